@@ -0,0 +1,398 @@
+"""
+Columnar aggregation of Search Console query rows.
+
+Rows are folded into array-backed columns as pages arrive, then loaded into
+a typed DataFrame with a dictionary-encoded query column; segment totals are
+computed with vectorized group-bys. Rows fetched with extra dimensions (date,
+device, country) are kept as dictionary-encoded columns so their
+brand/non-brand rollups come from the same fetch as the query totals; page
+rollups need a fetch of their own.
+"""
+import threading
+from itertools import islice
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from metrics import span
+
+QUERY_COLUMNS = ['query', 'clicks', 'impressions', 'position', 'ctr']
+# Dimensions that can be fetched together with query for rollups
+ROLLUP_DIMENSIONS = ['date', 'page', 'device', 'country']
+# Rows per rollup for dimensions other than date (date rollups cover every day)
+ROLLUP_LIMIT = 100
+
+
+class _Columns:
+    """Append-only numpy columns that grow by doubling."""
+
+    def __init__(self, dtypes: dict, capacity: int = 1024):
+        self.size = 0
+        self.arrays = {name: np.zeros(capacity, dtype=dtype) for name, dtype in dtypes.items()}
+
+    def append(self, **values):
+        count = len(next(iter(values.values())))
+        end = self.size + count
+        capacity = len(next(iter(self.arrays.values())))
+        if end > capacity:
+            while capacity < end:
+                capacity *= 2
+            for name, column in self.arrays.items():
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.arrays[name] = grown
+        for name, column in values.items():
+            self.arrays[name][self.size:end] = column
+        self.size = end
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name][:self.size]
+
+
+class QueryAccumulator:
+    """
+    Per-query totals folded page by page as API rows arrive.
+
+    Queries are interned in one dictionary and their metrics kept in
+    growable numpy columns, so raw page dicts can be dropped right after
+    they are folded. New queries are classified when first seen. Pages may
+    be folded from several threads.
+
+    With `dimensions`, rows are keyed by [query, *dimensions]: per-query
+    totals are summed over the extra dimensions and every row is also kept,
+    dictionary-encoded, for rollups(). Search Console counts impressions per
+    page when the page dimension is requested, so query totals would then be
+    page-level sums: page rows are folded into an accumulator of their own
+    and attached with add_rollups().
+    """
+
+    def __init__(self, classifier, dimensions: tuple = (), capacity: int = 1024):
+        self.classifier = classifier
+        self.dimensions = tuple(dimensions)
+        self._dimension_index = [{} for _ in self.dimensions]
+        self._dimension_values = [[] for _ in self.dimensions]
+        self._rows = None
+        if self.dimensions:
+            dtypes = {name: np.int32 for name in self.dimensions}
+            dtypes.update(query=np.int32, clicks=np.int64, impressions=np.int64, position_sum=np.float64)
+            self._rows = _Columns(dtypes)
+        self._index = {}
+        self._labels = []
+        self._clicks = np.zeros(capacity, dtype=np.int64)
+        self._impressions = np.zeros(capacity, dtype=np.int64)
+        self._position_sum = np.zeros(capacity, dtype=np.float64)
+        self._is_brand = np.zeros(capacity, dtype=bool)
+        self._lock = threading.Lock()
+        # Accumulators whose rollups are returned with ours, by dimension
+        self._attached = {}
+
+    def __len__(self):
+        return len(self._labels)
+
+    def _grow(self, size: int):
+        capacity = len(self._clicks)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity += capacity // 2
+        for name in ('_clicks', '_impressions', '_position_sum', '_is_brand'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    def fold(self, rows: list):
+        """Add API rows keyed by [query, *dimensions]; rows for the same (lowercased) query are summed."""
+        if not rows:
+            return
+        count = len(rows)
+        clicks = np.array([row.get('clicks', 0) for row in rows], dtype=np.int64)
+        impressions = np.array([row.get('impressions', 0) for row in rows], dtype=np.int64)
+        position = np.array([row.get('position', 0) for row in rows], dtype=np.float64)
+        # Queries are matched and displayed lowercased (Search Console already sends them so)
+        queries = [row['keys'][0] for row in rows]
+        queries = [query if query.islower() else query.lower() for query in queries]
+
+        with self._lock:
+            index = self._index
+            labels = self._labels
+            first_new = len(labels)
+            # A new query gets the next code; dicts keep insertion order, so new queries are the last keys
+            intern = index.setdefault
+            codes = np.fromiter((intern(query, len(index)) for query in queries), dtype=np.int64, count=count)
+            if len(index) > first_new:
+                labels.extend(reversed(list(islice(reversed(index), len(index) - first_new))))
+
+            if self._rows is not None:
+                self._fold_dimensions(rows, codes, clicks, impressions, position)
+
+            if len(labels) > first_new:
+                self._grow(len(labels))
+                with span('classification'):
+                    self._is_brand[first_new:len(labels)] = self.classifier.classify(labels[first_new:])
+
+            np.add.at(self._clicks, codes, clicks)
+            np.add.at(self._impressions, codes, impressions)
+            np.add.at(self._position_sum, codes, position * impressions)
+
+    def _fold_dimensions(self, rows: list, codes: np.ndarray, clicks, impressions, position):
+        values = {'query': codes, 'clicks': clicks, 'impressions': impressions, 'position_sum': position * impressions}
+        for d, name in enumerate(self.dimensions):
+            index = self._dimension_index[d]
+            dimension_values = self._dimension_values[d]
+            dimension_codes = np.empty(len(rows), dtype=np.int32)
+            for i, row in enumerate(rows):
+                value = row['keys'][d + 1]
+                code = index.get(value)
+                if code is None:
+                    code = index[value] = len(dimension_values)
+                    dimension_values.append(value)
+                dimension_codes[i] = code
+            values[name] = dimension_codes
+        self._rows.append(**values)
+
+    @property
+    def rollup_dimensions(self) -> tuple:
+        return self.dimensions + tuple(self._attached)
+
+    def add_rollups(self, accumulator: 'QueryAccumulator'):
+        """Return the rollups of an accumulator fetched separately (e.g. by page) with ours."""
+        self._attached.update(dict.fromkeys(accumulator.dimensions, accumulator))
+
+    def rollups(self, limit: int = ROLLUP_LIMIT) -> dict:
+        """
+        Brand/non-brand clicks, impressions, positions and brand share for each
+        value of every extra dimension, attached ones included. Dates are
+        returned in order (the brand share trend); other dimensions keep their
+        `limit` values with the most clicks.
+        """
+        rollups = self._rollups(limit)
+        for accumulator in dict.fromkeys(self._attached.values()):
+            rollups.update(accumulator._rollups(limit))
+        return rollups
+
+    def _rollups(self, limit: int) -> dict:
+        rows = self._rows
+        if rows is None or rows.size == 0:
+            return {name: [] for name in self.dimensions}
+
+        is_brand = self._is_brand[rows['query']].astype(np.int64)
+        metrics = {'clicks': rows['clicks'], 'impressions': rows['impressions'], 'position_sum': rows['position_sum']}
+        rollups = {}
+        for d, name in enumerate(self.dimensions):
+            values = self._dimension_values[d]
+            # Group by (dimension value, segment) in one pass: column 1 is brand, column 0 non-brand
+            group = rows[name].astype(np.int64) * 2 + is_brand
+            sums = {
+                metric: np.bincount(group, weights=column, minlength=2 * len(values)).reshape(-1, 2)
+                for metric, column in metrics.items()
+            }
+            clicks, impressions, position_sum = sums['clicks'], sums['impressions'], sums['position_sum']
+            total_clicks = clicks.sum(axis=1)
+
+            if name == 'date':
+                order = np.argsort(np.asarray(values, dtype=object), kind='stable')
+            else:
+                order = np.argsort(-total_clicks, kind='stable')[:limit]
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                share = np.where(total_clicks > 0, clicks[:, 1] / total_clicks * 100, 0.0)
+                avg_position = np.where(impressions > 0, position_sum / impressions, 0.0)
+
+            rollups[name] = [
+                {
+                    name: values[i],
+                    "brand_clicks": int(clicks[i, 1]),
+                    "non_brand_clicks": int(clicks[i, 0]),
+                    "brand_impressions": int(impressions[i, 1]),
+                    "non_brand_impressions": int(impressions[i, 0]),
+                    "brand_share": float(share[i]),
+                    "brand_avg_position": float(avg_position[i, 1]),
+                    "non_brand_avg_position": float(avg_position[i, 0])
+                }
+                for i in order
+            ]
+        return rollups
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        The per-query frame, ordered by clicks then query so the order does not
+        depend on which page arrived first. This finishes the accumulator: the
+        query index and metric columns are released and no more pages can be
+        folded; rollups() still works.
+        """
+        index, self._index = self._index, None
+        labels = self._labels
+        size = len(labels)
+        clicks = self._clicks[:size]
+        impressions = self._impressions[:size]
+
+        # Codes in lexical order of their queries: the strings are sorted as they are
+        # (no sort keys) and mapped back to their codes through the query index
+        lexical = np.fromiter(map(index.__getitem__, sorted(labels)), dtype=np.int64, count=size)
+        del index
+        # Most clicks first, ties in lexical order
+        order = lexical[np.argsort(-clicks[lexical], kind='stable')]
+        del lexical
+        # Columns are built in row order once and handed to the frame without another copy;
+        # the accumulator's own columns are released first (rollups only need is_brand)
+        clicks = clicks[order]
+        impressions = impressions[order]
+        position_sum = self._position_sum[:size][order]
+        self._clicks = self._impressions = self._position_sum = None
+        ranked = impressions > 0
+        ctr = np.divide(clicks, impressions, out=np.zeros(size), where=ranked)
+        ctr *= 100
+        position = np.divide(position_sum, impressions, out=position_sum, where=ranked)
+        position[~ranked] = 0.0
+
+        # Categories in row order, so the codes are simply 0..n-1
+        query = pd.Categorical.from_codes(
+            np.arange(size, dtype=np.int32),
+            dtype=pd.CategoricalDtype(pd.Index(np.array(labels, dtype=object)[order], dtype=object))
+        )
+
+        return pd.DataFrame({
+            'query': query,
+            'clicks': clicks,
+            'impressions': impressions,
+            'ctr': ctr,
+            'position': position,
+            'is_brand': self._is_brand[:size][order]
+        }, copy=False)
+
+
+def segment_totals(frame: pd.DataFrame) -> dict:
+    """
+    Clicks, impressions, CTR and impression-weighted position per segment.
+    Returns {'brand': {...}, 'non_brand': {...}}.
+    """
+    grouped = frame.assign(position_sum=frame['position'] * frame['impressions']).groupby('is_brand')[
+        ['clicks', 'impressions', 'position_sum']
+    ].sum()
+
+    totals = {}
+    for segment, is_brand in (('brand', True), ('non_brand', False)):
+        if is_brand in grouped.index:
+            clicks, impressions, position_sum = grouped.loc[is_brand]
+        else:
+            clicks, impressions, position_sum = 0, 0, 0.0
+        clicks, impressions, position_sum = int(clicks), int(impressions), float(position_sum)
+        totals[segment] = {
+            'clicks': clicks,
+            'impressions': impressions,
+            'position_sum': position_sum,
+            'ctr': (clicks / impressions * 100) if impressions > 0 else 0,
+            'avg_position': (position_sum / impressions) if impressions > 0 else 0
+        }
+    return totals
+
+
+def add_shares(frame: pd.DataFrame, total_clicks: int, total_impressions: int) -> pd.DataFrame:
+    """Add each query's share of all clicks and impressions, in percent."""
+    frame['click_share'] = frame['clicks'] / total_clicks * 100 if total_clicks > 0 else 0.0
+    frame['impression_share'] = frame['impressions'] / total_impressions * 100 if total_impressions > 0 else 0.0
+    return frame
+
+
+def top_queries(frame: pd.DataFrame, is_brand: bool, n: int = 10) -> List[dict]:
+    """Top-n queries of a segment by clicks, using partial selection."""
+    segment = frame.loc[frame['is_brand'] == is_brand, QUERY_COLUMNS]
+    top = segment.nlargest(n, 'clicks', keep='first')
+    return query_records(top)
+
+
+def query_records(frame: pd.DataFrame) -> List[dict]:
+    return frame[QUERY_COLUMNS].astype({'query': str}).to_dict('records')
+
+
+def _as_categorical(column: pd.Series) -> pd.Categorical:
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.array
+    return pd.Categorical(column.astype(str))
+
+
+def compare_queries(
+    previous: pd.DataFrame,
+    current: pd.DataFrame,
+    clicks_threshold: float = 10,
+    position_threshold: float = 0.5,
+    limit: int = 100
+) -> List[dict]:
+    """
+    Compare per-query metrics between two periods and return the `limit`
+    most significant changes, ordered by absolute click change.
+
+    Both frames are aligned on one shared query dictionary (an outer join
+    done with array indexing) and only the top-k rows are materialized.
+    """
+    if limit <= 0:
+        return []
+
+    # Share one query dictionary between both periods: the previous period's
+    # categories, extended with the queries that only appear in the current one
+    previous_query = _as_categorical(previous['query'])
+    current_query = _as_categorical(current['query'])
+    previous_categories = previous_query.categories
+    positions = previous_categories.get_indexer(current_query.categories)
+    is_new = positions == -1
+    positions[is_new] = len(previous_categories) + np.arange(int(is_new.sum()))
+    uniques = previous_categories.append(current_query.categories[is_new])
+
+    previous_codes = previous_query.codes
+    current_codes = positions[current_query.codes]
+    size = len(uniques)
+
+    def align(frame: pd.DataFrame, frame_codes: np.ndarray) -> dict:
+        columns = {'present': np.zeros(size, dtype=bool)}
+        columns['present'][frame_codes] = True
+        for name, dtype in (('clicks', np.int64), ('impressions', np.int64), ('ctr', np.float64), ('position', np.float64)):
+            column = np.zeros(size, dtype=dtype)
+            column[frame_codes] = frame[name].to_numpy()
+            columns[name] = column
+        return columns
+
+    prev = align(previous, previous_codes)
+    curr = align(current, current_codes)
+
+    # Same rules as calculate_percentage_change, applied to whole columns
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clicks_change = np.where(
+            prev['clicks'] == 0,
+            np.where(curr['clicks'] > 0, 100.0, 0.0),
+            (curr['clicks'] - prev['clicks']) / prev['clicks'] * 100
+        )
+    both_ranked = (prev['position'] != 0) & (curr['position'] != 0)
+    position_change = np.where(both_ranked, prev['position'] - curr['position'], 0.0)
+
+    significant = np.flatnonzero(
+        (np.abs(clicks_change) > clicks_threshold) | (np.abs(position_change) > position_threshold)
+    )
+    score = np.abs(clicks_change[significant])
+    if limit < len(significant):
+        keep = np.argpartition(-score, limit - 1)[:limit]
+        significant, score = significant[keep], score[keep]
+    top = significant[np.argsort(-score, kind='stable')]
+
+    def record(columns: dict, i: int) -> dict:
+        if not columns['present'][i]:
+            return {"clicks": 0, "impressions": 0, "ctr": 0, "position": 0}
+        return {
+            "query": uniques[i],
+            "clicks": int(columns['clicks'][i]),
+            "impressions": int(columns['impressions'][i]),
+            "position": float(columns['position'][i]),
+            "ctr": float(columns['ctr'][i])
+        }
+
+    return [
+        {
+            "query": uniques[i],
+            "clicks_change": float(clicks_change[i]),
+            "position_change": float(position_change[i]),
+            "current": record(curr, i),
+            "previous": record(prev, i)
+        }
+        for i in top
+    ]
@@ -0,0 +1,388 @@
+"""
+Analysis pipeline shared by the /analyze and /compare endpoints.
+
+Authentication and site resolution, period fetching and aggregation are
+separate steps so that callers analysing several periods can authenticate
+once and fetch concurrently. Queries are classified and folded into compact
+columns page by page while the rest of the period is still downloading.
+"""
+import asyncio
+import json
+import logging
+import time
+
+import pandas as pd
+from fastapi import HTTPException, UploadFile
+
+from aggregation import QueryAccumulator, add_shares, segment_totals, top_queries
+from classifier import get_classifier, site_classifier
+from fetch import fetch_rows
+from gsc import cache_site, get_cached_site, get_session
+from metrics import span
+from results import DATA_VERSION_SECONDS, AnalysisResult, save_result
+from store import row_store, sync_site
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_PERMISSION_LEVELS = ['siteOwner', 'siteFullUser', 'siteRestrictedUser']
+
+
+def get_base_domain(url: str) -> str:
+    """
+    Get the base domain from a URL, handling various formats.
+    Returns the domain without any prefix or protocol.
+    """
+    # Remove protocol if present
+    url = url.lower().strip()
+    if '://' in url:
+        url = url.split('://', 1)[1]
+
+    # Remove path, query parameters, etc.
+    url = url.split('/')[0]
+
+    # Remove www. if present
+    if url.startswith('www.'):
+        url = url[4:]
+
+    # Remove sc-domain: if present
+    if url.startswith('sc-domain:'):
+        url = url[10:]
+
+    return url
+
+
+def get_all_possible_site_formats(domain: str) -> list:
+    """
+    Generate all possible formats for a given domain.
+    """
+    domain = get_base_domain(domain)  # Clean the domain first
+    return [
+        f"sc-domain:{domain}",
+        f"https://www.{domain}/",
+        f"https://{domain}/",
+        f"http://www.{domain}/",
+        f"http://{domain}/"
+    ]
+
+
+async def resolve_site(session, site_url: str) -> str:
+    """
+    Find the Search Console property matching the requested domain and verify
+    the service account may read it. Matches are cached per service account.
+    """
+    # Clean up input domain
+    input_domain = get_base_domain(site_url)
+    logger.debug("Cleaned input domain: %s", input_domain)
+
+    cached = get_cached_site(session, input_domain)
+    if cached is None:
+        sites = await session.list_sites()
+
+        # Log all available sites
+        available_sites = [site['siteUrl'] for site in sites.get('siteEntry', [])]
+        logger.debug("Available sites: %s", available_sites)
+
+        # Try to find any site that matches our domain
+        for site in sites.get('siteEntry', []):
+            current_site_url = site['siteUrl']
+            current_domain = get_base_domain(current_site_url)
+
+            logger.debug("Checking site URL: %s", current_site_url)
+            logger.debug("Cleaned site domain: %s", current_domain)
+            logger.debug("Comparing with input domain: %s", input_domain)
+
+            if current_domain == input_domain:
+                logger.info(f"Found matching domain! Using site URL: {current_site_url}")
+                cached = (current_site_url, site.get('permissionLevel'))
+                cache_site(session, input_domain, *cached)
+                break
+
+        if cached is None:
+            error_msg = f"No matching domain found. You entered: {site_url} (cleaned to: {input_domain}). Available sites: {available_sites}"
+            logger.error(error_msg)
+            raise HTTPException(status_code=404, detail=error_msg)
+
+    matched_site_url, permission_level = cached
+    if permission_level not in ALLOWED_PERMISSION_LEVELS:
+        logger.error(f"Insufficient permission level: {permission_level}")
+        raise HTTPException(status_code=403, detail="Insufficient permissions to access site data")
+
+    logger.info(f"Access verified with permission level: {permission_level}")
+    return matched_site_url
+
+
+async def read_json_key(file: UploadFile) -> dict:
+    """Read and parse the uploaded service-account key file."""
+    try:
+        content = await file.read()
+        logger.info(f"JSON key file name: {file.filename}")
+        json_key = json.loads(content)
+        logger.info("Successfully parsed JSON key file")
+        return json_key
+    except json.JSONDecodeError as je:
+        logger.error(f"JSON decode error: {str(je)}")
+        raise HTTPException(status_code=400, detail=f"Invalid JSON key file: {str(je)}")
+    except Exception as e:
+        logger.error(f"Error reading file: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Error reading file: {str(e)}")
+
+
+async def open_site(json_key: dict, site_url: str):
+    """Authenticate (cached per service account) and resolve the property. Returns (session, site_url)."""
+    try:
+        with span('auth'):
+            session = await get_session(json_key)
+        logger.info("Successfully created credentials")
+
+        # Verify site access before proceeding
+        with span('site_lookup'):
+            normalized_site_url = await resolve_site(session, site_url)
+        logger.info(f"Final site URL being used: {normalized_site_url}")
+        return session, normalized_site_url
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Credentials or site access error: {str(e)}")
+        raise HTTPException(status_code=403, detail=f"Error accessing Search Console: {str(e)}")
+
+
+async def _fetch_total_clicks(session, site_url: str, start_date: str, end_date: str) -> int:
+    total_request = {
+        'startDate': start_date,
+        'endDate': end_date,
+        'dimensions': []  # No dimensions means we get totals
+    }
+
+    try:
+        logger.debug("Querying total clicks...")
+        with span('totals'):
+            total_response = await session.query(site_url, total_request)
+        logger.debug("Total response: %s", total_response)
+    except Exception as e:
+        logger.error(f"Search Console API error (totals): {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Error querying Search Console API: {str(e)}")
+
+    if 'rows' not in total_response or not total_response['rows']:
+        logger.error("No data returned from Search Console API")
+        raise HTTPException(status_code=404, detail="No data found for the specified period")
+
+    return total_response['rows'][0]['clicks']
+
+
+async def _fetch_query_rows(session, site_url: str, start_date: str, end_date: str, shard: str, on_page, accumulator):
+    # Fetch query rows, sharded and paged concurrently for large properties, folding pages as they arrive
+    try:
+        return await fetch_rows(
+            session, site_url, start_date, end_date, dimensions=['query', *accumulator.dimensions],
+            shard=shard, on_page=on_page, sink=accumulator
+        )
+    except Exception as e:
+        logger.error(f"Search Console API error (query data): {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Error querying Search Console API: {str(e)}")
+
+
+def _fold_stored_rows(accumulator: QueryAccumulator, site_url: str, start_date: str, end_date: str):
+    by_date = 'date' in accumulator.dimensions
+    with span('fold'):
+        for rows in row_store.query_row_chunks(site_url, start_date, end_date, by_date=by_date):
+            accumulator.fold(rows)
+
+
+async def fetch_period(
+    session,
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    classifier,
+    shard: str = 'auto',
+    on_page=None,
+    dimensions: tuple = ()
+):
+    """
+    Property-level total clicks and the classified per-query totals of one period.
+    Returns (total_gsc_clicks, QueryAccumulator). `on_page(row_count)` reports fetch progress.
+    Extra `dimensions` (see aggregation.ROLLUP_DIMENSIONS) are fetched in the same pass for
+    rollups, except page: Search Console counts impressions per page once page is a
+    dimension, so page rows are fetched on their own and never enter the query totals.
+    """
+    classifier = site_classifier(classifier, site_url)
+    accumulator = QueryAccumulator(classifier, tuple(d for d in dimensions if d != 'page'))
+    if 'page' in dimensions:
+        pages = QueryAccumulator(classifier, ('page',))
+        (total_gsc_clicks, _), _ = await asyncio.gather(
+            _fill_period(accumulator, session, site_url, start_date, end_date, shard, on_page),
+            _fetch_query_rows(session, site_url, start_date, end_date, shard, on_page, pages)
+        )
+        accumulator.add_rollups(pages)
+    else:
+        total_gsc_clicks, _ = await _fill_period(accumulator, session, site_url, start_date, end_date, shard, on_page)
+
+    logger.info(f"Total GSC clicks: {total_gsc_clicks}")
+    logger.info(f"Total queries fetched: {len(accumulator)}")
+    return total_gsc_clicks, accumulator
+
+
+async def _fill_period(accumulator, session, site_url: str, start_date: str, end_date: str, shard: str, on_page):
+    """Fold one period's query rows into `accumulator`. Returns (total_gsc_clicks, None)."""
+    # The row store keeps per-day query rows, so it can only answer date rollups
+    if row_store is not None and set(accumulator.dimensions) <= {'date'}:
+        # Answer from the local row store, fetching only the days it is missing
+        try:
+            await sync_site(row_store, session, site_url, start_date, end_date, shard, on_page)
+        except Exception as e:
+            logger.error(f"Search Console API error (row store sync): {str(e)}")
+            raise HTTPException(status_code=400, detail=f"Error querying Search Console API: {str(e)}")
+
+        total_gsc_clicks = await asyncio.to_thread(row_store.total_clicks, site_url, start_date, end_date)
+        if total_gsc_clicks is None:
+            logger.error("No data returned from Search Console API")
+            raise HTTPException(status_code=404, detail="No data found for the specified period")
+
+        await asyncio.to_thread(_fold_stored_rows, accumulator, site_url, start_date, end_date)
+        return total_gsc_clicks, None
+    return await asyncio.gather(
+        _fetch_total_clicks(session, site_url, start_date, end_date),
+        _fetch_query_rows(session, site_url, start_date, end_date, shard, on_page, accumulator)
+    )
+
+
+def summarize_period(accumulator: QueryAccumulator, total_gsc_clicks: int):
+    """Aggregate one fetched period. Returns (summary, frame)."""
+    with span('aggregation'):
+        return _summarize_period(accumulator, total_gsc_clicks)
+
+
+def _summarize_period(accumulator: QueryAccumulator, total_gsc_clicks: int):
+    # Load the folded columns into a frame and aggregate per segment
+    frame = accumulator.to_frame()
+    summary = segment_summary(segment_totals(frame), total_gsc_clicks)
+    add_shares(frame, summary["total_all_clicks"], summary["total_impressions"])
+
+    summary["top_brand_queries"] = top_queries(frame, True, 10)  # Top 10 pour le dashboard
+    summary["top_non_brand_queries"] = top_queries(frame, False, 10)  # Top 10 pour le dashboard
+    if accumulator.rollup_dimensions:
+        summary["rollups"] = accumulator.rollups()
+    return summary, frame
+
+
+def segment_summary(totals: dict, total_gsc_clicks: int) -> dict:
+    """
+    Summary metrics of a period from its per-segment totals (see
+    aggregation.segment_totals) and the property-level click total.
+    """
+    brand_clicks = totals['brand']['clicks']
+    brand_impressions = totals['brand']['impressions']
+    non_brand_clicks = totals['non_brand']['clicks']
+    non_brand_impressions = totals['non_brand']['impressions']
+    total_impressions = brand_impressions + non_brand_impressions
+
+    # Calculate metrics
+    total_all_clicks = brand_clicks + non_brand_clicks
+    unattributed_clicks = max(0, total_gsc_clicks - total_all_clicks)
+
+    total_with_unattributed = total_all_clicks + unattributed_clicks
+    brand_percentage = (brand_clicks / total_with_unattributed * 100) if total_with_unattributed > 0 else 0
+    non_brand_percentage = (non_brand_clicks / total_with_unattributed * 100) if total_with_unattributed > 0 else 0
+    unattributed_percentage = (unattributed_clicks / total_with_unattributed * 100) if total_with_unattributed > 0 else 0
+
+    brand_avg_position = totals['brand']['avg_position']
+    non_brand_avg_position = totals['non_brand']['avg_position']
+
+    brand_ctr = totals['brand']['ctr']
+    non_brand_ctr = totals['non_brand']['ctr']
+
+    # Calculate visibility score (0-100)
+    visibility_score = min(100, (
+        (brand_percentage * 0.4) +  # Brand dominance
+        (min(100, (1/brand_avg_position) * 50) * 0.3) +  # Brand position
+        (min(100, brand_ctr) * 0.3)  # Brand CTR
+    )) if brand_avg_position > 0 else 0
+
+    return {
+        "total_all_clicks": total_with_unattributed,
+        "brand_clicks": brand_clicks,
+        "non_brand_clicks": non_brand_clicks,
+        "brand_percentage": brand_percentage,
+        "non_brand_percentage": non_brand_percentage,
+        "unattributed_clicks": unattributed_clicks,
+        "unattributed_percentage": unattributed_percentage,
+        # Additional metrics for exports
+        "brand_impressions": brand_impressions,
+        "non_brand_impressions": non_brand_impressions,
+        "brand_ctr": brand_ctr,
+        "non_brand_ctr": non_brand_ctr,
+        "brand_avg_position": brand_avg_position,
+        "non_brand_avg_position": non_brand_avg_position,
+        "visibility_score": visibility_score,
+        "total_impressions": total_impressions
+    }
+
+
+async def analyze_site(
+    session,
+    matched_site_url: str,
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    classifier,
+    shard: str = 'auto',
+    progress=None,
+    dimensions: tuple = ()
+) -> dict:
+    """
+    Fetch, classify, aggregate and store one period of a resolved property.
+    `progress`, when given, is a jobs.Job receiving phase and counter updates.
+    """
+    on_page = None
+    if progress is not None:
+        progress.update(phase='fetching')
+        on_page = progress.page_fetched
+
+    # Pages are classified and folded while the remaining ones download
+    total_gsc_clicks, accumulator = await fetch_period(
+        session, matched_site_url, start_date, end_date, classifier, shard, on_page, dimensions
+    )
+
+    if progress is not None:
+        progress.update(phase='aggregating')
+    summary, frame = await asyncio.to_thread(summarize_period, accumulator, total_gsc_clicks)
+    if progress is not None:
+        progress.update(rows_processed=len(accumulator))
+    # Building the result's sort indexes takes a while on large properties
+    return await asyncio.to_thread(store_result, summary, frame, site_url, start_date, end_date)
+
+
+async def run_analysis(
+    json_key: dict,
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    exclude_regex: str,
+    match_mode: str = 'keywords',
+    shard: str = 'auto',
+    progress=None,
+    dimensions: tuple = ()
+) -> dict:
+    """Full /analyze pipeline: auth, site lookup, then analyze_site."""
+    # Initialize credentials and service (cached per service account)
+    session, normalized_site_url = await open_site(json_key, site_url)
+    classifier = get_classifier(exclude_regex, match_mode)
+    return await analyze_site(
+        session, normalized_site_url, site_url, start_date, end_date, classifier, shard, progress, dimensions
+    )
+
+
+async def data_version(site_url: str, start_date: str, end_date: str) -> str:
+    """Version of the Search Console data behind a period, for ETags."""
+    if row_store is not None:
+        fetched_at = await asyncio.to_thread(row_store.data_version, site_url, start_date, end_date)
+        if fetched_at is not None:
+            return f"store:{fetched_at}"
+    return f"time:{int(time.time() // DATA_VERSION_SECONDS)}"
+
+
+def store_result(summary: dict, frame: pd.DataFrame, site_url: str, start_date: str, end_date: str) -> dict:
+    """Keep the full query data for the export endpoints and tag the summary with its result ID."""
+    summary["result_id"] = save_result(AnalysisResult(summary, frame, site_url, start_date, end_date))
+    return summary
@@ -0,0 +1,142 @@
+"""
+Batch analysis of many properties under one service account.
+
+Sites are listed once per key. Each property then takes its session from
+the session cache when its analysis starts: sessions carry a bearer token
+that cannot be refreshed, and a large batch outlives it, so the key is kept
+for the duration of the batch to open a new one when the cached one expires.
+Site analyses are bounded by a process-wide
+semaphore, so concurrent batches cannot flood the Search Console API.
+Results are reported as each site finishes, then rolled up into a portfolio
+summary.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import List
+
+from fastapi import HTTPException
+
+from analysis import ALLOWED_PERMISSION_LEVELS, analyze_site, resolve_site
+from gsc import get_session
+
+logger = logging.getLogger(__name__)
+
+# Site analyses running at once across all batches in this worker
+BATCH_SITE_CONCURRENCY = int(os.getenv("BATCH_SITE_CONCURRENCY", "4"))
+# Maximum number of properties in one batch
+BATCH_MAX_SITES = int(os.getenv("BATCH_MAX_SITES", "200"))
+
+_site_semaphore = None
+
+
+def _semaphore() -> asyncio.Semaphore:
+    global _site_semaphore
+    if _site_semaphore is None:
+        _site_semaphore = asyncio.Semaphore(BATCH_SITE_CONCURRENCY)
+    return _site_semaphore
+
+
+def parse_site_list(site_urls: str) -> List[str]:
+    """Split a comma or newline separated list of sites, dropping blanks and duplicates."""
+    sites = []
+    for site in site_urls.replace('\n', ',').split(','):
+        site = site.strip()
+        if site and site not in sites:
+            sites.append(site)
+    return sites
+
+
+async def accessible_sites(session) -> List[str]:
+    """Every property the service account may read."""
+    sites = await session.list_sites()
+    return [
+        site['siteUrl'] for site in sites.get('siteEntry', [])
+        if site.get('permissionLevel') in ALLOWED_PERMISSION_LEVELS
+    ]
+
+
+def portfolio_rollup(summaries: List[dict]) -> dict:
+    """Combine per-site summaries; positions are weighted by impressions."""
+    brand_clicks = sum(s['brand_clicks'] for s in summaries)
+    non_brand_clicks = sum(s['non_brand_clicks'] for s in summaries)
+    unattributed_clicks = sum(s['unattributed_clicks'] for s in summaries)
+    total_all_clicks = sum(s['total_all_clicks'] for s in summaries)
+    brand_impressions = sum(s['brand_impressions'] for s in summaries)
+    non_brand_impressions = sum(s['non_brand_impressions'] for s in summaries)
+    brand_position_sum = sum(s['brand_avg_position'] * s['brand_impressions'] for s in summaries)
+    non_brand_position_sum = sum(s['non_brand_avg_position'] * s['non_brand_impressions'] for s in summaries)
+
+    def percentage(clicks):
+        return (clicks / total_all_clicks * 100) if total_all_clicks > 0 else 0
+
+    return {
+        "total_all_clicks": total_all_clicks,
+        "brand_clicks": brand_clicks,
+        "non_brand_clicks": non_brand_clicks,
+        "unattributed_clicks": unattributed_clicks,
+        "brand_percentage": percentage(brand_clicks),
+        "non_brand_percentage": percentage(non_brand_clicks),
+        "unattributed_percentage": percentage(unattributed_clicks),
+        "brand_impressions": brand_impressions,
+        "non_brand_impressions": non_brand_impressions,
+        "total_impressions": brand_impressions + non_brand_impressions,
+        "brand_ctr": (brand_clicks / brand_impressions * 100) if brand_impressions > 0 else 0,
+        "non_brand_ctr": (non_brand_clicks / non_brand_impressions * 100) if non_brand_impressions > 0 else 0,
+        "brand_avg_position": (brand_position_sum / brand_impressions) if brand_impressions > 0 else 0,
+        "non_brand_avg_position": (non_brand_position_sum / non_brand_impressions) if non_brand_impressions > 0 else 0
+    }
+
+
+async def _analyze_one(
+    json_key: dict, site_url: str, start_date: str, end_date: str, classifier, shard: str, dimensions: tuple
+) -> dict:
+    try:
+        async with _semaphore():
+            session = await get_session(json_key)
+            matched_site_url = await resolve_site(session, site_url)
+            summary = await analyze_site(
+                session, matched_site_url, site_url, start_date, end_date, classifier, shard, dimensions=dimensions
+            )
+        return {"type": "site", "site_url": site_url, "matched_site_url": matched_site_url, "summary": summary}
+    except HTTPException as he:
+        error = {"status_code": he.status_code, "detail": he.detail}
+    except Exception as e:
+        logger.error(f"Batch analysis failed for {site_url}: {str(e)}")
+        error = {"status_code": 500, "detail": f"An unexpected error occurred: {str(e)}"}
+    return {"type": "site", "site_url": site_url, "error": error}
+
+
+async def run_batch(
+    json_key: dict, sites: List[str], start_date: str, end_date: str, classifier, shard: str = 'auto', dimensions: tuple = ()
+):
+    """
+    Analyse `sites` concurrently and yield NDJSON lines: one per site as it
+    finishes, then the portfolio rollup of the sites that succeeded.
+    """
+    yield json.dumps({"type": "batch", "sites": sites}) + "\n"
+
+    tasks = [
+        asyncio.create_task(_analyze_one(json_key, site, start_date, end_date, classifier, shard, dimensions))
+        for site in sites
+    ]
+    summaries = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            line = await next_done
+            if 'summary' in line:
+                summaries.append(line['summary'])
+            yield json.dumps(line) + "\n"
+    finally:
+        # The client went away: stop analysing the remaining sites
+        for task in tasks:
+            task.cancel()
+
+    logger.info(f"Batch finished: {len(summaries)}/{len(sites)} sites analysed")
+    yield json.dumps({
+        "type": "portfolio",
+        "sites": len(summaries),
+        "failed": len(sites) - len(summaries),
+        "summary": portfolio_rollup(summaries)
+    }) + "\n"
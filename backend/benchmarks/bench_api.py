@@ -0,0 +1,244 @@
+"""
+End-to-end benchmark of /analyze and /compare against the local fake
+Search Console server (fake_gsc.py), with no Google property or network.
+
+Starts the fake server and the backend as subprocesses, then reports
+latency, peak RSS of the backend and rows/sec (rows served by the fake API
+per second of request time) for:
+  - /analyze, cold (first request of the process) and warm
+  - /compare
+  - a concurrency load check: N /analyze requests at once on distinct date
+    ranges, so they cannot share upstream calls. The script exits non-zero
+    when the time N requests spend waiting on the fake API adds up as if
+    they were served one after another (more than --max-serial-share of
+    N x one request's wait). CPU time is discounted: on a single core it
+    is serial no matter how well requests overlap.
+
+Usage (from backend/):
+    python benchmarks/bench_api.py --queries 200000 --latency 0.1 --runs 3 --concurrency 8
+
+The same scenarios run with time and memory budgets as a pytest-benchmark
+suite in test_bench_api.py.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+
+import httpx
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def service_account_key(token_uri: str) -> bytes:
+    """A throwaway service-account key whose token exchange goes to the fake server."""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    return json.dumps({
+        "type": "service_account",
+        "project_id": "bench",
+        "private_key_id": "bench",
+        "private_key": pem,
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri
+    }).encode()
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    sys.exit(f"{url} did not start within {timeout}s")
+
+
+def peak_rss_mb(pid: int):
+    """Peak resident set size of a process (Linux only), in MiB."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def reset_peak_rss(pid: int):
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def cpu_seconds(*pids: int) -> float:
+    """User plus system CPU time used so far by these processes (Linux only, else 0)."""
+    total = 0.0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except OSError:
+            pass
+    return total
+
+
+def days_ago(days: int) -> str:
+    return (date.today() - timedelta(days=days)).isoformat()
+
+
+class Bench:
+    def __init__(self, app_url: str, fake_url: str, app_pid: int, fake_pid: int, key: bytes):
+        self.app_url = app_url
+        self.fake_url = fake_url
+        self.app_pid = app_pid
+        self.fake_pid = fake_pid
+        self.key = key
+        self.cpu = 0.0
+        self.rows = 0
+        self.rss = None
+
+    async def post(self, client: httpx.AsyncClient, path: str, data: dict) -> float:
+        start = time.perf_counter()
+        response = await client.post(path, files={'file': ('key.json', self.key)}, data=data)
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            sys.exit(f"{path} failed with {response.status_code}: {response.text[:500]}")
+        return elapsed
+
+    async def run(self, name: str, requests: list) -> float:
+        """
+        Send `requests` [(path, form)] at once, print one result line and
+        return the wall time. The CPU time both servers spent, the rows served
+        by the fake API and the backend's peak RSS are kept in `cpu`, `rows`
+        and `rss`.
+        """
+        rows_before = httpx.get(self.fake_url).json()['rows_served']
+        reset_peak_rss(self.app_pid)
+        async with httpx.AsyncClient(base_url=self.app_url, timeout=3600) as client:
+            cpu_before = cpu_seconds(self.app_pid, self.fake_pid)
+            start = time.perf_counter()
+            latencies = await asyncio.gather(*(self.post(client, path, data) for path, data in requests))
+            wall = time.perf_counter() - start
+            self.cpu = cpu_seconds(self.app_pid, self.fake_pid) - cpu_before
+        self.rows = httpx.get(self.fake_url).json()['rows_served'] - rows_before
+        self.rss = peak_rss_mb(self.app_pid)
+        print(
+            f"{name:<24} {len(requests):>3} req  "
+            f"p50 {statistics.median(latencies):7.2f}s  max {max(latencies):7.2f}s  "
+            f"{self.rows / wall:>10,.0f} rows/s  peak RSS "
+            + (f"{self.rss:7.0f} MiB" if self.rss is not None else "n/a")
+        )
+        return wall
+
+
+def analyze_form(start: str, end: str) -> dict:
+    return {'start_date': start, 'end_date': end, 'exclude_regex': 'queryscope|qscope', 'site_url': 'example.com'}
+
+
+# Date ranges end a week before the dataset does so concurrent requests can shift
+# their windows (and therefore their upstream queries) by one day each
+ANALYZE = ('/analyze', analyze_form(days_ago(35), days_ago(8)))
+COMPARE = ('/compare', {
+    'current_start_date': days_ago(35), 'current_end_date': days_ago(8),
+    'previous_start_date': days_ago(63), 'previous_end_date': days_ago(36),
+    'exclude_regex': 'queryscope|qscope', 'site_url': 'example.com'
+})
+
+
+async def serial_share(bench: Bench, concurrency: int):
+    """
+    Share of N x one request's wait that N concurrent /analyze requests spent
+    waiting, or None when the injected latency is too small to tell.
+    """
+    load = [('/analyze', analyze_form(days_ago(35 + i), days_ago(8 + i))) for i in range(concurrency)]
+    concurrent = await bench.run(f'analyze x{concurrency} concurrent', load)
+    concurrent_cpu = bench.cpu
+    single = await bench.run('analyze x1 (reference)', load[:1])
+    wait = single - bench.cpu
+
+    # Served one at a time, N requests also wait N times as long as one
+    if concurrency < 2 or wait < 0.1 * single:
+        print("load check skipped: needs a concurrency of 2+ and enough latency to outweigh CPU time")
+        return None
+    share = max(0.0, concurrent - concurrent_cpu) / (concurrency * wait)
+    print(f"concurrent wait is {share:.0%} of {concurrency} x the single request's "
+          f"({concurrent:.2f}s wall, {concurrent_cpu:.2f}s CPU; one request {single:.2f}s wall, {bench.cpu:.2f}s CPU)")
+    return share
+
+
+async def benchmark(bench: Bench, runs: int, concurrency: int, max_serial_share: float):
+    await bench.run('analyze (cold)', [ANALYZE])
+    for run in range(runs):
+        await bench.run(f'analyze #{run + 1}', [ANALYZE])
+    for run in range(runs):
+        await bench.run(f'compare #{run + 1}', [COMPARE])
+    share = await serial_share(bench, concurrency)
+    if share is not None and share > max_serial_share:
+        sys.exit(f"FAIL: concurrent requests waited one after another (limit {max_serial_share:.0%})")
+
+
+@contextlib.contextmanager
+def servers(queries: int, days: int, latency: float, error_rate: float, fake_port: int, app_port: int):
+    """Run the fake Search Console server and the backend as subprocesses and yield a Bench against them."""
+    fake_url = f"http://127.0.0.1:{fake_port}/"
+    app_url = f"http://127.0.0.1:{app_port}"
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(BACKEND_DIR, 'benchmarks', 'fake_gsc.py'),
+        '--queries', str(queries), '--days', str(days), '--latency', str(latency),
+        '--error-rate', str(error_rate), '--port', str(fake_port)
+    ])
+    env = dict(os.environ, GSC_API_ENDPOINT=fake_url, ROW_STORE_PATH='')
+    app = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(app_port), '--log-level', 'warning'],
+        cwd=BACKEND_DIR, env=env
+    )
+    try:
+        wait_until_up(fake_url, fake)
+        wait_until_up(f"{app_url}/stats", app)
+        yield Bench(app_url, fake_url, app.pid, fake.pid, service_account_key(f"{fake_url}token"))
+    finally:
+        app.terminate()
+        fake.terminate()
+        app.wait()
+        fake.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=200_000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--latency', type=float, default=0.1, help='mean seconds added to each fake API call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of fake API calls answered with 429')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--max-serial-share', type=float, default=0.5,
+                        help="fail when N concurrent requests wait more than this share of N x one request's wait")
+    parser.add_argument('--fake-port', type=int, default=8765)
+    parser.add_argument('--app-port', type=int, default=8766)
+    args = parser.parse_args()
+
+    with servers(args.queries, args.days, args.latency, args.error_rate, args.fake_port, args.app_port) as bench:
+        asyncio.run(benchmark(bench, args.runs, args.concurrency, args.max_serial_share))
+        print(json.dumps(httpx.get(f"{bench.app_url}/stats").json().get('query_scheduler'), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark brand classification: the legacy per-row keyword loop against the
+compiled BrandClassifier, and fuzzy mode against exact keyword matching on
+queries where some brand terms are misspelled or glued to another word.
+
+Usage (from backend/):
+    python benchmarks/bench_classifier.py --queries 1000000 --terms 200
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier import BrandClassifier, SiteClassifier  # noqa: E402
+
+
+# Brand terms that are common words must not match inside unrelated words
+FUZZY_CASES = {
+    'nike|apple': {'pineapple': False, 'apple pie': True, 'applestore': True, 'appleseo': True, 'pineapples': False},
+    'shell': {'eggshell paint': False, 'seashell': False, 'shell gas': True},
+    'queryscope|brand name': {
+        'queryscopeseo': True, 'myqueryscopelogin': False, 'queryscpe': True, 'query scope': True,
+        'brandname': True, 'querysc': False
+    },
+}
+
+
+def make_vocabulary(size: int, rng: random.Random) -> list:
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+
+def misspell(term: str, rng: random.Random) -> str:
+    """One typo (substitution, deletion or transposition), or the term glued to a suffix."""
+    i = rng.randrange(len(term) - 1)
+    kind = rng.randrange(4)
+    if kind == 0:
+        return term[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + term[i + 1:]
+    if kind == 1:
+        return term[:i] + term[i + 1:]
+    if kind == 2:
+        return term[:i] + term[i + 1] + term[i] + term[i + 2:]
+    return term + 'seo'
+
+
+def legacy_is_brand(query: str, exclude_regex: str) -> bool:
+    """The original per-row check from analyze_data."""
+    pattern = exclude_regex.lower()
+    brand_keywords = [kw.strip() for kw in pattern.split('|')]
+    return any(kw in query.split() for kw in brand_keywords)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=1_000_000)
+    parser.add_argument('--terms', type=int, default=200)
+    parser.add_argument('--legacy-sample', type=int, default=20_000,
+                        help='queries timed with the legacy loop (extrapolated to --queries)')
+    parser.add_argument('--typos', type=float, default=0.02, help='share of queries with a misspelled brand term')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(20_000, rng)
+    brand_terms = rng.sample(vocabulary, args.terms)
+    pattern = '|'.join(brand_terms)
+    queries = [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 5))) for _ in range(args.queries)]
+    print(f"{args.queries:,} queries x {args.terms} brand terms")
+
+    sample = queries[:args.legacy_sample]
+    start = time.perf_counter()
+    legacy = [legacy_is_brand(q, pattern) for q in sample]
+    legacy_elapsed = (time.perf_counter() - start) * len(queries) / len(sample)
+    print(f"legacy loop      {legacy_elapsed:8.2f}s (extrapolated from {len(sample):,} queries)")
+
+    start = time.perf_counter()
+    classifier = BrandClassifier(pattern, 'keywords')
+    mask = classifier.classify(queries)
+    elapsed = time.perf_counter() - start
+    print(f"BrandClassifier  {elapsed:8.2f}s ({len(queries) / elapsed:,.0f} queries/s, {int(mask.sum()):,} brand)")
+    print(f"speedup          {legacy_elapsed / elapsed:8.1f}x")
+
+    assert list(mask[:len(sample)]) == legacy, "classifier disagrees with the legacy loop"
+
+    regex = BrandClassifier(r'\b(' + pattern + r')\b', 'regex')
+    start = time.perf_counter()
+    regex.classify(queries)
+    elapsed = time.perf_counter() - start
+    print(f"regex mode       {elapsed:8.2f}s ({len(queries) / elapsed:,.0f} queries/s)")
+
+    long_terms = [term for term in brand_terms if len(term) >= 5]
+    fuzzy_queries = [
+        f"{q} {misspell(rng.choice(long_terms), rng)}" if rng.random() < args.typos else q
+        for q in queries
+    ]
+    start = time.perf_counter()
+    exact_mask = BrandClassifier(pattern, 'keywords').classify(fuzzy_queries)
+    exact_elapsed = time.perf_counter() - start
+    print(f"keywords mode    {exact_elapsed:8.2f}s ({int(exact_mask.sum()):,} brand)")
+
+    fuzzy = BrandClassifier(pattern, 'fuzzy')
+    site = SiteClassifier(fuzzy)
+    for run in ('cold', 'warm'):
+        start = time.perf_counter()
+        fuzzy_mask = site.classify(fuzzy_queries)
+        elapsed = time.perf_counter() - start
+        print(f"fuzzy mode {run}  {elapsed:8.2f}s ({int(fuzzy_mask.sum()):,} brand, "
+              f"{elapsed / exact_elapsed:.1f}x keywords)")
+    assert (fuzzy_mask | ~exact_mask).all(), "fuzzy mode missed an exact match"
+
+    for case_pattern, expected in FUZZY_CASES.items():
+        case = BrandClassifier(case_pattern, 'fuzzy')
+        got = dict(zip(expected, case.classify(list(expected)).tolist()))
+        assert got == expected, f"fuzzy {case_pattern!r}: expected {expected}, got {got}"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark compare_queries: the legacy dict-based loop against the columnar
+implementation, on two periods with overlapping query sets.
+
+Usage (from backend/):
+    python benchmarks/bench_compare.py --queries 1000000 --overlap 0.7
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aggregation import compare_queries  # noqa: E402
+
+
+def calculate_percentage_change(old_value: float, new_value: float) -> float:
+    if old_value == 0:
+        return 100 if new_value > 0 else 0
+    return ((new_value - old_value) / old_value) * 100
+
+
+def legacy_compare_queries(previous_queries: list, current_queries: list) -> list:
+    """The original implementation from main.py."""
+    query_changes = []
+    previous_dict = {q["query"]: q for q in previous_queries}
+    current_dict = {q["query"]: q for q in current_queries}
+    all_queries = set(previous_dict.keys()) | set(current_dict.keys())
+
+    for query in all_queries:
+        prev = previous_dict.get(query, {"clicks": 0, "impressions": 0, "ctr": 0, "position": 0})
+        curr = current_dict.get(query, {"clicks": 0, "impressions": 0, "ctr": 0, "position": 0})
+        clicks_change = calculate_percentage_change(prev["clicks"], curr["clicks"])
+        position_change = prev["position"] - curr["position"] if prev["position"] and curr["position"] else 0
+        if abs(clicks_change) > 10 or abs(position_change) > 0.5:
+            query_changes.append({
+                "query": query,
+                "clicks_change": clicks_change,
+                "position_change": position_change,
+                "current": curr,
+                "previous": prev
+            })
+
+    query_changes.sort(key=lambda x: abs(x["clicks_change"]), reverse=True)
+    return query_changes[:100]
+
+
+def assert_matches_legacy(changes: list, legacy: list):
+    # Ties in |clicks_change| may be ordered differently; the scores must match
+    assert [abs(c["clicks_change"]) for c in changes] == [abs(c["clicks_change"]) for c in legacy]
+    by_query = {c["query"]: c for c in legacy}
+    for change in changes:
+        if change["query"] in by_query:
+            assert change == by_query[change["query"]], change["query"]
+
+
+def make_period(queries: np.ndarray, rng: np.random.Generator) -> pd.DataFrame:
+    impressions = rng.zipf(1.6, len(queries)).clip(1, 1_000_000) * 10
+    clicks = (impressions * rng.uniform(0, 0.3, len(queries))).astype(np.int64)
+    position = rng.uniform(1, 60, len(queries)).round(1)
+    return pd.DataFrame({
+        'query': pd.Categorical(queries),
+        'clicks': clicks,
+        'impressions': impressions,
+        'ctr': np.where(impressions > 0, clicks / impressions * 100, 0),
+        'position': position,
+        'is_brand': np.zeros(len(queries), dtype=bool)
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=1_000_000, help='queries per period')
+    parser.add_argument('--overlap', type=float, default=0.7, help='share of queries present in both periods')
+    parser.add_argument('--skip-legacy', action='store_true')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    shared = int(args.queries * args.overlap)
+    pool = np.array([f"query {i}" for i in range(2 * args.queries - shared)], dtype=object)
+    previous = make_period(pool[:args.queries], rng)
+    current = make_period(pool[args.queries - shared:], rng)
+    print(f"{args.queries:,} queries per period, {shared:,} shared")
+
+    start = time.perf_counter()
+    changes = compare_queries(previous, current)
+    elapsed = time.perf_counter() - start
+    print(f"columnar  {elapsed:8.3f}s")
+
+    if args.skip_legacy:
+        return
+
+    def records(frame):
+        return frame.drop(columns='is_brand').astype({'query': str}).to_dict('records')
+
+    previous_records, current_records = records(previous), records(current)
+    start = time.perf_counter()
+    legacy = legacy_compare_queries(previous_records, current_records)
+    legacy_elapsed = time.perf_counter() - start
+    print(f"legacy    {legacy_elapsed:8.3f}s")
+    print(f"speedup   {legacy_elapsed / elapsed:8.1f}x")
+
+    assert_matches_legacy(changes, legacy)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark page folding: buffering every API row before building the query
+frame (the previous pipeline) against folding each page into a
+QueryAccumulator as it arrives.
+
+Each pipeline is timed on pages generated beforehand, then run again on
+pages generated one at a time, the way they arrive from the API, to measure
+peak Python heap usage with tracemalloc (which slows allocation down too
+much to time the same run).
+
+Usage (from backend/):
+    python benchmarks/bench_fold.py --queries 1000000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aggregation import QueryAccumulator  # noqa: E402
+from classifier import get_classifier  # noqa: E402
+
+PAGE_ROWS = 25000
+
+
+def pages(queries: int, seed: int):
+    """API-shaped pages of query rows, ordered by traffic like the API, generated page by page."""
+    rng = np.random.default_rng(seed)
+    for start in range(0, queries, PAGE_ROWS):
+        ranks = np.arange(start, min(start + PAGE_ROWS, queries))
+        # Impressions fall off with rank like a Zipf distribution
+        impressions = (10_000_000 / (ranks + 1) ** 0.9).astype(np.int64) + 10
+        clicks = (impressions * rng.uniform(0, 0.3, len(ranks))).astype(np.int64)
+        position = rng.uniform(1, 60, len(ranks))
+        brand = rng.random(len(ranks)) < 0.1
+        yield [
+            {
+                'keys': [f"{'queryscope ' if brand[j] else ''}running shoes {i}"],
+                'clicks': int(clicks[j]),
+                'impressions': int(impressions[j]),
+                'ctr': float(clicks[j] / impressions[j]),
+                'position': float(position[j])
+            }
+            for j, i in enumerate(ranks.tolist())
+        ]
+
+
+def buffered(page_source, classifier) -> pd.DataFrame:
+    """The previous pipeline: extend all_rows, then classify and build the frame."""
+    all_rows = []
+    for page in page_source:
+        all_rows.extend(page)
+    lowered = [row['keys'][0].lower() for row in all_rows]
+    codes, uniques = pd.factorize(pd.Series(lowered, dtype=object))
+    is_brand = classifier.classify(uniques.tolist())[codes]
+    count = len(all_rows)
+    return pd.DataFrame({
+        'query': pd.Categorical(lowered),
+        'clicks': np.fromiter((row['clicks'] for row in all_rows), dtype=np.int64, count=count),
+        'impressions': np.fromiter((row['impressions'] for row in all_rows), dtype=np.int64, count=count),
+        'ctr': np.fromiter((row['ctr'] for row in all_rows), dtype=np.float64, count=count) * 100,
+        'position': np.fromiter((row['position'] for row in all_rows), dtype=np.float64, count=count),
+        'is_brand': is_brand
+    })
+
+
+def folded(page_source, classifier) -> pd.DataFrame:
+    accumulator = QueryAccumulator(classifier)
+    for page in page_source:
+        accumulator.fold(page)
+    return accumulator.to_frame()
+
+
+def measure(name: str, run, queries: int, seed: int, classifier):
+    generated = list(pages(queries, seed))
+    start = time.perf_counter()
+    frame = run(generated, classifier)
+    elapsed = time.perf_counter() - start
+    del generated
+
+    tracemalloc.start()
+    run(pages(queries, seed), classifier)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<10} {elapsed:7.2f}s  peak heap {peak / 2 ** 20:8.0f} MiB")
+    return frame, peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    classifier = get_classifier('queryscope')
+    print(f"{args.queries:,} queries in pages of {PAGE_ROWS:,}")
+    old, old_peak, old_elapsed = measure('buffered', buffered, args.queries, args.seed, classifier)
+    new, new_peak, new_elapsed = measure('folded', folded, args.queries, args.seed, classifier)
+    print(f"peak heap {old_peak / new_peak:.1f}x smaller, {old_elapsed / new_elapsed:.2f}x the speed")
+
+    assert len(old) == len(new)
+    assert old['clicks'].sum() == new['clicks'].sum()
+    assert old['is_brand'].sum() == new['is_brand'].sum()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark response encoding: serialization time and bytes on the wire of a
+/compare response, with the standard-library encoder (Starlette's
+JSONResponse, the previous default) against orjson, uncompressed, gzip and
+brotli (when the brotli package is installed).
+
+The payload is built the way /compare builds it, from two periods of the
+synthetic dataset of fake_gsc.py with date/device/country rollups.
+
+Usage (from backend/):
+    python benchmarks/bench_responses.py --queries 200000 --query-limit 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aggregation import QueryAccumulator, compare_queries  # noqa: E402
+from analysis import summarize_period  # noqa: E402
+from classifier import get_classifier  # noqa: E402
+from compression import brotli, compress  # noqa: E402
+from fake_gsc import MAX_ROW_LIMIT, SyntheticDataset  # noqa: E402
+from metrics import TimedJSONResponse  # noqa: E402
+
+DIMENSIONS = ('date', 'device', 'country')
+
+
+def period(dataset: SyntheticDataset, start: str, end: str, classifier) -> tuple:
+    rows = dataset.view(start, end, ('query', *DIMENSIONS))
+    accumulator = QueryAccumulator(classifier, DIMENSIONS)
+    for offset in range(0, len(rows), MAX_ROW_LIMIT):
+        accumulator.fold(rows[offset:offset + MAX_ROW_LIMIT])
+    total = sum(row['clicks'] for row in rows)
+    return summarize_period(accumulator, total)
+
+
+def compare_payload(queries: int, query_limit: int) -> dict:
+    dataset = SyntheticDataset(queries=queries, days=56)
+    classifier = get_classifier('queryscope|qscope', 'regex')
+    previous, previous_frame = period(dataset, dataset.dates[0], dataset.dates[27], classifier)
+    current, current_frame = period(dataset, dataset.dates[28], dataset.dates[-1], classifier)
+    return {
+        "current_period": dict(current, result_id='0' * 32),
+        "previous_period": dict(previous, result_id='1' * 32),
+        "changes": {"queries": compare_queries(previous_frame, current_frame, limit=query_limit)}
+    }
+
+
+def best_of(runs: int, function, *args):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=200_000)
+    parser.add_argument('--query-limit', type=int, default=10_000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    payload = compare_payload(args.queries, args.query_limit)
+    for name, response_class in (('json', JSONResponse), ('orjson', TimedJSONResponse)):
+        seconds, body = best_of(args.runs, response_class(None).render, payload)
+        print(f"{name:<8} serialize {seconds * 1000:8.1f} ms  {len(body):>12,} bytes")
+
+    encodings = [('gzip', {'gzip'})] + ([('br', {'br'})] if brotli is not None else [])
+    for name, accepted in encodings:
+        seconds, (_, compressed) = best_of(args.runs, compress, body, accepted)
+        print(f"{name:<8} compress  {seconds * 1000:8.1f} ms  {len(compressed):>12,} bytes  "
+              f"({len(body) / len(compressed):.1f}x smaller)")
+    if brotli is None:
+        print("brotli   not installed (pip install brotli)")
+
+
+if __name__ == '__main__':
+    main()
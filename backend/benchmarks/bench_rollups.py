@@ -0,0 +1,65 @@
+"""
+Benchmark multi-dimension rollups: folding rows fetched with extra
+dimensions into a QueryAccumulator and computing every rollup from them,
+against the plain query-only fetch.
+
+Rows come from the synthetic dataset of fake_gsc.py, paged like the API.
+The number of API pages is what each extra view would otherwise cost in
+separate crawls.
+
+Usage (from backend/):
+    python benchmarks/bench_rollups.py --queries 200000 --dimensions date,device,country
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aggregation import QueryAccumulator  # noqa: E402
+from classifier import get_classifier  # noqa: E402
+from fake_gsc import MAX_ROW_LIMIT, SyntheticDataset  # noqa: E402
+
+
+def fold(dataset: SyntheticDataset, dimensions: tuple, classifier) -> tuple:
+    rows = dataset.view(dataset.dates[0], dataset.dates[-1], ('query', *dimensions))
+    accumulator = QueryAccumulator(classifier, dimensions)
+    start = time.perf_counter()
+    for offset in range(0, len(rows), MAX_ROW_LIMIT):
+        accumulator.fold(rows[offset:offset + MAX_ROW_LIMIT])
+    folded = time.perf_counter() - start
+    pages = -(-len(rows) // MAX_ROW_LIMIT)
+    return accumulator, len(rows), pages, folded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=200_000)
+    parser.add_argument('--days', type=int, default=28)
+    parser.add_argument('--dimensions', default='date,device,country')
+    args = parser.parse_args()
+
+    dimensions = tuple(d.strip() for d in args.dimensions.split(',') if d.strip())
+    dataset = SyntheticDataset(queries=args.queries, days=args.days)
+    classifier = get_classifier('queryscope|qscope', 'regex')
+
+    _, rows, pages, folded = fold(dataset, (), classifier)
+    print(f"{'query':<32} {rows:>10,} rows  {pages:4} pages  fold {folded:6.2f}s")
+
+    accumulator, rows, pages, folded = fold(dataset, dimensions, classifier)
+    label = ','.join(('query', *dimensions))
+    print(f"{label:<32} {rows:>10,} rows  {pages:4} pages  fold {folded:6.2f}s")
+
+    start = time.perf_counter()
+    rollups = accumulator.rollups()
+    print(f"{'rollups':<32} {time.perf_counter() - start:6.3f}s  "
+          + ', '.join(f"{name}: {len(entries)}" for name, entries in rollups.items()))
+
+    start = time.perf_counter()
+    accumulator.to_frame()
+    print(f"{'query frame':<32} {time.perf_counter() - start:6.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Cold-start benchmark of the backend.
+
+Reports, over several fresh processes:
+  - import time of main.py, and the slowest top-level imports
+  - time from process start to the first successful response (GET /stats),
+    which includes the lifespan warm-up
+  - time from process start to the first successful /analyze, served by the
+    local fake Search Console server (fake_gsc.py)
+
+Usage (from backend/):
+    python benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from bench_api import BACKEND_DIR, analyze_form, days_ago, service_account_key, wait_until_up
+
+
+def import_time() -> float:
+    output = subprocess.run(
+        [sys.executable, '-c', 'import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)'],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def slowest_imports(count: int = 8) -> list:
+    """Top-level modules imported by main, by cumulative import time."""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = len(name) - len(name.lstrip())
+        if depth == 1:
+            # A top-level import finished; children are printed before their parent
+            if name.strip() == 'main':
+                break
+            imports = []
+        elif depth == 3:
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def time_to_first_responses(app_port: int, fake_url: str, key: bytes) -> tuple:
+    app_url = f"http://127.0.0.1:{app_port}"
+    env = dict(os.environ, GSC_API_ENDPOINT=fake_url, ROW_STORE_PATH='')
+    start = time.perf_counter()
+    app = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(app_port), '--log-level', 'warning'],
+        cwd=BACKEND_DIR, env=env, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            try:
+                if httpx.get(f"{app_url}/stats", timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if app.poll() is not None:
+                sys.exit(f"backend exited with code {app.returncode}")
+            time.sleep(0.01)
+        ready = time.perf_counter() - start
+
+        response = httpx.post(
+            f"{app_url}/analyze",
+            files={'file': ('key.json', key)},
+            data=analyze_form(days_ago(35), days_ago(8)),
+            timeout=600
+        )
+        response.raise_for_status()
+        return ready, time.perf_counter() - start
+    finally:
+        app.terminate()
+        app.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=20_000, help='size of the fake property')
+    parser.add_argument('--fake-port', type=int, default=8765)
+    parser.add_argument('--app-port', type=int, default=8766)
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.runs)]
+    print(f"import main             median {statistics.median(imports):6.3f}s  min {min(imports):6.3f}s")
+    for seconds, name in slowest_imports():
+        print(f"  {name:<28} {seconds:6.3f}s")
+
+    fake_url = f"http://127.0.0.1:{args.fake_port}/"
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(BACKEND_DIR, 'benchmarks', 'fake_gsc.py'),
+        '--queries', str(args.queries), '--port', str(args.fake_port)
+    ])
+    try:
+        wait_until_up(fake_url, fake)
+        key = service_account_key(f"{fake_url}token")
+        results = [time_to_first_responses(args.app_port, fake_url, key) for _ in range(args.runs)]
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    ready, analyzed = zip(*results)
+    print(f"first response          median {statistics.median(ready):6.3f}s  min {min(ready):6.3f}s")
+    print(f"first /analyze          median {statistics.median(analyzed):6.3f}s  min {min(analyzed):6.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""
+Local stand-in for the Search Console API, serving a synthetic dataset.
+
+Implements the OAuth token exchange, sites.list and searchanalytics.query
+(any combination of the query, date, page, device and country dimensions) with the real API's
+pagination (rowLimit up to 25,000, startRow), plus injected latency and
+429 quota errors. Access tokens expire after --token-ttl seconds and are
+then refused with 401, like Google's. Point the backend at it with GSC_API_ENDPOINT and a key
+whose token_uri is this server's /token (see bench_api.py).
+
+Usage (from backend/):
+    python benchmarks/fake_gsc.py --queries 1000000 --days 90 --latency 0.2 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+MAX_ROW_LIMIT = 25000
+DEVICES = ['DESKTOP', 'MOBILE', 'TABLET']
+COUNTRIES = ['usa', 'gbr', 'fra', 'deu', 'esp', 'ita', 'can', 'aus', 'bra', 'ind', 'jpn', 'nld']
+WORDS = [
+    'buy', 'cheap', 'best', 'review', 'price', 'near', 'me', 'online', 'how', 'to', 'vs', 'free', 'sale',
+    'shoes', 'running', 'trail', 'women', 'men', 'kids', 'size', 'guide', 'store', 'delivery', 'return',
+    'black', 'white', 'red', 'blue', 'waterproof', 'leather', 'boots', 'sandals', 'socks', 'jacket', '2026',
+    # Real queries carry quotes and commas, which exports must quote
+    '"exact"', '9,99'
+]
+
+
+class SyntheticDataset:
+    """
+    Per-day, per-query rows for `queries` queries over `days` days.
+
+    Impressions follow a Zipf distribution over query rank; popular queries
+    are spread over more days. A `brand_share` fraction of queries contains
+    one of `brand_terms`, and those get better positions and CTRs. Each query
+    lands on one of `pages` pages; each row gets a device and a country.
+    """
+
+    def __init__(
+        self,
+        queries: int = 100_000,
+        days: int = 90,
+        brand_terms: tuple = ('queryscope', 'qscope'),
+        brand_share: float = 0.1,
+        zipf_exponent: float = 1.1,
+        end_date: date = None,
+        pages: int = 500,
+        seed: int = 42
+    ):
+        rng = np.random.default_rng(seed)
+        self.end_date = end_date or date.today() - timedelta(days=1)
+        self.dates = [(self.end_date - timedelta(days=days - 1 - i)).isoformat() for i in range(days)]
+
+        # Query strings: a few vocabulary words, a brand term for brand queries, and
+        # a base-36 suffix so every query is unique
+        is_brand = rng.random(queries) < brand_share
+        word_counts = rng.integers(1, 4, queries)
+        word_ids = rng.integers(0, len(WORDS), (queries, 3))
+        brand_ids = rng.integers(0, len(brand_terms), queries)
+        self.queries = np.empty(queries, dtype=object)
+        for i in range(queries):
+            words = [WORDS[w] for w in word_ids[i, :word_counts[i]]]
+            if is_brand[i]:
+                words.insert(int(word_ids[i, 0]) % (len(words) + 1), brand_terms[brand_ids[i]])
+            words.append(np.base_repr(i, 36).lower())
+            self.queries[i] = ' '.join(words)
+
+        # Zipfian impressions by rank, with brand queries ranking better and converting more
+        rank = rng.permutation(queries) + 1
+        impressions = np.maximum(1, (2_000_000 / rank ** zipf_exponent)).astype(np.int64)
+        position = np.where(is_brand, rng.uniform(1, 3, queries), rng.uniform(2, 60, queries))
+        ctr = np.where(is_brand, 0.35, 0.25) / np.sqrt(position)
+        clicks = rng.binomial(impressions, np.clip(ctr, 0, 1))
+
+        # Spread each query over consecutive days; clicks never exceed impressions per day
+        active_days = np.clip(impressions // 50 + 1, 1, days)
+        query_index = np.repeat(np.arange(queries), active_days)
+        group_start = np.repeat(np.cumsum(active_days) - active_days, active_days)
+        offset = np.arange(len(query_index)) - group_start
+        first_day = rng.integers(0, days, queries)
+        self.day = ((first_day[query_index] + offset) % days).astype(np.int32)
+        self.query_index = query_index
+
+        k = active_days[query_index]
+        self.impressions = impressions[query_index] // k + (offset < impressions[query_index] % k)
+        self.clicks = clicks[query_index] // k + (offset < clicks[query_index] % k)
+        self.position = np.clip(position[query_index] + rng.normal(0, 0.5, len(query_index)), 1, None)
+
+        keep = self.impressions > 0
+        self.day, self.query_index = self.day[keep], self.query_index[keep]
+        self.impressions, self.clicks, self.position = self.impressions[keep], self.clicks[keep], self.position[keep]
+
+        # Drawn from a separate generator so the query/date data does not depend on them
+        extra = np.random.default_rng(seed + 1)
+        self.pages = np.array([f"https://www.example.com/p/{i}" for i in range(pages)], dtype=object)
+        page_of_query = extra.integers(0, pages, queries)
+        self.codes = {
+            'query': self.query_index,
+            'date': self.day,
+            'page': page_of_query[self.query_index],
+            'device': extra.choice(len(DEVICES), len(self.day), p=[0.4, 0.55, 0.05]),
+            'country': extra.integers(0, len(COUNTRIES), len(self.day))
+        }
+        self.labels = {
+            'query': self.queries,
+            'date': self.dates,
+            'page': self.pages,
+            'device': DEVICES,
+            'country': COUNTRIES
+        }
+        self._views = OrderedDict()
+
+    def __len__(self):
+        return len(self.query_index)
+
+    def _day_range(self, start_date: str, end_date: str) -> tuple:
+        start = sum(1 for d in self.dates if d < start_date)
+        end = sum(1 for d in self.dates if d <= end_date) - 1
+        return start, end
+
+    def view(self, start_date: str, end_date: str, dimensions: tuple) -> list:
+        """Rows for a date range and dimension set, ordered by clicks like the API. Cached."""
+        key = (start_date, end_date, dimensions)
+        rows = self._views.get(key)
+        if rows is not None:
+            self._views.move_to_end(key)
+            return rows
+
+        unknown = [d for d in dimensions if d not in self.codes]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unsupported dimensions: {unknown}")
+
+        start, end = self._day_range(start_date, end_date)
+        mask = (self.day >= start) & (self.day <= end)
+        clicks, impressions, position = self.clicks[mask], self.impressions[mask], self.position[mask]
+
+        # Group by the combined dimension codes (mixed radix), then sum like the API
+        combined = np.zeros(len(clicks), dtype=np.int64)
+        for name in dimensions:
+            combined = combined * len(self.labels[name]) + self.codes[name][mask]
+        groups_key, groups = np.unique(combined, return_inverse=True)
+        weighted = np.bincount(groups, position * impressions, len(groups_key))
+        clicks = np.bincount(groups, clicks, len(groups_key)).astype(np.int64)
+        impressions = np.bincount(groups, impressions, len(groups_key)).astype(np.int64)
+        position = weighted / np.maximum(impressions, 1)
+
+        key_codes = []
+        for name in reversed(dimensions):
+            key_codes.append(groups_key % len(self.labels[name]))
+            groups_key = groups_key // len(self.labels[name])
+        key_codes.reverse()
+        keys = [
+            tuple(self.labels[name][codes[i]] for name, codes in zip(dimensions, key_codes))
+            for i in range(len(clicks))
+        ]
+
+        order = np.lexsort((-impressions, -clicks))
+        rows = [
+            {
+                **({'keys': list(keys[i])} if dimensions else {}),
+                'clicks': int(clicks[i]),
+                'impressions': int(impressions[i]),
+                'ctr': float(clicks[i] / impressions[i]),
+                'position': float(position[i])
+            }
+            for i in order
+        ]
+        self._views[key] = rows
+        while len(self._views) > 16:
+            self._views.popitem(last=False)
+        return rows
+
+
+def create_app(
+    dataset: SyntheticDataset, sites: list, latency: float = 0.0, error_rate: float = 0.0, token_ttl: int = 3600
+) -> FastAPI:
+    app = FastAPI()
+    stats = {"queries": 0, "rows_served": 0, "quota_errors": 0, "tokens_issued": 0, "expired_tokens": 0}
+    # Access token -> expiry (monotonic seconds)
+    tokens = {}
+    token_ids = itertools.count()
+
+    def authorize(request: Request):
+        scheme, _, token = request.headers.get('authorization', '').partition(' ')
+        expiry = tokens.get(token)
+        if scheme != 'Bearer' or expiry is None:
+            raise HTTPException(status_code=401, detail="Request had invalid authentication credentials.")
+        if time.monotonic() >= expiry:
+            stats["expired_tokens"] += 1
+            raise HTTPException(status_code=401, detail="Request had invalid authentication credentials.")
+
+    async def simulate():
+        if latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * latency)
+        if error_rate and random.random() < error_rate:
+            stats["quota_errors"] += 1
+            raise HTTPException(status_code=429, detail="Quota exceeded")
+
+    @app.exception_handler(HTTPException)
+    async def google_error(request: Request, exc: HTTPException):
+        # Same error envelope as Google APIs, so HttpError messages look real
+        return JSONResponse(
+            status_code=exc.status_code,
+            content={"error": {"code": exc.status_code, "message": exc.detail}}
+        )
+
+    @app.get("/")
+    async def info():
+        return {"sites": sites, "dates": [dataset.dates[0], dataset.dates[-1]], "rows": len(dataset), **stats}
+
+    @app.post("/token")
+    async def token():
+        access_token = f"fake-token-{next(token_ids)}"
+        tokens[access_token] = time.monotonic() + token_ttl
+        stats["tokens_issued"] += 1
+        return {"access_token": access_token, "expires_in": token_ttl, "token_type": "Bearer"}
+
+    @app.get("/webmasters/v3/sites")
+    async def list_sites(request: Request):
+        authorize(request)
+        await simulate()
+        return {"siteEntry": [{"siteUrl": site, "permissionLevel": "siteOwner"} for site in sites]}
+
+    @app.post("/webmasters/v3/sites/{site_url:path}/searchAnalytics/query")
+    async def query(site_url: str, request: Request):
+        authorize(request)
+        if site_url not in sites:
+            raise HTTPException(status_code=403, detail=f"User does not have sufficient permission for site '{site_url}'.")
+        body = await request.json()
+        await simulate()
+        stats["queries"] += 1
+
+        dimensions = tuple(body.get('dimensions') or ())
+        row_limit = min(int(body.get('rowLimit', 1000)), MAX_ROW_LIMIT)
+        start_row = int(body.get('startRow', 0))
+        rows = await asyncio.to_thread(dataset.view, body['startDate'], body['endDate'], dimensions)
+        page = rows[start_row:start_row + row_limit]
+        stats["rows_served"] += len(page)
+        return {"rows": page, "responseAggregationType": "byProperty"} if page else {"responseAggregationType": "byProperty"}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--brand-share', type=float, default=0.1)
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of impressions by query rank')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to each API call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls answered with 429')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='seconds before an access token expires')
+    parser.add_argument('--sites', default='sc-domain:example.com', help='comma-separated site URLs')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    dataset = SyntheticDataset(args.queries, args.days, brand_share=args.brand_share, zipf_exponent=args.zipf, seed=args.seed)
+    print(f"{args.queries:,} queries, {len(dataset):,} daily rows over {dataset.dates[0]}..{dataset.dates[-1]}")
+    app = create_app(dataset, args.sites.split(','), args.latency, args.error_rate, args.token_ttl)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+pytest-benchmark suite for /analyze, /compare and the CSV export against the
+local fake Search Console server, with the same setup as bench_api.py.
+
+Each scenario records peak RSS of the backend and rows/sec in the benchmark's
+extra info and fails when it goes over its budget, so regressions show up as
+test failures rather than numbers to eyeball. The concurrency load check fails
+when concurrent requests wait on the API one after another.
+
+Usage (from backend/, with requirements-dev.txt installed):
+    python -m pytest benchmarks -q
+
+Dataset size, injected latency and budgets are set with the BENCH_*
+environment variables below.
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_api import ANALYZE, COMPARE, serial_share, servers  # noqa: E402
+
+BENCH_QUERIES = int(os.getenv("BENCH_QUERIES", "50000"))
+BENCH_DAYS = int(os.getenv("BENCH_DAYS", "90"))
+BENCH_LATENCY = float(os.getenv("BENCH_LATENCY", "0.1"))
+BENCH_ROUNDS = int(os.getenv("BENCH_ROUNDS", "3"))
+BENCH_CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "8"))
+BENCH_FAKE_PORT = int(os.getenv("BENCH_FAKE_PORT", "8765"))
+BENCH_APP_PORT = int(os.getenv("BENCH_APP_PORT", "8766"))
+
+# Budgets: median seconds per request, backend peak RSS in MiB, and the share of
+# N x one request's wait that N concurrent requests may spend waiting
+BENCH_ANALYZE_BUDGET = float(os.getenv("BENCH_ANALYZE_BUDGET", "2"))
+BENCH_COMPARE_BUDGET = float(os.getenv("BENCH_COMPARE_BUDGET", "3"))
+BENCH_CSV_BUDGET = float(os.getenv("BENCH_CSV_BUDGET", "1"))
+BENCH_RSS_BUDGET = float(os.getenv("BENCH_RSS_BUDGET", "1024"))
+BENCH_MAX_SERIAL_SHARE = float(os.getenv("BENCH_MAX_SERIAL_SHARE", "0.5"))
+
+
+@pytest.fixture(scope="module")
+def bench():
+    with servers(BENCH_QUERIES, BENCH_DAYS, BENCH_LATENCY, 0.0, BENCH_FAKE_PORT, BENCH_APP_PORT) as bench:
+        # The first request of the process pays for imports and connection set-up
+        asyncio.run(bench.run('warm-up', [ANALYZE]))
+        yield bench
+
+
+def timed(benchmark, func) -> float:
+    """Run `func` under the benchmark and return its median seconds (also with --benchmark-disable)."""
+    times = []
+
+    def run():
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    benchmark.pedantic(run, rounds=BENCH_ROUNDS)
+    return statistics.median(times)
+
+
+def run_request(benchmark, bench, name: str, request: tuple, budget: float):
+    median = timed(benchmark, lambda: asyncio.run(bench.run(name, [request])))
+    benchmark.extra_info['rows_per_sec'] = round(bench.rows / median)
+    benchmark.extra_info['peak_rss_mib'] = bench.rss
+    assert median <= budget, f"{name} took {median:.2f}s, budget {budget:.2f}s"
+    assert bench.rss is None or bench.rss <= BENCH_RSS_BUDGET, \
+        f"{name} peaked at {bench.rss:.0f} MiB, budget {BENCH_RSS_BUDGET:.0f} MiB"
+
+
+def test_analyze(benchmark, bench):
+    run_request(benchmark, bench, 'analyze', ANALYZE, BENCH_ANALYZE_BUDGET)
+
+
+def test_compare(benchmark, bench):
+    run_request(benchmark, bench, 'compare', COMPARE, BENCH_COMPARE_BUDGET)
+
+
+def test_export_csv(benchmark, bench):
+    path, data = ANALYZE
+    response = httpx.post(f"{bench.app_url}{path}", files={'file': ('key.json', bench.key)}, data=data, timeout=3600)
+    response.raise_for_status()
+    url = f"{bench.app_url}/results/{response.json()['result_id']}/export.csv"
+
+    sizes = []
+
+    def export():
+        with httpx.stream('GET', url, timeout=3600) as csv:
+            csv.raise_for_status()
+            sizes.append(sum(len(chunk) for chunk in csv.iter_bytes()))
+
+    median = timed(benchmark, export)
+    benchmark.extra_info['mib_per_sec'] = round(sizes[-1] / 2 ** 20 / median, 1)
+    assert median <= BENCH_CSV_BUDGET, f"CSV export took {median:.2f}s, budget {BENCH_CSV_BUDGET:.2f}s"
+
+
+def test_concurrent_requests_overlap(bench):
+    share = asyncio.run(serial_share(bench, BENCH_CONCURRENCY))
+    if share is None:
+        pytest.skip("injected latency too small next to CPU time to tell")
+    assert share <= BENCH_MAX_SERIAL_SHARE, \
+        f"concurrent requests waited one after another ({share:.0%} of {BENCH_CONCURRENCY} x one request's wait)"
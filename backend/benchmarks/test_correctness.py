@@ -0,0 +1,128 @@
+"""
+Correctness checks behind the benchmarks: the optimized code paths must give
+the same answers as the code they replaced. Pure functions are checked against
+the legacy implementations kept in the bench_*.py scripts; fetching, export
+and pagination are checked end to end against a small fake Search Console
+dataset.
+
+Usage (from backend/, with requirements-dev.txt installed):
+    python -m pytest benchmarks -q
+"""
+import csv
+import io
+import os
+import random
+import sys
+
+import httpx
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_api import ANALYZE, servers  # noqa: E402
+from bench_classifier import FUZZY_CASES, legacy_is_brand, make_vocabulary  # noqa: E402
+from bench_compare import assert_matches_legacy, legacy_compare_queries, make_period  # noqa: E402
+from aggregation import compare_queries  # noqa: E402
+from classifier import BrandClassifier  # noqa: E402
+
+BENCH_FAKE_PORT = int(os.getenv("BENCH_FAKE_PORT", "8765"))
+BENCH_APP_PORT = int(os.getenv("BENCH_APP_PORT", "8766"))
+# Queries in the fake dataset; small enough that every check takes seconds
+BENCH_CHECK_QUERIES = int(os.getenv("BENCH_CHECK_QUERIES", "5000"))
+
+SUMMARY_TOTALS = ('brand_clicks', 'non_brand_clicks', 'brand_impressions', 'non_brand_impressions', 'total_all_clicks')
+
+
+@pytest.fixture(scope="module")
+def bench():
+    with servers(BENCH_CHECK_QUERIES, 90, 0.0, 0.0, BENCH_FAKE_PORT, BENCH_APP_PORT) as bench:
+        yield bench
+
+
+def analyze(bench, **options) -> dict:
+    path, data = ANALYZE
+    response = httpx.post(
+        f"{bench.app_url}{path}", files={'file': ('key.json', bench.key)}, data=dict(data, **options), timeout=600
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def test_classifier_matches_legacy_loop():
+    rng = random.Random(42)
+    vocabulary = make_vocabulary(2000, rng)
+    pattern = '|'.join(rng.sample(vocabulary, 50))
+    queries = [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 5))) for _ in range(20_000)]
+    mask = BrandClassifier(pattern, 'keywords').classify(queries)
+    assert mask.any()
+    assert list(mask) == [legacy_is_brand(query, pattern) for query in queries]
+
+
+@pytest.mark.parametrize('pattern', FUZZY_CASES)
+def test_fuzzy_cases(pattern):
+    expected = FUZZY_CASES[pattern]
+    got = dict(zip(expected, BrandClassifier(pattern, 'fuzzy').classify(list(expected)).tolist()))
+    assert got == expected
+
+
+def test_compare_matches_legacy():
+    rng = np.random.default_rng(42)
+    pool = np.array([f"query {i}" for i in range(14_000)], dtype=object)
+    previous, current = make_period(pool[:10_000], rng), make_period(pool[4_000:], rng)
+
+    def records(frame):
+        return frame.drop(columns='is_brand').astype({'query': str}).to_dict('records')
+
+    assert_matches_legacy(compare_queries(previous, current), legacy_compare_queries(records(previous), records(current)))
+
+
+@pytest.mark.parametrize('shard', ['day', 'week'])
+def test_sharded_totals_match_single_range(bench, shard):
+    single = analyze(bench, shard='none')
+    sharded = analyze(bench, shard=shard)
+    assert single['brand_clicks'] > 0
+    assert {key: sharded[key] for key in SUMMARY_TOTALS} == {key: single[key] for key in SUMMARY_TOTALS}
+    for key in ('brand_avg_position', 'non_brand_avg_position'):
+        assert sharded[key] == pytest.approx(single[key])
+
+
+def test_cursor_pagination_covers_every_query_once(bench):
+    result_id = analyze(bench)['result_id']
+    items, cursor, total = [], None, None
+    while True:
+        params = {'limit': 700, **({'cursor': cursor} if cursor else {})}
+        page = httpx.get(f"{bench.app_url}/results/{result_id}/queries", params=params, timeout=60).json()
+        items += page['items']
+        total = page['total']
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    queries = [item['query'] for item in items]
+    assert len(queries) == total == len(set(queries))
+    clicks = [item['clicks'] for item in items]
+    assert clicks == sorted(clicks, reverse=True)
+
+    brand = httpx.get(
+        f"{bench.app_url}/results/{result_id}/queries", params={'segment': 'brand', 'q': 'QSCOPE', 'limit': 1000},
+        timeout=60
+    ).json()
+    assert brand['items'] and all(item['segment'] == 'brand' and 'qscope' in item['query'] for item in brand['items'])
+
+
+def test_csv_export_round_trips_queries(bench):
+    result_id = analyze(bench)['result_id']
+    export = httpx.get(f"{bench.app_url}/results/{result_id}/export.csv", params={'summary': 'false'}, timeout=60)
+    export.raise_for_status()
+    assert export.content.startswith('\ufeff'.encode())
+
+    header, *rows = csv.reader(io.StringIO(export.content.decode('utf-8-sig')))
+    assert header[:2] == ['Type', 'Query']
+    assert all(len(row) == len(header) for row in rows)
+
+    page = httpx.get(f"{bench.app_url}/results/{result_id}/queries", params={'limit': 1000}, timeout=60).json()
+    assert len(rows) == page['total']
+    queries = {row[1] for row in rows}
+    assert any(',' in query for query in queries) and any('"' in query for query in queries)
+    assert {item['query'] for item in page['items']} <= queries
@@ -0,0 +1,329 @@
+"""
+Brand / non-brand query classification.
+
+A classifier is compiled once per (pattern, mode) and reused across requests.
+It classifies a whole column of queries at a time instead of re-parsing the
+pattern for every row.
+
+Fuzzy mode also accepts misspelled and concatenated brand terms. Tokens are
+looked up in a trigram index over the brand terms, so only the few terms
+sharing enough trigrams are compared by edit distance, and every token and
+query is classified once: tokens per classifier, queries per site.
+"""
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Sequence
+
+import numpy as np
+
+from cache import TTLCache
+
+# 'keywords': the pattern is a |-separated list of brand terms matched as whole words
+# 'regex': the pattern is a regular expression searched in each query
+# 'fuzzy': like 'keywords', also matching terms with typos or glued to other words
+MATCH_MODES = ['keywords', 'regex', 'fuzzy']
+
+# Edit distance (insertions, deletions, substitutions, transpositions) tolerated
+# by fuzzy mode; terms get one edit per FUZZY_TERM_LENGTH characters, up to this
+FUZZY_MAX_EDITS = int(os.getenv("FUZZY_MAX_EDITS", "1"))
+# Shorter terms are only matched exactly in fuzzy mode ("nike" must not match "bike")
+FUZZY_TERM_LENGTH = 5
+# A term glued to another word must start or end the token, and the rest of the token
+# must be a brand term, a known modifier or at least this long ("pineapple" is not "apple")
+FUZZY_GLUED_REST_LENGTH = int(os.getenv("FUZZY_GLUED_REST_LENGTH", "5"))
+FUZZY_GLUED_MODIFIERS = frozenset(
+    os.getenv("FUZZY_GLUED_MODIFIERS", "seo,app,api,com,www,web,pro,io,fr,net,org,tool,shop,login").split(',')
+)
+# Entries of all fuzzy memos of a worker together: tokens remembered by the
+# classifiers and queries remembered per site
+FUZZY_MEMO_SIZE = int(os.getenv("FUZZY_MEMO_SIZE", "1000000"))
+FUZZY_MEMO_TTL = int(os.getenv("FUZZY_MEMO_TTL", str(24 * 3600)))
+
+
+def _trigrams(word: str) -> set:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Optimal string alignment distance, or limit + 1 once it is known to exceed `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class _MemoBudget:
+    """
+    One entry budget shared by every fuzzy memo of the process. Memos report
+    each use; the least recently used ones are shrunk, then dropped, until
+    all of them fit.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._memos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def used(self, memo):
+        with self._lock:
+            self._memos.pop(id(memo), None)
+            self._memos[id(memo)] = weakref.ref(memo)
+            remaining = self.size
+            for key in reversed(list(self._memos)):
+                entry = self._memos[key]()
+                if entry is not None and entry.memo_size() > remaining:
+                    entry.shrink_memo(remaining)
+                if entry is None or remaining == 0:
+                    del self._memos[key]
+                    continue
+                remaining = max(0, remaining - entry.memo_size())
+
+    def stats(self) -> dict:
+        with self._lock:
+            memos = [ref() for ref in self._memos.values()]
+        return {"memos": len(memos), "entries": sum(m.memo_size() for m in memos if m is not None), "size": self.size}
+
+
+memo_budget = _MemoBudget(FUZZY_MEMO_SIZE)
+
+
+class FuzzyTermIndex:
+    """
+    Single-word brand terms, matched against tokens exactly, glued to the start
+    or end of another word ("queryscopeseo") or within their edit budget ("queryscpe").
+    """
+
+    def __init__(self, terms, max_edits: int = FUZZY_MAX_EDITS):
+        self.terms = frozenset(terms)
+        self._terms = []
+        self._edits = []
+        self._min_shared = []
+        self._grams = {}
+        for term in sorted(self.terms):
+            edits = min(max_edits, len(term) // FUZZY_TERM_LENGTH)
+            if edits == 0:
+                continue
+            grams = _trigrams(term)
+            for gram in grams:
+                self._grams.setdefault(gram, []).append(len(self._terms))
+            self._terms.append(term)
+            self._edits.append(edits)
+            # An edit changes at most 4 trigrams (a transposition), so a term within
+            # `edits` of a token shares at least this many trigrams with it
+            self._min_shared.append(max(1, len(grams) - 4 * edits))
+
+        self._glued = tuple(sorted((term for term in self.terms if len(term) >= FUZZY_TERM_LENGTH), key=len, reverse=True))
+        # Lengths a token can have and still be within the edit budget of a term
+        self._min_length = min((len(term) for term in self.terms), default=0) - max_edits
+        self._max_length = max((len(term) for term in self.terms), default=0) + max_edits
+        # Proper prefixes of the terms: a query can only hold a split term if a token is one
+        self.heads = frozenset(term[:i] for term in self.terms for i in range(1, len(term)))
+        # Tokens already looked up, and those of them that matched. A token is added to
+        # `seen` after `matched`, so other threads never see it half-classified
+        self.seen = set()
+        self.matched = set()
+
+    def matching(self, tokens) -> set:
+        """The tokens that match a term; only tokens not seen before are looked up."""
+        found = self.matched.intersection(tokens)
+        for token in set(tokens) - self.seen:
+            match = self._match(token)
+            if match:
+                found.add(token)
+            # Once the memo is full, new tokens are looked up every time
+            if len(self.seen) < memo_budget.size:
+                if match:
+                    self.matched.add(token)
+                self.seen.add(token)
+        return found
+
+    def memo_size(self) -> int:
+        return len(self.seen)
+
+    def shrink_memo(self, size: int):
+        for token in list(self.seen)[size:]:
+            self.seen.discard(token)
+            self.matched.discard(token)
+
+    def _is_glued(self, word: str) -> bool:
+        for term in self._glued:
+            if word.startswith(term):
+                rest = word[len(term):]
+            elif word.endswith(term):
+                rest = word[:-len(term)]
+            else:
+                continue
+            if len(rest) >= FUZZY_GLUED_REST_LENGTH or rest in FUZZY_GLUED_MODIFIERS or rest in self.terms:
+                return True
+        return False
+
+    def _match(self, word: str) -> bool:
+        if word in self.terms:
+            return True
+        if (word.startswith(self._glued) or word.endswith(self._glued)) and self._is_glued(word):
+            return True
+        if not self._min_length <= len(word) <= self._max_length:
+            return False
+
+        shared = {}
+        for gram in _trigrams(word):
+            for i in self._grams.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        return any(
+            count >= self._min_shared[i]
+            and _edit_distance(word, self._terms[i], self._edits[i]) <= self._edits[i]
+            for i, count in shared.items()
+        )
+
+
+class BrandClassifier:
+    """Compiled brand matcher for one pattern."""
+
+    def __init__(self, pattern: str, mode: str = 'keywords'):
+        self.pattern = pattern
+        self.mode = mode
+        self.terms = frozenset()
+        self.regex = None
+        self.fuzzy = None
+        self.phrase_heads = frozenset()
+
+        if mode == 'regex':
+            self.regex = re.compile(pattern, re.IGNORECASE) if pattern else None
+            return
+
+        keywords = [kw.strip() for kw in pattern.lower().split('|') if kw.strip()]
+        # Single-word terms are matched with a token hash-set; multi-word terms
+        # need one alternation anchored on whitespace boundaries
+        self.terms = frozenset(kw for kw in keywords if len(kw.split()) == 1)
+        phrases = [' '.join(kw.split()) for kw in keywords if len(kw.split()) > 1]
+        if phrases:
+            alternation = '|'.join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+            self.regex = re.compile(rf'(?:^|\s)(?:{alternation})(?=\s|$)')
+        if mode == 'fuzzy':
+            self.phrase_heads = frozenset(phrase.split()[0] for phrase in phrases)
+            # Phrases are also matched written as one word ("brandname")
+            self.fuzzy = FuzzyTermIndex(self.terms | {''.join(phrase.split()) for phrase in phrases})
+
+    def is_brand(self, query: str) -> bool:
+        if self.mode == 'regex':
+            return self.regex is not None and self.regex.search(query) is not None
+        if self.fuzzy is not None:
+            tokens = query.split()
+            return self._is_fuzzy_brand(tokens, self.fuzzy.matching(tokens))
+        if not self.terms.isdisjoint(query.split()):
+            return True
+        return self.regex is not None and self.regex.search(' '.join(query.split())) is not None
+
+    def _is_fuzzy_brand(self, tokens: list, matched: set) -> bool:
+        if not matched.isdisjoint(tokens):
+            return True
+        # Two tokens that are one term split in two ("query scope")
+        fuzzy = self.fuzzy
+        if len(tokens) > 1 and not fuzzy.heads.isdisjoint(tokens):
+            terms = fuzzy.terms
+            if any(first + second in terms for first, second in zip(tokens, tokens[1:])):
+                return True
+        return self.regex is not None and self.regex.search(' '.join(tokens)) is not None
+
+    def _classify_fuzzy(self, queries: Sequence[str]):
+        # Tokens are looked up the first time they are seen. Only queries holding a
+        # matched token, the start of a split term or the first word of a phrase
+        # need a closer look; the rest cost two set operations
+        fuzzy = self.fuzzy
+        matched = set(fuzzy.matched)
+        candidates = matched | fuzzy.heads | self.phrase_heads
+        all_seen, isdisjoint = fuzzy.seen.issuperset, candidates.isdisjoint
+        is_brand = self._is_fuzzy_brand
+        for query in queries:
+            tokens = query.split()
+            if not all_seen(tokens):
+                found = fuzzy.matching(tokens)
+                matched |= found
+                candidates |= found
+            yield not isdisjoint(tokens) and is_brand(tokens, matched)
+
+    def classify(self, queries: Sequence[str]) -> np.ndarray:
+        """Return a boolean mask, True where the query is a brand query."""
+        if self.mode == 'regex':
+            if self.regex is None:
+                return np.zeros(len(queries), dtype=bool)
+            search = self.regex.search
+            return np.fromiter((search(q) is not None for q in queries), dtype=bool, count=len(queries))
+
+        if self.fuzzy is not None:
+            mask = np.fromiter(self._classify_fuzzy(queries), dtype=bool, count=len(queries))
+            memo_budget.used(self.fuzzy)
+            return mask
+        if self.regex is None:
+            # Pure token mode: one set intersection per query
+            isdisjoint = self.terms.isdisjoint
+            return np.fromiter((not isdisjoint(q.split()) for q in queries), dtype=bool, count=len(queries))
+        return np.fromiter((self.is_brand(q) for q in queries), dtype=bool, count=len(queries))
+
+
+@lru_cache(maxsize=256)
+def get_classifier(pattern: str, mode: str = 'keywords') -> BrandClassifier:
+    """Compiled classifiers are cached by pattern string and mode."""
+    return BrandClassifier(pattern, mode)
+
+
+class SiteClassifier:
+    """Memo of one site's query classifications in front of a shared classifier."""
+
+    def __init__(self, classifier: BrandClassifier):
+        self.classifier = classifier
+        self._memo = {}
+
+    def memo_size(self) -> int:
+        return len(self._memo)
+
+    def shrink_memo(self, size: int):
+        """Forget the oldest queries first."""
+        memo = self._memo
+        for query in list(memo)[:max(0, len(memo) - size)]:
+            memo.pop(query, None)
+
+    def classify(self, queries: Sequence[str]) -> np.ndarray:
+        memo = self._memo
+        known = [memo.get(q) for q in queries]
+        missing = [i for i, value in enumerate(known) if value is None]
+        if missing:
+            computed = self.classifier.classify([queries[i] for i in missing]).tolist()
+            for i, value in zip(missing, computed):
+                known[i] = memo[queries[i]] = value
+        memo_budget.used(self)
+        return np.array(known, dtype=bool)
+
+
+_site_classifiers = TTLCache(256, FUZZY_MEMO_TTL)
+
+
+def site_classifier(classifier: BrandClassifier, site_url: str):
+    """
+    The classifier to use for one site's queries. Fuzzy classifications are
+    memoized per site across requests; the other modes are cheaper than a lookup.
+    """
+    if classifier.fuzzy is None:
+        return classifier
+    key = (site_url, classifier.pattern, classifier.mode)
+    memoized = _site_classifiers.get(key)
+    if memoized is None:
+        memoized = SiteClassifier(classifier)
+        _site_classifiers.set(key, memoized)
+    return memoized
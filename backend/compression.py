@@ -0,0 +1,101 @@
+"""
+Response compression.
+
+JSON bodies above a size threshold are compressed with brotli when the
+client accepts it, otherwise with gzip. Streamed responses (SSE, NDJSON, CSV exports) are passed through
+untouched so their chunks still reach the client as they are produced.
+"""
+import gzip
+import os
+
+import brotli
+
+from metrics import span
+
+# Bodies smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+# Streamed media types; their headers are sent as soon as the response starts
+STREAMED_TYPES = (b'text/event-stream', b'application/x-ndjson', b'text/csv')
+
+
+def _accepted_encodings(scope) -> set:
+    for name, value in scope['headers']:
+        if name == b'accept-encoding':
+            return {part.split(';')[0].strip() for part in value.decode('latin-1').lower().split(',')}
+    return set()
+
+
+def compress(body: bytes, accepted: set) -> tuple:
+    """(encoding, compressed body) for the best accepted encoding, or (None, body)."""
+    if 'br' in accepted:
+        with span('compression'):
+            return 'br', brotli.compress(body, quality=BROTLI_QUALITY)
+    if 'gzip' in accepted:
+        with span('compression'):
+            return 'gzip', gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return None, body
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing single-message response bodies."""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        accepted = _accepted_encodings(scope)
+        if not accepted:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message['type'] == 'http.response.start':
+                content_type = next((v for k, v in message['headers'] if k == b'content-type'), b'')
+                if content_type.startswith(STREAMED_TYPES):
+                    passthrough = True
+                    await send(message)
+                else:
+                    # Held back until the body is known
+                    start_message = message
+                return
+
+            body = message.get('body', b'')
+            headers = start_message['headers']
+            encoded = any(k == b'content-encoding' for k, _ in headers)
+            if message.get('more_body', False) or encoded or len(body) < self.minimum_size:
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            encoding, body = compress(body, accepted)
+            if encoding is None:
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            vary = next((v for k, v in headers if k == b'vary'), None)
+            headers = [(k, v) for k, v in headers if k not in (b'content-length', b'vary')] + [
+                (b'content-encoding', encoding.encode()),
+                (b'content-length', str(len(body)).encode()),
+                (b'vary', vary + b', Accept-Encoding' if vary else b'Accept-Encoding')
+            ]
+            await send(dict(start_message, headers=headers))
+            await send({'type': 'http.response.body', 'body': body})
+
+        await self.app(scope, receive, send_compressed)
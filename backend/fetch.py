@@ -0,0 +1,236 @@
+"""
+Fetch planning for searchanalytics.query.
+
+Large properties need many 25k-row pages per period. The planner splits the
+date range into day or week shards and fetches shards and pages concurrently,
+bounded by a per-analysis semaphore, then merges the rows back per query.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import List
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+ROW_LIMIT = 25000
+SHARD_MODES = ['auto', 'none', 'day', 'week']
+
+# Maximum number of concurrent Search Console calls for one analysis
+GSC_FETCH_CONCURRENCY = int(os.getenv("GSC_FETCH_CONCURRENCY", "8"))
+# Number of pages requested together once a shard turns out to need paging
+GSC_PAGE_PREFETCH = int(os.getenv("GSC_PAGE_PREFETCH", "3"))
+
+
+def plan_shards(start_date: str, end_date: str, shard: str) -> List[tuple]:
+    """
+    Split an inclusive YYYY-MM-DD range into (start, end) shards.
+    `shard` is 'none', 'day' or 'week'.
+    """
+    if shard == 'none':
+        return [(start_date, end_date)]
+
+    step = timedelta(days=1 if shard == 'day' else 7)
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    shards = []
+    while start <= end:
+        shard_end = min(start + step - timedelta(days=1), end)
+        shards.append((start.strftime("%Y-%m-%d"), shard_end.strftime("%Y-%m-%d")))
+        start = shard_end + timedelta(days=1)
+    return shards
+
+
+async def _fold(sink, rows: list):
+    # Folding is CPU work; run it off the event loop while other pages download
+    with span('fold'):
+        await asyncio.to_thread(sink.fold, rows)
+
+
+async def _fetch_page(session, site_url: str, body: dict, start_row: int, semaphore, on_page=None, sink=None) -> list:
+    page_body = dict(body, rowLimit=ROW_LIMIT, startRow=start_row)
+    async with semaphore:
+        logger.debug("Fetching %s..%s starting at row %s", body['startDate'], body['endDate'], start_row)
+        with span('page'):
+            response = await session.query(site_url, page_body)
+    rows = response.get('rows') or []
+    if sink is not None:
+        await _fold(sink, rows)
+    if on_page is not None:
+        on_page(len(rows))
+    return rows
+
+
+async def _fetch_shard(
+    session,
+    site_url: str,
+    body: dict,
+    semaphore,
+    first_page: list = None,
+    on_page=None,
+    sink=None
+) -> list:
+    """
+    Fetch every page of one shard, prefetching several pages at a time.
+    With `sink`, pages are folded into it instead of being collected.
+    """
+    if first_page is None:
+        first_page = await _fetch_page(session, site_url, body, 0, semaphore, on_page, sink)
+    elif sink is not None:
+        await _fold(sink, first_page)
+    rows = list(first_page) if sink is None else []
+    if len(first_page) < ROW_LIMIT:
+        return rows
+
+    next_row = ROW_LIMIT
+    while True:
+        starts = [next_row + i * ROW_LIMIT for i in range(GSC_PAGE_PREFETCH)]
+        pages = await asyncio.gather(*[
+            _fetch_page(session, site_url, body, start_row, semaphore, on_page, sink) for start_row in starts
+        ])
+        for page in pages:
+            if sink is None:
+                rows.extend(page)
+            if len(page) < ROW_LIMIT:
+                return rows
+        next_row = starts[-1] + ROW_LIMIT
+
+
+def merge_rows(rows: list) -> list:
+    """
+    Merge rows sharing the same keys. Clicks and impressions are summed and
+    position is re-weighted by impressions, which is how Search Console
+    aggregates a single range.
+    """
+    merged = {}
+    for row in rows:
+        key = tuple(row['keys'])
+        clicks = row.get('clicks', 0)
+        impressions = row.get('impressions', 0)
+        entry = merged.get(key)
+        if entry is None:
+            merged[key] = [clicks, impressions, row.get('position', 0) * impressions]
+        else:
+            entry[0] += clicks
+            entry[1] += impressions
+            entry[2] += row.get('position', 0) * impressions
+
+    return [
+        {
+            'keys': list(key),
+            'clicks': clicks,
+            'impressions': impressions,
+            'ctr': clicks / impressions if impressions > 0 else 0,
+            'position': position_sum / impressions if impressions > 0 else 0
+        }
+        for key, (clicks, impressions, position_sum) in merged.items()
+    ]
+
+
+async def plan_fetch(
+    session,
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    dimensions: List[str],
+    shard: str = 'auto',
+    semaphore=None
+) -> tuple:
+    """
+    Shards to fetch a period with, as (shards, first_page).
+
+    In 'auto' mode the whole range is requested first; only when that page
+    is full (the property needs paging) is the range re-planned into day or
+    week shards. `first_page` is that page while it is still the first page
+    of the only shard, else None. It has not been reported to any `on_page`,
+    since a re-planned range discards it.
+    """
+    if shard != 'auto':
+        return plan_shards(start_date, end_date, shard), None
+
+    body = {'startDate': start_date, 'endDate': end_date, 'dimensions': dimensions}
+    first_page = await _fetch_page(session, site_url, body, 0, semaphore or asyncio.Semaphore(1))
+    if len(first_page) < ROW_LIMIT:
+        return [(start_date, end_date)], first_page
+    span_days = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+    shard = 'day' if span_days <= 14 else 'week'
+    logger.info(f"Range needs paging, sharding by {shard}")
+    shards = plan_shards(start_date, end_date, shard)
+    return shards, first_page if len(shards) == 1 else None
+
+
+async def fetch_shard(
+    session,
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    dimensions: List[str],
+    semaphore,
+    first_page: list = None,
+    on_page=None,
+    sink=None
+):
+    """
+    Fetch one planned shard; pages are bounded by `semaphore`, which may be
+    shared by several shards. `first_page` is plan_fetch's probe page, if any.
+    """
+    if first_page is not None and on_page is not None:
+        on_page(len(first_page))
+    body = {'startDate': start_date, 'endDate': end_date, 'dimensions': dimensions}
+    rows = await _fetch_shard(session, site_url, body, semaphore, first_page, on_page, sink)
+    return rows if sink is None else sink
+
+
+async def fetch_rows(
+    session,
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    dimensions: List[str],
+    shard: str = 'auto',
+    concurrency: int = GSC_FETCH_CONCURRENCY,
+    on_page=None,
+    sink=None
+):
+    """
+    Fetch all rows for a period, merged per key.
+
+    In 'auto' mode the whole range is requested first; only when that page
+    is full (the property needs paging) is the range re-planned into shards.
+    `on_page(row_count)` is called after every page, for progress reporting.
+
+    With `sink` (e.g. an aggregation.QueryAccumulator), every page is folded
+    into it as soon as it arrives and nothing is buffered; `sink` is returned
+    instead of the rows.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    body = {'startDate': start_date, 'endDate': end_date, 'dimensions': dimensions}
+    shards, first_page = await plan_fetch(session, site_url, start_date, end_date, dimensions, shard, semaphore)
+    if first_page is not None:
+        # The plan is final: the probe page is part of the result from here on
+        if on_page is not None:
+            on_page(len(first_page))
+        if len(first_page) < ROW_LIMIT:
+            if sink is None:
+                return first_page
+            await _fold(sink, first_page)
+            return sink
+
+    if len(shards) == 1:
+        rows = await _fetch_shard(session, site_url, body, semaphore, first_page, on_page, sink)
+        return rows if sink is None else sink
+
+    shard_rows = await asyncio.gather(*[
+        _fetch_shard(
+            session, site_url, dict(body, startDate=shard_start, endDate=shard_end), semaphore,
+            on_page=on_page, sink=sink
+        )
+        for shard_start, shard_end in shards
+    ])
+    if sink is not None:
+        logger.info(f"Folded {len(sink)} queries across {len(shards)} shards")
+        return sink
+    logger.info(f"Fetched {sum(len(r) for r in shard_rows)} rows across {len(shards)} shards")
+    return merge_rows(row for rows in shard_rows for row in rows)
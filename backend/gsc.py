@@ -0,0 +1,221 @@
+"""
+Search Console API access layer.
+
+google-api-python-client is fully synchronous, so every call that touches the
+network (credential refresh, sites.list, searchanalytics.query) is dispatched
+to a bounded thread pool instead of running on the event loop. The client
+library is imported on first use and the service is built from its bundled
+discovery document, so neither costs anything at import time.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import google_auth_httplib2
+import httplib2
+
+from cache import TTLCache
+from scheduler import query_scheduler
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ['https://www.googleapis.com/auth/webmasters.readonly']
+
+# Maximum number of Search Console calls in flight at once in this worker
+GSC_MAX_CONCURRENCY = int(os.getenv("GSC_MAX_CONCURRENCY", "16"))
+
+# Pool threads whose connections are opened at startup, and how long each may take;
+# the rest of the pool stays free for requests arriving meanwhile
+GSC_WARM_THREADS = min(GSC_MAX_CONCURRENCY, int(os.getenv("GSC_WARM_THREADS", "4")))
+GSC_WARM_TIMEOUT = float(os.getenv("GSC_WARM_TIMEOUT", "3"))
+
+# Alternative API root, e.g. a local fake server for benchmarks; empty uses Google's
+GSC_API_ENDPOINT = os.getenv("GSC_API_ENDPOINT", "")
+
+_executor = ThreadPoolExecutor(max_workers=GSC_MAX_CONCURRENCY, thread_name_prefix="gsc")
+
+# Authorized sessions and resolved site URLs, keyed by service-account fingerprint.
+# Entries never outlive the access token they were built with.
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "256"))
+SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "3000"))
+# google-auth treats a token as expired this many seconds before its expiry
+# (google.auth._helpers.REFRESH_THRESHOLD) and, without a refresh token, fails
+GOOGLE_AUTH_REFRESH_THRESHOLD = 225
+# Usable token time a cached session still has when it is handed out, so an
+# analysis started with it can finish before the token goes stale
+TOKEN_EXPIRY_MARGIN = 600
+
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+site_cache = TTLCache(SESSION_CACHE_SIZE * 8, SESSION_CACHE_TTL)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking callable on the Search Console thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+# httplib2 connections are not thread-safe: each pool thread keeps its own
+# connection pool, shared by every session so keep-alive connections are reused
+_thread_local = threading.local()
+
+
+def _thread_http() -> httplib2.Http:
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        http = httplib2.Http()
+        _thread_local.http = http
+    return http
+
+
+@functools.lru_cache(maxsize=None)
+def discovery_document() -> dict:
+    """The Search Console discovery document bundled with google-api-python-client, parsed once."""
+    from googleapiclient.discovery_cache import get_static_doc
+    return json.loads(get_static_doc('searchconsole', 'v1'))
+
+
+def build_service(credentials):
+    from googleapiclient.discovery import build_from_document
+    return build_from_document(
+        discovery_document(),
+        credentials=credentials,
+        client_options={'api_endpoint': GSC_API_ENDPOINT} if GSC_API_ENDPOINT else None
+    )
+
+
+class GscSession:
+    """
+    Authorized Search Console client that can be shared between threads.
+
+    Requests are executed through an AuthorizedHttp around the calling pool
+    thread's connection pool instead of the one owned by the service object.
+    """
+
+    def __init__(self, credentials, fingerprint: str = None):
+        self.credentials = credentials
+        self.fingerprint = fingerprint
+        self.service = build_service(credentials)
+        self._sites = None
+
+    def _http(self):
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=_thread_http())
+
+    def _execute(self, request):
+        try:
+            return request.execute(http=self._http())
+        except ConnectionError:
+            # The server closed an idle keep-alive connection: retry once on a new one
+            _thread_local.http = None
+            return request.execute(http=self._http())
+
+    async def list_sites(self) -> dict:
+        """List accessible sites; the result lives as long as the cached session."""
+        if self._sites is None:
+            self._sites = await run_blocking(self._execute, self.service.sites().list())
+        return self._sites
+
+    async def query(self, site_url: str, body: dict) -> dict:
+        """searchanalytics.query through the central rate-limiting scheduler."""
+        async def call():
+            request = self.service.searchanalytics().query(siteUrl=site_url, body=body)
+            return await run_blocking(self._execute, request)
+
+        return await query_scheduler.submit(self.fingerprint or str(id(self)), site_url, body, call)
+
+
+def key_fingerprint(json_key: dict) -> str:
+    """Stable SHA-256 fingerprint of a service-account key, independent of formatting."""
+    canonical = json.dumps(json_key, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _open_session(json_key: dict, fingerprint: str):
+    """
+    Exchange the service-account key for an access token and build a session
+    around a bearer-only credential, so the cached session holds no key material.
+    """
+    from google.oauth2 import credentials as oauth2_credentials
+    from google.oauth2 import service_account
+
+    sa_credentials = service_account.Credentials.from_service_account_info(json_key, scopes=SCOPES)
+    sa_credentials.refresh(google_auth_httplib2.Request(_thread_http()))
+    credentials = oauth2_credentials.Credentials(
+        token=sa_credentials.token,
+        expiry=sa_credentials.expiry,
+        scopes=SCOPES
+    )
+    return GscSession(credentials, fingerprint)
+
+
+async def get_session(json_key: dict) -> GscSession:
+    """Return a cached authorized session for this key, creating it on a miss."""
+    fingerprint = key_fingerprint(json_key)
+    session = session_cache.get(fingerprint)
+    if session is not None:
+        return session
+
+    session = await run_blocking(_open_session, json_key, fingerprint)
+    ttl = SESSION_CACHE_TTL
+    if session.credentials.expiry is not None:
+        # google-auth expiries are naive UTC datetimes
+        remaining = (session.credentials.expiry - datetime.utcnow()).total_seconds()
+        ttl = max(0, remaining - GOOGLE_AUTH_REFRESH_THRESHOLD - TOKEN_EXPIRY_MARGIN)
+    session_cache.set(fingerprint, session, ttl=ttl)
+    return session
+
+
+def get_cached_site(session: GscSession, domain: str):
+    """Return the cached (site_url, permission_level) for a domain, if any."""
+    return site_cache.get((session.fingerprint, domain))
+
+
+def cache_site(session: GscSession, domain: str, site_url: str, permission_level: str):
+    site_cache.set((session.fingerprint, domain), (site_url, permission_level))
+
+
+def _warm_connection(http: httplib2.Http, connect_url: str):
+    """Open a keep-alive connection with a short timeout, then lift the timeout for real calls."""
+    http.timeout = GSC_WARM_TIMEOUT
+    try:
+        http.request(connect_url, 'HEAD')
+    except Exception as e:
+        logger.debug("Connection warm-up failed: %s", e)
+    finally:
+        http.timeout = None
+        for connection in list(http.connections.values()):
+            connection.timeout = None
+            if connection.sock is not None:
+                connection.sock.settimeout(None)
+
+
+def warm_up_pool(connect_url: str = None):
+    """
+    Start GSC_WARM_THREADS pool threads with their connection pool and build a
+    service from the discovery document. With `connect_url`, each of these
+    threads also opens a keep-alive connection to it, giving up after
+    GSC_WARM_TIMEOUT seconds.
+    """
+    from google.oauth2 import credentials as oauth2_credentials
+
+    build_service(oauth2_credentials.Credentials(token='warm-up'))
+    barrier = threading.Barrier(GSC_WARM_THREADS)
+
+    def warm_thread():
+        http = _thread_http()
+        # Hold the thread briefly so each task lands on a thread of its own
+        try:
+            barrier.wait(timeout=1)
+        except threading.BrokenBarrierError:
+            pass
+        if connect_url:
+            _warm_connection(http, connect_url)
+
+    for future in [_executor.submit(warm_thread) for _ in range(GSC_WARM_THREADS)]:
+        future.result()
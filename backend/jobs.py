@@ -0,0 +1,168 @@
+"""
+Background analysis jobs.
+
+Long analyses run on a bounded pool of worker tasks instead of inside the
+HTTP request. Clients poll the job or follow its Server-Sent Events stream;
+identical in-flight jobs are shared and finished jobs expire after a TTL.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of jobs running at once; others wait in the queue
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# How long finished jobs (and their results) can be polled
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+JOB_CACHE_SIZE = int(os.getenv("JOB_CACHE_SIZE", "256"))
+
+
+def job_key(*parts) -> str:
+    """Deduplication key for a job; parts must be JSON serializable."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Job:
+    """State and progress of one background job."""
+
+    def __init__(self, key: str):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = 'queued'
+        self.phase = None
+        self.pages_fetched = 0
+        self.rows_fetched = 0
+        self.rows_processed = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self._notify()
+
+    def page_fetched(self, row_count: int):
+        self.pages_fetched += 1
+        self.rows_fetched += row_count
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self, timeout: float):
+        """Wait until the job changes; returns False on timeout."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "phase": self.phase,
+            "progress": {
+                "pages_fetched": self.pages_fetched,
+                "rows_fetched": self.rows_fetched,
+                "rows_processed": self.rows_processed
+            },
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+        if self.status == 'done':
+            data["result"] = self.result
+        if self.status == 'failed':
+            data["error"] = self.error
+        return data
+
+
+class JobManager:
+    """Runs jobs on a bounded worker pool, deduplicating identical in-flight jobs."""
+
+    def __init__(self, workers: int = JOB_WORKERS, ttl: int = JOB_TTL, maxsize: int = JOB_CACHE_SIZE):
+        self.workers = workers
+        self._active = {}
+        self._inflight = {}
+        self._finished = TTLCache(maxsize, ttl)
+        self._semaphore = None
+        self._tasks = set()
+
+    def get(self, job_id: str):
+        job = self._active.get(job_id)
+        return job if job is not None else self._finished.get(job_id)
+
+    def submit(self, key: str, run) -> Job:
+        """
+        Start `run(job)` in the background, or return the in-flight job with
+        the same key. `run` is a coroutine function returning the job result.
+        """
+        job_id = self._inflight.get(key)
+        if job_id is not None:
+            logger.info(f"Reusing in-flight job {job_id}")
+            return self._active[job_id]
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        job = Job(key)
+        self._active[job.id] = job
+        self._inflight[key] = job.id
+        task = asyncio.create_task(self._run(job, run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job: Job, run):
+        try:
+            async with self._semaphore:
+                job.update(status='running')
+                result = await run(job)
+            job.update(status='done', result=result, phase='done')
+        except HTTPException as he:
+            job.update(status='failed', error={"status_code": he.status_code, "detail": he.detail})
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            job.update(status='failed', error={"status_code": 500, "detail": f"An unexpected error occurred: {str(e)}"})
+        finally:
+            job.finished_at = time.time()
+            self._inflight.pop(job.key, None)
+            self._finished.set(job.id, job)
+            self._active.pop(job.id, None)
+            job.update()
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._active),
+            "running": sum(1 for job in self._active.values() if job.status == 'running'),
+            "finished": self._finished.stats()
+        }
+
+
+job_manager = JobManager()
+
+
+async def job_events(job: Job, heartbeat: float = 15):
+    """Server-Sent Events stream of a job's state until it finishes."""
+    while True:
+        yield f"data: {json.dumps(job.to_dict())}\n\n"
+        if job.finished:
+            return
+        if not await job.wait_for_change(heartbeat):
+            yield ": keep-alive\n\n"
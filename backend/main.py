@@ -1,19 +1,37 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import pandas as pd
-import json
+from fastapi.responses import Response, StreamingResponse
+import asyncio
 import re
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import io
-import matplotlib.pyplot as plt
-import base64
 import logging
-from urllib.parse import urlparse
-from typing import List
+from typing import Optional
 import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from aggregation import ROLLUP_DIMENSIONS, compare_queries
+from analysis import (
+    analyze_site, data_version, fetch_period, get_base_domain, open_site,
+    read_json_key, run_analysis, store_result, summarize_period
+)
+from batch import BATCH_MAX_SITES, accessible_sites, parse_site_list, run_batch
+from classifier import MATCH_MODES, get_classifier, memo_budget
+from fetch import SHARD_MODES
+from compression import CompressionMiddleware
+from results import (
+    SEGMENTS, SORT_KEYS, decode_cursor, encode_cursor, etag_is_current, get_result,
+    iter_csv, remember_etag, result_etag, result_store
+)
+from rollups import rollup_refresher, rollup_summary, rollup_version
+from store import row_store
+from gsc import get_session, key_fingerprint, session_cache, site_cache
+from jobs import job_events, job_key, job_manager
+from metrics import TimedJSONResponse, server_timing_header, start_request_timings
+from scheduler import query_scheduler
+from warmup import warm_up
 
 # Configure logging with more detail
 logging.basicConfig(
@@ -26,7 +44,16 @@ logger = logging.getLogger(__name__)
 # Use a default like your Vercel preview URL or localhost for development if needed
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000") # Default to localhost:3000 if not set
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await warm_up()
+    if rollup_refresher is not None:
+        rollup_refresher.start()
+    yield
+    if rollup_refresher is not None:
+        await rollup_refresher.stop()
+
+app = FastAPI(lifespan=lifespan, default_response_class=TimedJSONResponse)
 
 # CORS config
 app.add_middleware(
@@ -35,7 +62,39 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"], # Allow POST
     allow_headers=["*"],
+    expose_headers=["ETag", "Server-Timing"],
 )
+app.add_middleware(CompressionMiddleware)
+
+@app.middleware("http")
+async def add_server_timing(request: Request, call_next):
+    """Return the phase spans recorded while handling the request as Server-Timing."""
+    start = time.perf_counter()
+    timings = start_request_timings()
+    response = await call_next(request)
+    response.headers["Server-Timing"] = server_timing_header(timings, time.perf_counter() - start)
+    # Lets the frontend's Resource Timing entries carry the phases too
+    response.headers["Timing-Allow-Origin"] = FRONTEND_URL
+    return response
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True when If-None-Match lists `etag` (weak comparison)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    opaque = etag.removeprefix('W/')
+    return opaque in {tag.strip().removeprefix('W/') for tag in header.split(',')}
+
+def check_precondition(request: Request, etag: str):
+    """
+    POST analyses are not revalidated with 304 (RFC 9110 13.1.2): when the client
+    already holds the current response, the request fails with 412 instead and
+    the result stays readable, and revalidatable, at GET /results/{result_id}.
+    """
+    if etag_matches(request, etag) and etag_is_current(etag):
+        raise HTTPException(
+            status_code=412, detail="The current response matches If-None-Match", headers={"ETag": etag}
+        )
 
 def validate_regex(pattern: str) -> bool:
     try:
@@ -64,350 +123,106 @@ def normalize_site_url(url: str) -> str:
         
     return url
 
-def validate_dates(start_date: str, end_date: str):
+def validate_analysis_options(exclude_regex: str, match_mode: str, shard: str):
+    if match_mode not in MATCH_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid match mode. Use one of: {', '.join(MATCH_MODES)}")
+
+    # Validate regex pattern (keyword lists are matched literally)
+    if match_mode == 'regex' and exclude_regex and not validate_regex(exclude_regex):
+        logger.error(f"Invalid regex pattern: {exclude_regex}")
+        raise HTTPException(status_code=400, detail="Invalid regex pattern provided")
+
+    if shard not in SHARD_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid shard mode. Use one of: {', '.join(SHARD_MODES)}")
+
+def parse_dimensions(dimensions: str) -> tuple:
+    """Comma-separated rollup dimensions, fetched together with query."""
+    parsed = tuple(dict.fromkeys(d.strip().lower() for d in dimensions.split(',') if d.strip()))
+    invalid = [d for d in parsed if d not in ROLLUP_DIMENSIONS]
+    if invalid:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid dimensions: {', '.join(invalid)}. Use any of: {', '.join(ROLLUP_DIMENSIONS)}"
+        )
+    return parsed
+
+def parse_dates(start_date: str, end_date: str):
+    """Parse a YYYY-MM-DD range; malformed dates are a 400, not an error deep in the store or fetch."""
     try:
-        start = datetime.strptime(start_date, "%Y-%m-%d")
-        end = datetime.strptime(end_date, "%Y-%m-%d")
-        today = datetime.now()
-        
-        if end > today - timedelta(days=1):
-            raise HTTPException(status_code=400, detail="End date cannot be later than yesterday")
-        if start < end - timedelta(days=16*30):
-            raise HTTPException(status_code=400, detail="Date range cannot exceed 16 months")
-        if start > end:
-            raise HTTPException(status_code=400, detail="Start date must be before end date")
-            
-        return start, end
+        return datetime.strptime(start_date, "%Y-%m-%d"), datetime.strptime(end_date, "%Y-%m-%d")
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
 
-def get_base_domain(url: str) -> str:
-    """
-    Get the base domain from a URL, handling various formats.
-    Returns the domain without any prefix or protocol.
-    """
-    # Remove protocol if present
-    url = url.lower().strip()
-    if '://' in url:
-        url = url.split('://', 1)[1]
-    
-    # Remove path, query parameters, etc.
-    url = url.split('/')[0]
-    
-    # Remove www. if present
-    if url.startswith('www.'):
-        url = url[4:]
-        
-    # Remove sc-domain: if present
-    if url.startswith('sc-domain:'):
-        url = url[10:]
-        
-    return url
+def validate_dates(start_date: str, end_date: str):
+    start, end = parse_dates(start_date, end_date)
+    today = datetime.now()
 
-def get_all_possible_site_formats(domain: str) -> list:
-    """
-    Generate all possible formats for a given domain.
-    """
-    domain = get_base_domain(domain)  # Clean the domain first
-    return [
-        f"sc-domain:{domain}",
-        f"https://www.{domain}/",
-        f"https://{domain}/",
-        f"http://www.{domain}/",
-        f"http://{domain}/"
-    ]
+    if end > today - timedelta(days=1):
+        raise HTTPException(status_code=400, detail="End date cannot be later than yesterday")
+    if start < end - timedelta(days=16*30):
+        raise HTTPException(status_code=400, detail="Date range cannot exceed 16 months")
+    if start > end:
+        raise HTTPException(status_code=400, detail="Start date must be before end date")
+
+    return start, end
 
 @app.post("/analyze")
 async def analyze_data(
+    request: Request,
     file: UploadFile = File(...),
     start_date: str = Form(...),
     end_date: str = Form(...),
     exclude_regex: str = Form(...),
-    site_url: str = Form(...)
+    site_url: str = Form(...),
+    shard: str = Form('auto'),
+    match_mode: str = Form('keywords'),
+    dimensions: str = Form(''),
+    detail: bool = Form(True)
 ):
     try:
         logger.info(f"Starting analysis for site: {site_url}")
         logger.info(f"Date range: {start_date} to {end_date}")
         logger.info(f"Exclude regex: {exclude_regex}")
 
-        # Validate regex pattern
-        if exclude_regex and not validate_regex(exclude_regex):
-            logger.error(f"Invalid regex pattern: {exclude_regex}")
-            raise HTTPException(status_code=400, detail="Invalid regex pattern provided")
+        parse_dates(start_date, end_date)
+        validate_analysis_options(exclude_regex, match_mode, shard)
+        rollup_dimensions = parse_dimensions(dimensions)
 
         # Read and validate JSON key file
-        try:
-            content = await file.read()
-            logger.info(f"JSON key file name: {file.filename}")
-            json_key = json.loads(content)
-            logger.info("Successfully parsed JSON key file")
-        except json.JSONDecodeError as je:
-            logger.error(f"JSON decode error: {str(je)}")
-            raise HTTPException(status_code=400, detail=f"Invalid JSON key file: {str(je)}")
-        except Exception as e:
-            logger.error(f"Error reading file: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Error reading file: {str(e)}")
-
-        # Initialize credentials and service
-        try:
-            credentials = service_account.Credentials.from_service_account_info(
-                json_key,
-                scopes=['https://www.googleapis.com/auth/webmasters.readonly']
+        json_key = await read_json_key(file)
+        session, normalized_site_url = await open_site(json_key, site_url)
+
+        # Summary-only answers may come from the rollups, which are refreshed on their own schedule
+        rollups = None
+        if not detail and not rollup_dimensions:
+            rollups = await rollup_version(normalized_site_url, exclude_regex, match_mode, start_date, end_date)
+
+        def etag(version):
+            return result_etag(
+                key_fingerprint(json_key), normalized_site_url, start_date, end_date,
+                exclude_regex, match_mode, rollup_dimensions, detail, version, rollups
             )
-            logger.info("Successfully created credentials")
-            
-            # Verify site access before proceeding
-            webmasters_service = build('searchconsole', 'v1', credentials=credentials)
-            sites = webmasters_service.sites().list().execute()
-            
-            # Log all available sites
-            available_sites = [site['siteUrl'] for site in sites.get('siteEntry', [])]
-            logger.info(f"Available sites: {available_sites}")
-            
-            # Clean up input domain
-            input_domain = get_base_domain(site_url)
-            logger.info(f"Cleaned input domain: {input_domain}")
-            
-            site_found = False
-            matched_site_url = None
-            
-            # Try to find any site that matches our domain
-            for site in sites.get('siteEntry', []):
-                current_site_url = site['siteUrl']
-                current_domain = get_base_domain(current_site_url)
-                
-                logger.info(f"Checking site URL: {current_site_url}")
-                logger.info(f"Cleaned site domain: {current_domain}")
-                logger.info(f"Comparing with input domain: {input_domain}")
-                
-                if current_domain == input_domain:
-                    site_found = True
-                    matched_site_url = current_site_url
-                    logger.info(f"Found matching domain! Using site URL: {matched_site_url}")
-                    
-                    if site.get('permissionLevel') in ['siteOwner', 'siteFullUser', 'siteRestrictedUser']:
-                        logger.info(f"Access verified with permission level: {site.get('permissionLevel')}")
-                        break
-                    else:
-                        logger.error(f"Insufficient permission level: {site.get('permissionLevel')}")
-                        raise HTTPException(status_code=403, detail="Insufficient permissions to access site data")
-            
-            if not site_found:
-                error_msg = f"No matching domain found. You entered: {site_url} (cleaned to: {input_domain}). Available sites: {available_sites}"
-                logger.error(error_msg)
-                raise HTTPException(status_code=404, detail=error_msg)
-            
-            # Use the matched site URL for subsequent requests
-            normalized_site_url = matched_site_url
-            logger.info(f"Final site URL being used: {normalized_site_url}")
-            
-        except Exception as e:
-            logger.error(f"Credentials or site access error: {str(e)}")
-            raise HTTPException(status_code=403, detail=f"Error accessing Search Console: {str(e)}")
-
-        # Get total clicks for the period first
-        total_request = {
-            'startDate': start_date,
-            'endDate': end_date,
-            'dimensions': []  # No dimensions means we get totals
-        }
-        
-        try:
-            logger.info("Querying total clicks...")
-            total_response = webmasters_service.searchanalytics().query(
-                siteUrl=normalized_site_url,
-                body=total_request
-            ).execute()
-            logger.info(f"Total response: {total_response}")
-        except Exception as e:
-            logger.error(f"Search Console API error (totals): {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Error querying Search Console API: {str(e)}")
-        
-        if 'rows' not in total_response or not total_response['rows']:
-            logger.error("No data returned from Search Console API")
-            raise HTTPException(status_code=404, detail="No data found for the specified period")
-            
-        total_gsc_clicks = total_response['rows'][0]['clicks']
-        logger.info(f"Total GSC clicks: {total_gsc_clicks}")
-        
-        # Initialize variables for pagination
-        start_row = 0
-        row_limit = 25000
-        all_rows = []
-        
-        while True:
-            # Prepare request body with pagination
-            request = {
-                'startDate': start_date,
-                'endDate': end_date,
-                'dimensions': ['query'],
-                'rowLimit': row_limit,
-                'startRow': start_row
-            }
-            
-            # Execute API request
-            try:
-                logger.info(f"Fetching data batch starting at row {start_row}")
-                response = webmasters_service.searchanalytics().query(
-                    siteUrl=normalized_site_url,
-                    body=request
-                ).execute()
-                
-                if 'rows' in response and response['rows']:
-                    logger.info(f"Received {len(response['rows'])} rows")
-                    all_rows.extend(response['rows'])
-                else:
-                    logger.info("No more rows to fetch")
-                    break
-                    
-                if len(response['rows']) < row_limit:
-                    logger.info("Reached last batch of data")
-                    break
-                    
-                start_row += row_limit
-                
-            except Exception as e:
-                logger.error(f"Search Console API error (query data): {str(e)}")
-                raise HTTPException(status_code=400, detail=f"Error querying Search Console API: {str(e)}")
-        
-        logger.info(f"Total rows fetched: {len(all_rows)}")
-        
-        # Initialize counters
-        total_clicks = 0
-        total_impressions = 0
-        brand_clicks = 0
-        brand_impressions = 0
-        brand_position_sum = 0
-        non_brand_clicks = 0
-        non_brand_impressions = 0
-        non_brand_position_sum = 0
-        brand_queries = []
-        non_brand_queries = []
-        
-        # Process all results
-        for row in all_rows:
-            query = row['keys'][0].lower()
-            clicks = row.get('clicks', 0)
-            impressions = row.get('impressions', 0)
-            position = row.get('position', 0)
-            
-            total_clicks += clicks
-            total_impressions += impressions
-            
-            # Use empty string if exclude_regex is empty to avoid regex errors
-            pattern = exclude_regex.lower() if exclude_regex else ''
-            if pattern:
-                # Split the pattern by | and create a list of words to check
-                brand_keywords = [kw.strip() for kw in pattern.split('|')]
-                # Check if any of the keywords is present in the query
-                if any(kw in query.split() for kw in brand_keywords):
-                    brand_clicks += clicks
-                    brand_impressions += impressions
-                    brand_position_sum += position * impressions
-                    brand_queries.append({
-                        'query': query,
-                        'clicks': clicks,
-                        'impressions': impressions,
-                        'position': position,
-                        'ctr': row.get('ctr', 0) * 100
-                    })
-                else:
-                    non_brand_clicks += clicks
-                    non_brand_impressions += impressions
-                    non_brand_position_sum += position * impressions
-                    non_brand_queries.append({
-                        'query': query,
-                        'clicks': clicks,
-                        'impressions': impressions,
-                        'position': position,
-                        'ctr': row.get('ctr', 0) * 100
-                    })
-        
-        # Calculate metrics
-        total_all_clicks = brand_clicks + non_brand_clicks
-        unattributed_clicks = max(0, total_gsc_clicks - total_all_clicks)
-        
-        total_with_unattributed = total_all_clicks + unattributed_clicks
-        brand_percentage = (brand_clicks / total_with_unattributed * 100) if total_with_unattributed > 0 else 0
-        non_brand_percentage = (non_brand_clicks / total_with_unattributed * 100) if total_with_unattributed > 0 else 0
-        unattributed_percentage = (unattributed_clicks / total_with_unattributed * 100) if total_with_unattributed > 0 else 0
-        
-        brand_avg_position = (brand_position_sum / brand_impressions) if brand_impressions > 0 else 0
-        non_brand_avg_position = (non_brand_position_sum / non_brand_impressions) if non_brand_impressions > 0 else 0
-        
-        brand_ctr = (brand_clicks / brand_impressions * 100) if brand_impressions > 0 else 0
-        non_brand_ctr = (non_brand_clicks / non_brand_impressions * 100) if non_brand_impressions > 0 else 0
-        
-        # Sort queries by clicks for the top 10 lists
-        brand_queries.sort(key=lambda x: x['clicks'], reverse=True)
-        non_brand_queries.sort(key=lambda x: x['clicks'], reverse=True)
-        
-        # Prepare CSV data with ALL queries
-        csv_data = "SEO Performance Analysis - Complete Query Data\n"
-        csv_data += f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        csv_data += f"Website: {site_url}\n"
-        csv_data += f"Period: {start_date} to {end_date}\n\n"
-        
-        # Add summary metrics
-        csv_data += "Overall Metrics\n"
-        csv_data += f"Total Clicks (including unattributed),{total_with_unattributed}\n"
-        csv_data += f"Unattributed Clicks,{unattributed_clicks}\n"
-        csv_data += f"Total Impressions,{total_impressions}\n"
-        csv_data += f"Average CTR,{(total_clicks/total_impressions*100 if total_impressions > 0 else 0):.2f}%\n"
-        csv_data += f"Average Position,{((brand_position_sum + non_brand_position_sum)/(brand_impressions + non_brand_impressions) if (brand_impressions + non_brand_impressions) > 0 else 0):.1f}\n\n"
-        
-        csv_data += "Brand vs Non-Brand Summary\n"
-        csv_data += "Type,Clicks,Impressions,CTR,Average Position,Share of Voice\n"
-        csv_data += f"Brand,{brand_clicks},{brand_impressions},{brand_ctr:.2f}%,{brand_avg_position:.1f},{brand_percentage:.1f}%\n"
-        csv_data += f"Non-Brand,{non_brand_clicks},{non_brand_impressions},{non_brand_ctr:.2f}%,{non_brand_avg_position:.1f},{non_brand_percentage:.1f}%\n"
-        csv_data += f"Unattributed,{unattributed_clicks},N/A,N/A,N/A,{unattributed_percentage:.1f}%\n\n"
-        
-        # Add complete query data
-        csv_data += "Complete Query Analysis\n"
-        csv_data += "Type,Query,Clicks,Impressions,CTR,Position,Click Share,Impression Share\n"
-        
-        # Add all brand queries
-        for query in brand_queries:
-            click_share = (query['clicks'] / total_with_unattributed * 100) if total_with_unattributed > 0 else 0
-            impression_share = (query['impressions'] / total_impressions * 100) if total_impressions > 0 else 0
-            csv_data += f"Brand,{query['query']},{query['clicks']},{query['impressions']},{query['ctr']:.2f}%,{query['position']:.1f},{click_share:.2f}%,{impression_share:.2f}%\n"
-            
-        # Add all non-brand queries
-        for query in non_brand_queries:
-            click_share = (query['clicks'] / total_with_unattributed * 100) if total_with_unattributed > 0 else 0
-            impression_share = (query['impressions'] / total_impressions * 100) if total_impressions > 0 else 0
-            csv_data += f"Non-Brand,{query['query']},{query['clicks']},{query['impressions']},{query['ctr']:.2f}%,{query['position']:.1f},{click_share:.2f}%,{impression_share:.2f}%\n"
-        
-        # Calculate visibility score (0-100)
-        visibility_score = min(100, (
-            (brand_percentage * 0.4) +  # Brand dominance
-            (min(100, (1/brand_avg_position) * 50) * 0.3) +  # Brand position
-            (min(100, brand_ctr) * 0.3)  # Brand CTR
-        )) if brand_avg_position > 0 else 0
-        
-        return {
-            "total_all_clicks": total_with_unattributed,
-            "brand_clicks": brand_clicks,
-            "non_brand_clicks": non_brand_clicks,
-            "brand_percentage": brand_percentage,
-            "non_brand_percentage": non_brand_percentage,
-            "unattributed_clicks": unattributed_clicks,
-            "unattributed_percentage": unattributed_percentage,
-            "csv_data": csv_data,
-            # Additional metrics for exports
-            "brand_impressions": brand_impressions,
-            "non_brand_impressions": non_brand_impressions,
-            "brand_ctr": brand_ctr,
-            "non_brand_ctr": non_brand_ctr,
-            "brand_avg_position": brand_avg_position,
-            "non_brand_avg_position": non_brand_avg_position,
-            "visibility_score": visibility_score,
-            "top_brand_queries": brand_queries[:10],  # Top 10 pour le dashboard
-            "top_non_brand_queries": non_brand_queries[:10],  # Top 10 pour le dashboard
-            "all_brand_queries": brand_queries,  # Toutes les requêtes pour l'export CSV
-            "all_non_brand_queries": non_brand_queries,  # Toutes les requêtes pour l'export CSV
-            "total_impressions": total_impressions
-        }
+
+        # A repeat request for unchanged data is refused without recomputing
+        version = await data_version(normalized_site_url, start_date, end_date)
+        check_precondition(request, etag(version))
+
+        # Summary metrics alone are answered from the daily rollups when they cover the range
+        if not detail and not rollup_dimensions:
+            summary = await rollup_summary(normalized_site_url, exclude_regex, match_mode, start_date, end_date)
+            if summary is not None:
+                remember_etag(etag(version), [])
+                return TimedJSONResponse(summary, headers={"ETag": etag(version)})
+
+        classifier = get_classifier(exclude_regex, match_mode)
+        summary = await analyze_site(
+            session, normalized_site_url, site_url, start_date, end_date, classifier, shard, dimensions=rollup_dimensions
+        )
+
+        # Syncing the row store may have changed the data version
+        response_etag = etag(await data_version(normalized_site_url, start_date, end_date))
+        remember_etag(response_etag, [summary["result_id"]])
+        return TimedJSONResponse(summary, headers={"ETag": response_etag})
         
     except HTTPException as he:
         raise he
@@ -415,129 +230,390 @@ async def analyze_data(
         logging.error(f"Error in analyze_data: {str(e)}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
+@app.post("/jobs/analyze")
+async def submit_analysis_job(
+    file: UploadFile = File(...),
+    start_date: str = Form(...),
+    end_date: str = Form(...),
+    exclude_regex: str = Form(...),
+    site_url: str = Form(...),
+    shard: str = Form('auto'),
+    match_mode: str = Form('keywords'),
+    dimensions: str = Form('')
+):
+    """Run /analyze in the background; identical in-flight analyses share one job."""
+    parse_dates(start_date, end_date)
+    validate_analysis_options(exclude_regex, match_mode, shard)
+    rollup_dimensions = parse_dimensions(dimensions)
+    json_key = await read_json_key(file)
+
+    key = job_key(
+        key_fingerprint(json_key), get_base_domain(site_url), start_date, end_date,
+        exclude_regex, match_mode, shard, *rollup_dimensions
+    )
+
+    async def run(job):
+        return await run_analysis(
+            json_key, site_url, start_date, end_date, exclude_regex, match_mode, shard,
+            progress=job, dimensions=rollup_dimensions
+        )
+
+    job = job_manager.submit(key, run)
+    logger.info(f"Analysis job {job.id} for {site_url} is {job.status}")
+    return {"job_id": job.id, "status": job.status}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status, progress and, once done, the result of a background analysis."""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """Server-Sent Events stream of a job's progress, ending when it finishes."""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return StreamingResponse(
+        job_events(job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/batch/analyze")
+async def batch_analyze(
+    file: UploadFile = File(...),
+    start_date: str = Form(...),
+    end_date: str = Form(...),
+    exclude_regex: str = Form(...),
+    site_urls: str = Form(''),
+    all_sites: bool = Form(False),
+    shard: str = Form('auto'),
+    match_mode: str = Form('keywords'),
+    dimensions: str = Form('')
+):
+    """
+    Analyse several properties with one key. Streams NDJSON: a line per site
+    as it finishes, then a portfolio rollup.
+    """
+    parse_dates(start_date, end_date)
+    validate_analysis_options(exclude_regex, match_mode, shard)
+    rollup_dimensions = parse_dimensions(dimensions)
+    json_key = await read_json_key(file)
+
+    try:
+        session = await get_session(json_key)
+        sites = await accessible_sites(session) if all_sites else parse_site_list(site_urls)
+    except Exception as e:
+        logger.error(f"Credentials or site access error: {str(e)}")
+        raise HTTPException(status_code=403, detail=f"Error accessing Search Console: {str(e)}")
+
+    if not sites:
+        raise HTTPException(status_code=400, detail="No sites to analyze")
+    if len(sites) > BATCH_MAX_SITES:
+        raise HTTPException(status_code=400, detail=f"A batch cannot exceed {BATCH_MAX_SITES} sites")
+
+    logger.info(f"Starting batch analysis of {len(sites)} sites")
+    classifier = get_classifier(exclude_regex, match_mode)
+    return StreamingResponse(
+        run_batch(json_key, sites, start_date, end_date, classifier, shard, rollup_dimensions),
+        media_type="application/x-ndjson"
+    )
+
 @app.post("/compare")
 async def compare_periods(
+    request: Request,
     file: UploadFile = File(...),
     current_start_date: str = Form(...),
     current_end_date: str = Form(...),
     previous_start_date: str = Form(...),
     previous_end_date: str = Form(...),
     exclude_regex: str = Form(...),
-    site_url: str = Form(...)
+    site_url: str = Form(...),
+    shard: str = Form('auto'),
+    match_mode: str = Form('keywords'),
+    dimensions: str = Form(''),
+    detail: bool = Form(True),
+    clicks_threshold: float = Form(10),
+    position_threshold: float = Form(0.5),
+    query_limit: int = Form(100)
 ):
     try:
         # Validate dates
         validate_dates(current_start_date, current_end_date)
         validate_dates(previous_start_date, previous_end_date)
-        
-        # Read JSON key file
-        content = await file.read()
-        json_key = json.loads(content)
-        
-        # Initialize credentials
-        credentials = service_account.Credentials.from_service_account_info(
-            json_key,
-            scopes=['https://www.googleapis.com/auth/webmasters.readonly']
+        validate_analysis_options(exclude_regex, match_mode, shard)
+        rollup_dimensions = parse_dimensions(dimensions)
+        if clicks_threshold < 0 or position_threshold < 0:
+            raise HTTPException(status_code=400, detail="Significance thresholds must be non-negative")
+        if not 1 <= query_limit <= 10000:
+            raise HTTPException(status_code=400, detail="query_limit must be between 1 and 10000")
+        
+        # Read the JSON key file once, then authenticate and resolve the site once
+        json_key = await read_json_key(file)
+        session, normalized_site_url = await open_site(json_key, site_url)
+
+        async def etag():
+            versions = await asyncio.gather(
+                data_version(normalized_site_url, current_start_date, current_end_date),
+                data_version(normalized_site_url, previous_start_date, previous_end_date)
+            )
+            if not detail and not rollup_dimensions:
+                # Both periods may be answered from the rollups, which are refreshed on their own schedule
+                versions += await asyncio.gather(
+                    rollup_version(normalized_site_url, exclude_regex, match_mode, current_start_date, current_end_date),
+                    rollup_version(normalized_site_url, exclude_regex, match_mode, previous_start_date, previous_end_date)
+                )
+            return result_etag(
+                key_fingerprint(json_key), normalized_site_url, current_start_date, current_end_date,
+                previous_start_date, previous_end_date, exclude_regex, match_mode, rollup_dimensions, detail,
+                clicks_threshold, position_threshold, query_limit, *versions
+            )
+
+        # A repeat request for unchanged data is refused without recomputing
+        request_etag = await etag()
+        check_precondition(request, request_etag)
+
+        # Without query-level changes, both periods are answered from the daily rollups when they cover them
+        if not detail and not rollup_dimensions:
+            current_period, previous_period = await asyncio.gather(
+                rollup_summary(normalized_site_url, exclude_regex, match_mode, current_start_date, current_end_date),
+                rollup_summary(normalized_site_url, exclude_regex, match_mode, previous_start_date, previous_end_date)
+            )
+            if current_period is not None and previous_period is not None:
+                remember_etag(request_etag, [])
+                return TimedJSONResponse({
+                    "current_period": current_period,
+                    "previous_period": previous_period,
+                    "changes": period_changes(previous_period, current_period)
+                }, headers={"ETag": request_etag})
+        
+        # Fetch both periods concurrently, classifying and folding pages as they arrive. Each
+        # period classifies its own new queries; in fuzzy mode both go through the site's memo,
+        # so a query seen in both periods is matched once
+        classifier = get_classifier(exclude_regex, match_mode)
+        (current_total, current_queries), (previous_total, previous_queries) = await asyncio.gather(
+            fetch_period(
+                session, normalized_site_url, current_start_date, current_end_date, classifier, shard,
+                dimensions=rollup_dimensions
+            ),
+            fetch_period(
+                session, normalized_site_url, previous_start_date, previous_end_date, classifier, shard,
+                dimensions=rollup_dimensions
+            )
         )
+
+        def _summarize():
+            return (
+                summarize_period(current_queries, current_total),
+                summarize_period(previous_queries, previous_total)
+            )
+
+        (current_period, current_frame), (previous_period, previous_frame) = await asyncio.to_thread(_summarize)
         
-        # Create service
-        webmasters_service = build('searchconsole', 'v1', credentials=credentials)
-        
-        # Get data for both periods
-        current_period = await analyze_data(
-            file=file,
-            start_date=current_start_date,
-            end_date=current_end_date,
-            exclude_regex=exclude_regex,
-            site_url=site_url
+        # Calculate changes
+        changes = period_changes(previous_period, current_period)
+        changes["queries"] = compare_queries(
+            previous_frame,
+            current_frame,
+            clicks_threshold=clicks_threshold,
+            position_threshold=position_threshold,
+            limit=query_limit
         )
         
-        previous_period = await analyze_data(
-            file=file,
-            start_date=previous_start_date,
-            end_date=previous_end_date,
-            exclude_regex=exclude_regex,
-            site_url=site_url
+        current_period, previous_period = await asyncio.gather(
+            asyncio.to_thread(store_result, current_period, current_frame, site_url, current_start_date, current_end_date),
+            asyncio.to_thread(store_result, previous_period, previous_frame, site_url, previous_start_date, previous_end_date)
         )
-        
-        # Calculate changes
-        changes = {
-            "non_brand": {
-                "clicks_change": calculate_percentage_change(
-                    previous_period["non_brand_clicks"],
-                    current_period["non_brand_clicks"]
-                ),
-                "ctr_change": calculate_percentage_change(
-                    previous_period["non_brand_ctr"],
-                    current_period["non_brand_ctr"]
-                ),
-                "position_change": previous_period["non_brand_avg_position"] - current_period["non_brand_avg_position"]
-            },
-            "brand": {
-                "clicks_change": calculate_percentage_change(
-                    previous_period["brand_clicks"],
-                    current_period["brand_clicks"]
-                ),
-                "ctr_change": calculate_percentage_change(
-                    previous_period["brand_ctr"],
-                    current_period["brand_ctr"]
-                ),
-                "position_change": previous_period["brand_avg_position"] - current_period["brand_avg_position"]
-            },
-            "queries": compare_queries(
-                previous_period["all_non_brand_queries"] + previous_period["all_brand_queries"],
-                current_period["all_non_brand_queries"] + current_period["all_brand_queries"]
-            )
-        }
-        
-        return {
+        content = {
             "current_period": current_period,
             "previous_period": previous_period,
             "changes": changes
         }
+
+        # Syncing the row store may have changed the data version
+        response_etag = await etag()
+        remember_etag(response_etag, [current_period["result_id"], previous_period["result_id"]])
+        return TimedJSONResponse(content, headers={"ETag": response_etag})
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logging.error(f"Error in compare_periods: {str(e)}")
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
+@app.get("/results/{result_id}")
+async def get_result_summary(result_id: str, request: Request):
+    """Summary of a stored analysis; stored results never change, so clients revalidate it with If-None-Match."""
+    result = get_result(result_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+    etag = result_etag(result_id)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return TimedJSONResponse(result.summary, headers={"ETag": etag})
+
+@app.get("/results/{result_id}/export.csv")
+async def export_csv(result_id: str, summary: bool = True):
+    """Stream every query of a stored analysis as CSV."""
+    result = get_result(result_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+
+    return StreamingResponse(
+        iter_csv(result, include_summary=summary),
+        media_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="queryscope_analysis.csv"'}
+    )
+
+@app.get("/results/{result_id}/queries")
+async def list_result_queries(
+    result_id: str,
+    sort: str = 'clicks',
+    order: str = 'desc',
+    segment: str = 'all',
+    q: str = '',
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """Page through the queries of a stored analysis, sorted and filtered server-side."""
+    result = get_result(result_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+    if sort not in SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"Invalid sort key. Use one of: {', '.join(SORT_KEYS)}")
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail="Invalid order. Use asc or desc")
+    if segment not in SEGMENTS:
+        raise HTTPException(status_code=400, detail=f"Invalid segment. Use one of: {', '.join(SEGMENTS)}")
+
+    try:
+        offset = decode_cursor(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    view_key = (sort, order == 'desc', segment, q.strip())
+    view = result.cached_view(*view_key)
+    if view is None:
+        # Filtering scans every query; keep it off the event loop
+        view = await asyncio.to_thread(result.query_view, *view_key)
+    next_offset = offset + limit
+    return {
+        "items": result.query_page(view, offset, limit),
+        "total": len(view),
+        "next_cursor": encode_cursor(next_offset) if next_offset < len(view) else None
+    }
+
+@app.post("/rollups/register")
+async def register_rollups(
+    file: UploadFile = File(...),
+    site_url: str = Form(...),
+    exclude_regex: str = Form(...),
+    match_mode: str = Form('keywords')
+):
+    """
+    Maintain daily brand/non-brand rollups of a property for one brand pattern.
+    The key is kept in memory to refresh them once a day, until DELETE /rollups/register.
+    """
+    if rollup_refresher is None:
+        raise HTTPException(status_code=404, detail="Rollups are disabled")
+    validate_analysis_options(exclude_regex, match_mode, 'auto')
+
+    json_key = await read_json_key(file)
+    _, matched_site_url = await open_site(json_key, site_url)
+
+    rollup_refresher.register(json_key, matched_site_url, exclude_regex, match_mode)
+    logger.info(f"Registered rollups for {matched_site_url}")
+    return {"site_url": matched_site_url, "exclude_regex": exclude_regex, "match_mode": match_mode}
+
+@app.delete("/rollups/register")
+async def unregister_rollups(
+    file: UploadFile = File(...),
+    site_url: str = Form(...),
+    exclude_regex: str = Form(...),
+    match_mode: str = Form('keywords')
+):
+    """
+    Stop maintaining a property's rollups: its key is dropped from memory and
+    its stored rollups deleted. Only the key it was registered with can do this;
+    the key is compared locally, so it works even after being revoked.
+    """
+    if rollup_refresher is None:
+        raise HTTPException(status_code=404, detail="Rollups are disabled")
+
+    json_key = await read_json_key(file)
+    domain = get_base_domain(site_url)
+    registrations = [
+        registration for registration in rollup_refresher.registrations(json_key)
+        if get_base_domain(registration[0]) == domain and registration[1:] == (exclude_regex, match_mode)
+    ]
+    if not registrations:
+        raise HTTPException(status_code=404, detail="No rollups registered for this property, pattern and key")
+
+    for registration in registrations:
+        deleted = await rollup_refresher.unregister(registration)
+        logger.info(f"Unregistered rollups for {registration[0]} ({deleted} rows deleted)")
+    return {"site_url": registrations[0][0], "exclude_regex": exclude_regex, "match_mode": match_mode, "unregistered": True}
+
+@app.post("/store/invalidate")
+async def invalidate_store(
+    file: UploadFile = File(...),
+    site_url: str = Form(...)
+):
+    """Drop the locally stored rows of a site the uploaded key has access to."""
+    if row_store is None:
+        raise HTTPException(status_code=404, detail="Row store is disabled")
+
+    json_key = await read_json_key(file)
+    _, matched_site_url = await open_site(json_key, site_url)
+
+    deleted_rows = await asyncio.to_thread(row_store.invalidate, matched_site_url)
+    return {"site_url": matched_site_url, "deleted_rows": deleted_rows}
+
+@app.get("/stats")
+async def get_stats():
+    """Expose in-process cache counters."""
+    return {
+        "session_cache": session_cache.stats(),
+        "site_cache": site_cache.stats(),
+        "result_store": result_store.stats(),
+        "jobs": job_manager.stats(),
+        "query_scheduler": query_scheduler.stats(),
+        "fuzzy_memo": memo_budget.stats(),
+        "row_store": await asyncio.to_thread(row_store.stats) if row_store is not None else None,
+        "rollups": await asyncio.to_thread(rollup_refresher.stats) if rollup_refresher is not None else None
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics, including the per-phase timing histograms."""
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+def period_changes(previous_period: dict, current_period: dict) -> dict:
+    """Click, CTR and position changes of each segment between two period summaries."""
+    return {
+        segment: {
+            "clicks_change": calculate_percentage_change(
+                previous_period[f"{segment}_clicks"],
+                current_period[f"{segment}_clicks"]
+            ),
+            "ctr_change": calculate_percentage_change(
+                previous_period[f"{segment}_ctr"],
+                current_period[f"{segment}_ctr"]
+            ),
+            "position_change": previous_period[f"{segment}_avg_position"] - current_period[f"{segment}_avg_position"]
+        }
+        for segment in ("non_brand", "brand")
+    }
+
 def calculate_percentage_change(old_value: float, new_value: float) -> float:
     """Calculate percentage change between two values."""
     if old_value == 0:
         return 100 if new_value > 0 else 0
     return ((new_value - old_value) / old_value) * 100
 
-def compare_queries(previous_queries: List[dict], current_queries: List[dict]) -> List[dict]:
-    """Compare queries between two periods and identify significant changes."""
-    query_changes = []
-    
-    # Create dictionaries for easy lookup
-    previous_dict = {q["query"]: q for q in previous_queries}
-    current_dict = {q["query"]: q for q in current_queries}
-    
-    # Find all unique queries
-    all_queries = set(previous_dict.keys()) | set(current_dict.keys())
-    
-    for query in all_queries:
-        prev = previous_dict.get(query, {"clicks": 0, "impressions": 0, "ctr": 0, "position": 0})
-        curr = current_dict.get(query, {"clicks": 0, "impressions": 0, "ctr": 0, "position": 0})
-        
-        clicks_change = calculate_percentage_change(prev["clicks"], curr["clicks"])
-        position_change = prev["position"] - curr["position"] if prev["position"] and curr["position"] else 0
-        
-        # Only include significant changes
-        if abs(clicks_change) > 10 or abs(position_change) > 0.5:
-            query_changes.append({
-                "query": query,
-                "clicks_change": clicks_change,
-                "position_change": position_change,
-                "current": curr,
-                "previous": prev
-            })
-    
-    # Sort by absolute click change
-    query_changes.sort(key=lambda x: abs(x["clicks_change"]), reverse=True)
-    return query_changes[:100]  # Return top 100 most significant changes
-
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
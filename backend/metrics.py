@@ -0,0 +1,64 @@
+"""
+Per-phase timing spans.
+
+Each span is observed in a Prometheus histogram (served at /metrics) and
+added to the current request's timings, which the middleware returns in a
+Server-Timing header.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.responses import ORJSONResponse
+from prometheus_client import Histogram
+
+PHASE_SECONDS = Histogram(
+    'queryscope_phase_seconds',
+    'Time spent in each analysis phase',
+    ['phase'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+# phase -> [total seconds, count] for the request being served
+_request_timings = ContextVar('request_timings', default=None)
+
+
+def start_request_timings() -> dict:
+    """Start collecting spans for the current request; returns the collector."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def span(phase: str):
+    """Time a block of code as one occurrence of `phase`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        PHASE_SECONDS.labels(phase).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            entry = timings.setdefault(phase, [0.0, 0])
+            entry[0] += elapsed
+            entry[1] += 1
+
+
+def server_timing_header(timings: dict, total: float) -> str:
+    """Server-Timing value; repeated phases (e.g. concurrent pages) are summed."""
+    metrics = [
+        f'{phase};dur={seconds * 1000:.1f}' + (f';desc="{count}x"' if count > 1 else '')
+        for phase, (seconds, count) in timings.items()
+    ]
+    metrics.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(metrics)
+
+
+class TimedJSONResponse(ORJSONResponse):
+    """orjson-encoded JSON response that records its rendering time as the 'serialization' phase."""
+
+    def render(self, content) -> bytes:
+        with span('serialization'):
+            return super().render(content)
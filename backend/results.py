@@ -0,0 +1,242 @@
+"""
+Analysis results kept in memory under a result ID.
+
+/analyze returns only the summary and top-N lists; the full per-query data
+stays here and is served by the export endpoints.
+"""
+import base64
+import csv
+import hashlib
+import io
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from cache import TTLCache
+from metrics import span
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "64"))
+RESULT_TTL = int(os.getenv("RESULT_TTL", "3600"))
+# Memory held by stored results, estimated from their frames and indexes
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", str(1024 ** 3)))
+# Without a row store to date the data, results are revalidated for this long
+DATA_VERSION_SECONDS = int(os.getenv("DATA_VERSION_SECONDS", "3600"))
+# Number of CSV rows serialized per streamed chunk
+CSV_CHUNK_ROWS = 5000
+# Filtered/sorted views kept per result for the paginated query table
+QUERY_VIEW_CACHE_SIZE = 32
+
+SORT_KEYS = ['clicks', 'impressions', 'ctr', 'position']
+SEGMENTS = ['all', 'brand', 'non_brand']
+# Columns of a query table page
+PAGE_COLUMNS = ('query', 'is_brand', 'clicks', 'impressions', 'ctr', 'position')
+
+result_store = TTLCache(RESULT_CACHE_SIZE, RESULT_TTL, maxbytes=RESULT_CACHE_BYTES, sizeof=lambda result: result.nbytes())
+# ETag -> IDs of the results its response refers to
+etag_store = TTLCache(RESULT_CACHE_SIZE, RESULT_TTL)
+
+
+class AnalysisResult:
+    """
+    Summary metrics plus the per-query frame of one analysis.
+
+    The sort orders behind the paginated query table are built up front, off
+    the event loop, so a first page costs no more than the next.
+    """
+
+    def __init__(self, summary: dict, frame: pd.DataFrame, site_url: str, start_date: str, end_date: str):
+        self.summary = summary
+        # Brand queries first, then non-brand, each ordered by clicks
+        self.frame = frame.sort_values(['is_brand', 'clicks'], ascending=[False, False], kind='stable')
+        self.site_url = site_url
+        self.start_date = start_date
+        self.end_date = end_date
+        self._columns = {name: np.asarray(self.frame[name]) for name in PAGE_COLUMNS}
+        # Row positions of the whole frame ordered by each sort key, both ways
+        self._sort_indexes = {}
+        for sort in SORT_KEYS:
+            values = self._columns[sort]
+            self._sort_indexes[(sort, False)] = np.argsort(values, kind='stable')
+            self._sort_indexes[(sort, True)] = np.argsort(-values, kind='stable')
+        self._views = OrderedDict()
+        # Views are built in worker threads and looked up on the event loop
+        self._views_lock = threading.Lock()
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the result: the frame, strings included, and what was built from it."""
+        return int(
+            self.frame.memory_usage(deep=True).sum()
+            + self._columns['query'].nbytes
+            + sum(index.nbytes for index in self._sort_indexes.values())
+        )
+
+    def cached_view(self, sort: str, descending: bool, segment: str, search: str):
+        """A view already built by query_view, or None."""
+        key = (sort, descending, segment, search)
+        with self._views_lock:
+            view = self._views.get(key)
+            if view is not None:
+                self._views.move_to_end(key)
+            return view
+
+    def query_view(self, sort: str, descending: bool, segment: str, search: str) -> np.ndarray:
+        """
+        Row positions matching a segment and substring filter, in sort order.
+        Views are cached so following pages are plain slices. A substring
+        filter scans every query; call this off the event loop when the view
+        is not cached.
+        """
+        view = self.cached_view(sort, descending, segment, search)
+        if view is not None:
+            return view
+
+        index = self._sort_indexes[(sort, descending)]
+        mask = np.ones(len(self.frame), dtype=bool)
+        if segment != 'all':
+            mask &= self._columns['is_brand'] == (segment == 'brand')
+        if search:
+            # Queries are lowercased when they are folded
+            mask &= self.frame['query'].str.contains(search.lower(), regex=False).to_numpy(dtype=bool)
+        view = index[mask[index]]
+
+        with self._views_lock:
+            self._views[(sort, descending, segment, search)] = view
+            while len(self._views) > QUERY_VIEW_CACHE_SIZE:
+                self._views.popitem(last=False)
+        return view
+
+    def query_page(self, view: np.ndarray, offset: int, limit: int) -> list:
+        rows = view[offset:offset + limit]
+        return [
+            {
+                'query': query,
+                'segment': 'brand' if is_brand else 'non_brand',
+                'clicks': int(clicks),
+                'impressions': int(impressions),
+                'ctr': float(ctr),
+                'position': float(position)
+            }
+            for query, is_brand, clicks, impressions, ctr, position in zip(
+                *(self._columns[name][rows] for name in PAGE_COLUMNS)
+            )
+        ]
+
+
+def save_result(result: AnalysisResult) -> str:
+    result_id = uuid.uuid4().hex
+    result_store.set(result_id, result)
+    return result_id
+
+
+def get_result(result_id: str):
+    return result_store.get(result_id)
+
+
+def result_etag(*parts) -> str:
+    """
+    Weak ETag of a response built from `parts` (request options and data
+    version); weak because the same entity is sent gzip- or brotli-encoded.
+    """
+    digest = hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+
+def remember_etag(etag: str, result_ids: list):
+    etag_store.set(etag, list(result_ids))
+
+
+def etag_is_current(etag: str) -> bool:
+    """True while every result the ETag's response refers to is still stored."""
+    result_ids = etag_store.get(etag)
+    return result_ids is not None and all(result_store.get(result_id) is not None for result_id in result_ids)
+
+
+def encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(f"o:{offset}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    """Offset encoded in an opaque page cursor; raises ValueError when malformed."""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    prefix, _, offset = base64.urlsafe_b64decode(padded.encode()).decode().partition(':')
+    if prefix != 'o' or not offset.isdigit():
+        raise ValueError("Invalid cursor")
+    return int(offset)
+
+
+def _summary_rows(result: AnalysisResult) -> list:
+    s = result.summary
+    total_impressions = s['total_impressions']
+    segment_impressions = s['brand_impressions'] + s['non_brand_impressions']
+    position_sum = s['brand_avg_position'] * s['brand_impressions'] + s['non_brand_avg_position'] * s['non_brand_impressions']
+    brand_and_non_brand_clicks = s['brand_clicks'] + s['non_brand_clicks']
+    return [
+        ["SEO Performance Analysis - Complete Query Data"],
+        [f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"],
+        [f"Website: {result.site_url}"],
+        [f"Period: {result.start_date} to {result.end_date}"],
+        [],
+        ["Overall Metrics"],
+        ["Total Clicks (including unattributed)", s['total_all_clicks']],
+        ["Unattributed Clicks", s['unattributed_clicks']],
+        ["Total Impressions", total_impressions],
+        ["Average CTR", f"{(brand_and_non_brand_clicks / total_impressions * 100 if total_impressions > 0 else 0):.2f}%"],
+        ["Average Position", f"{(position_sum / segment_impressions if segment_impressions > 0 else 0):.1f}"],
+        [],
+        ["Brand vs Non-Brand Summary"],
+        ["Type", "Clicks", "Impressions", "CTR", "Average Position", "Share of Voice"],
+        ["Brand", s['brand_clicks'], s['brand_impressions'], f"{s['brand_ctr']:.2f}%",
+         f"{s['brand_avg_position']:.1f}", f"{s['brand_percentage']:.1f}%"],
+        ["Non-Brand", s['non_brand_clicks'], s['non_brand_impressions'], f"{s['non_brand_ctr']:.2f}%",
+         f"{s['non_brand_avg_position']:.1f}", f"{s['non_brand_percentage']:.1f}%"],
+        ["Unattributed", s['unattributed_clicks'], "N/A", "N/A", "N/A", f"{s['unattributed_percentage']:.1f}%"],
+        [],
+        ["Complete Query Analysis"],
+    ]
+
+
+def iter_csv(result: AnalysisResult, include_summary: bool = True):
+    """Yield the CSV export in chunks; queries are quoted by the csv writer as needed."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def flush():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return chunk
+
+    # Byte order mark, so Excel opens the file as UTF-8 (accented queries)
+    buffer.write('\ufeff')
+    if include_summary:
+        writer.writerows(_summary_rows(result))
+    writer.writerow(["Type", "Query", "Clicks", "Impressions", "CTR", "Position", "Click Share", "Impression Share"])
+    yield flush()
+
+    frame = result.frame
+    for start in range(0, len(frame), CSV_CHUNK_ROWS):
+        chunk = frame.iloc[start:start + CSV_CHUNK_ROWS]
+        with span('serialization'):
+            writer.writerows(
+                (
+                    "Brand" if is_brand else "Non-Brand",
+                    query,
+                    clicks,
+                    impressions,
+                    f"{ctr:.2f}%",
+                    f"{position:.1f}",
+                    f"{click_share:.2f}%",
+                    f"{impression_share:.2f}%"
+                )
+                for is_brand, query, clicks, impressions, ctr, position, click_share, impression_share in zip(
+                    chunk['is_brand'], chunk['query'], chunk['clicks'], chunk['impressions'],
+                    chunk['ctr'], chunk['position'], chunk['click_share'], chunk['impression_share']
+                )
+            )
+        yield flush()
@@ -0,0 +1,339 @@
+"""
+Materialized daily brand/non-brand rollups of registered properties.
+
+For every registered (property, brand pattern) pair, a background task keeps
+one row per day with the property-level clicks and the clicks, impressions
+and position sums of the brand and non-brand segments. Summary metrics of any
+date range are sums over those rows, so /analyze and /compare can answer
+them without query-level data.
+
+This is the one place in the backend where service account keys are kept
+after the request that brought them: every other path exchanges the key for
+a bearer token and drops it. Keys of registered properties are held in
+memory only, for at most ROLLUP_MAX_REGISTRATIONS properties, until they are
+unregistered (DELETE /rollups/register) or the process restarts; after a
+restart, properties must be registered again to keep their rollups fresh.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+
+from analysis import fetch_period, segment_summary
+from classifier import get_classifier
+from fetch import fetch_rows
+from gsc import get_session, key_fingerprint
+from sqlite_store import SQLiteStore, contiguous_ranges, date_range
+from store import ROW_STORE_PROVISIONAL_DAYS
+
+logger = logging.getLogger(__name__)
+
+# Path of the SQLite database; rollups are disabled when empty
+ROLLUP_STORE_PATH = os.getenv("ROLLUP_STORE_PATH", "")
+# Seconds between two refreshes of every registered property
+ROLLUP_REFRESH_INTERVAL = int(os.getenv("ROLLUP_REFRESH_INTERVAL", str(24 * 3600)))
+# Days kept per property, counted back from yesterday (Search Console keeps 16 months)
+ROLLUP_BACKFILL_DAYS = int(os.getenv("ROLLUP_BACKFILL_DAYS", "486"))
+# Registered properties, and so service account keys held in memory, at most
+ROLLUP_MAX_REGISTRATIONS = int(os.getenv("ROLLUP_MAX_REGISTRATIONS", "100"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    site_url TEXT NOT NULL,
+    pattern TEXT NOT NULL,
+    match_mode TEXT NOT NULL,
+    date TEXT NOT NULL,
+    final INTEGER NOT NULL,
+    total_clicks INTEGER NOT NULL,
+    brand_clicks INTEGER NOT NULL,
+    brand_impressions INTEGER NOT NULL,
+    brand_position_sum REAL NOT NULL,
+    non_brand_clicks INTEGER NOT NULL,
+    non_brand_impressions INTEGER NOT NULL,
+    non_brand_position_sum REAL NOT NULL,
+    refreshed_at REAL NOT NULL,
+    PRIMARY KEY (site_url, pattern, match_mode, date)
+) WITHOUT ROWID;
+"""
+
+
+def _segment(clicks: int, impressions: int, position_sum: float) -> dict:
+    return {
+        'clicks': clicks,
+        'impressions': impressions,
+        'position_sum': position_sum,
+        'ctr': (clicks / impressions * 100) if impressions > 0 else 0,
+        'avg_position': (position_sum / impressions) if impressions > 0 else 0
+    }
+
+
+class RollupStore(SQLiteStore):
+    """One row of brand/non-brand totals per day, property and brand pattern."""
+
+    SCHEMA = SCHEMA
+
+    def stale_days(self, site_url: str, pattern: str, match_mode: str, start_date: str, end_date: str) -> list:
+        """Days in the range without a final rollup."""
+        with self._connect() as conn:
+            final_days = {
+                row[0] for row in conn.execute(
+                    "SELECT date FROM daily_rollups "
+                    "WHERE site_url = ? AND pattern = ? AND match_mode = ? AND date BETWEEN ? AND ? AND final = 1",
+                    (site_url, pattern, match_mode, start_date, end_date)
+                )
+            }
+        return [day for day in date_range(start_date, end_date) if day not in final_days]
+
+    def save_days(self, site_url: str, pattern: str, match_mode: str, days: list, totals: list, daily: list):
+        """
+        Replace the rollups of `days`. `totals` are API rows keyed by [date];
+        `daily` are date rollups as returned by QueryAccumulator.rollups().
+        Days without data are stored as zeros.
+        """
+        provisional_from = (datetime.now() - timedelta(days=ROW_STORE_PROVISIONAL_DAYS)).strftime("%Y-%m-%d")
+        refreshed_at = time.time()
+        total_clicks = {row['keys'][0]: row.get('clicks', 0) for row in totals}
+        segments = {entry['date']: entry for entry in daily}
+        rows = []
+        for day in days:
+            entry = segments.get(day)
+            if entry is None:
+                brand, non_brand = (0, 0, 0.0), (0, 0, 0.0)
+            else:
+                brand = (
+                    entry['brand_clicks'], entry['brand_impressions'],
+                    entry['brand_avg_position'] * entry['brand_impressions']
+                )
+                non_brand = (
+                    entry['non_brand_clicks'], entry['non_brand_impressions'],
+                    entry['non_brand_avg_position'] * entry['non_brand_impressions']
+                )
+            rows.append((
+                site_url, pattern, match_mode, day, int(day < provisional_from),
+                total_clicks.get(day, 0), *brand, *non_brand, refreshed_at
+            ))
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO daily_rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def period(self, site_url: str, pattern: str, match_mode: str, start_date: str, end_date: str):
+        """
+        (total clicks, segment totals, daily brand share trend) of the range,
+        or None when any day of it has no rollup.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                """
+                SELECT date, total_clicks, brand_clicks, brand_impressions, brand_position_sum,
+                       non_brand_clicks, non_brand_impressions, non_brand_position_sum
+                FROM daily_rollups
+                WHERE site_url = ? AND pattern = ? AND match_mode = ? AND date BETWEEN ? AND ?
+                ORDER BY date
+                """,
+                (site_url, pattern, match_mode, start_date, end_date)
+            ).fetchall()
+        if len(rows) < len(date_range(start_date, end_date)):
+            return None
+
+        columns = list(zip(*rows))
+        totals = {
+            'brand': _segment(sum(columns[2]), sum(columns[3]), sum(columns[4])),
+            'non_brand': _segment(sum(columns[5]), sum(columns[6]), sum(columns[7]))
+        }
+        trend = []
+        for day, _, brand_clicks, brand_impressions, brand_position_sum, \
+                non_brand_clicks, non_brand_impressions, non_brand_position_sum in rows:
+            clicks = brand_clicks + non_brand_clicks
+            trend.append({
+                "date": day,
+                "brand_clicks": brand_clicks,
+                "non_brand_clicks": non_brand_clicks,
+                "brand_impressions": brand_impressions,
+                "non_brand_impressions": non_brand_impressions,
+                "brand_share": (brand_clicks / clicks * 100) if clicks > 0 else 0.0,
+                "brand_avg_position": (brand_position_sum / brand_impressions) if brand_impressions > 0 else 0.0,
+                "non_brand_avg_position": (
+                    non_brand_position_sum / non_brand_impressions if non_brand_impressions > 0 else 0.0
+                )
+            })
+        return sum(columns[1]), totals, trend
+
+    def version(self, site_url: str, pattern: str, match_mode: str, start_date: str, end_date: str):
+        """Refresh time of the most recently stored day of the range, or None when there is none."""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT MAX(refreshed_at) FROM daily_rollups "
+                "WHERE site_url = ? AND pattern = ? AND match_mode = ? AND date BETWEEN ? AND ?",
+                (site_url, pattern, match_mode, start_date, end_date)
+            ).fetchone()[0]
+
+    def delete(self, site_url: str, pattern: str, match_mode: str) -> int:
+        """Drop every stored day of a property and pattern. Returns the number of rows deleted."""
+        with self._connect() as conn:
+            return conn.execute(
+                "DELETE FROM daily_rollups WHERE site_url = ? AND pattern = ? AND match_mode = ?",
+                (site_url, pattern, match_mode)
+            ).rowcount
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            rows, properties = conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT site_url || ' ' || pattern || ' ' || match_mode) FROM daily_rollups"
+            ).fetchone()
+        return {"rows": rows, "properties": properties}
+
+
+rollup_store = RollupStore(ROLLUP_STORE_PATH) if ROLLUP_STORE_PATH else None
+
+
+async def refresh_rollups(
+    store: RollupStore,
+    session,
+    site_url: str,
+    pattern: str,
+    match_mode: str,
+    backfill_days: int = ROLLUP_BACKFILL_DAYS
+) -> int:
+    """Fetch and store the rollups of every stale day in the backfill window. Returns the number of days refreshed."""
+    end = datetime.now() - timedelta(days=1)
+    start_date = (end - timedelta(days=backfill_days - 1)).strftime("%Y-%m-%d")
+    end_date = end.strftime("%Y-%m-%d")
+    stale = await asyncio.to_thread(store.stale_days, site_url, pattern, match_mode, start_date, end_date)
+    classifier = get_classifier(pattern, match_mode)
+
+    for range_start, range_end in contiguous_ranges(stale):
+        logger.info(f"Refreshing rollups of {site_url} {range_start}..{range_end}")
+        try:
+            (_, accumulator), totals = await asyncio.gather(
+                fetch_period(session, site_url, range_start, range_end, classifier, dimensions=('date',)),
+                fetch_rows(session, site_url, range_start, range_end, dimensions=['date'], shard='none')
+            )
+            daily = accumulator.rollups()['date']
+        except HTTPException as he:
+            if he.status_code != 404:
+                raise
+            # No data for the whole range (e.g. a new property): stored as zeros
+            totals, daily = [], []
+        await asyncio.to_thread(
+            store.save_days, site_url, pattern, match_mode, date_range(range_start, range_end), totals, daily
+        )
+    return len(stale)
+
+
+async def rollup_summary(site_url: str, pattern: str, match_mode: str, start_date: str, end_date: str):
+    """
+    Summary metrics and daily brand share trend of a period from the rollups,
+    or None when they do not cover it.
+    """
+    if rollup_store is None:
+        return None
+    period = await asyncio.to_thread(rollup_store.period, site_url, pattern, match_mode, start_date, end_date)
+    if period is None:
+        return None
+    total_gsc_clicks, totals, trend = period
+    summary = segment_summary(totals, total_gsc_clicks)
+    summary["rollups"] = {"date": trend}
+    summary["source"] = "rollups"
+    return summary
+
+
+async def rollup_version(site_url: str, pattern: str, match_mode: str, start_date: str, end_date: str) -> str:
+    """Version of the rollups behind a period, for ETags of answers rollup_summary may serve."""
+    if rollup_store is None:
+        return None
+    refreshed_at = await asyncio.to_thread(rollup_store.version, site_url, pattern, match_mode, start_date, end_date)
+    return f"rollups:{refreshed_at}" if refreshed_at is not None else None
+
+
+class RollupRefresher:
+    """Registered properties, refreshed in the background every `interval` seconds."""
+
+    def __init__(self, store: RollupStore, interval: int = ROLLUP_REFRESH_INTERVAL, max_registrations: int = ROLLUP_MAX_REGISTRATIONS):
+        self.store = store
+        self.interval = interval
+        self.max_registrations = max_registrations
+        # (site_url, pattern, match_mode) -> service account key, never persisted
+        self._keys = {}
+        self._status = {}
+        self._locks = {}
+        self._tasks = set()
+        self._loop_task = None
+
+    def register(self, json_key: dict, site_url: str, pattern: str, match_mode: str):
+        """Keep a property's rollups fresh from now on, starting with a refresh."""
+        registration = (site_url, pattern, match_mode)
+        if registration not in self._keys and len(self._keys) >= self.max_registrations:
+            raise HTTPException(
+                status_code=409,
+                detail=f"The limit of {self.max_registrations} registered properties is reached; unregister one first"
+            )
+        self._keys[registration] = json_key
+        self._status.setdefault(registration, {"last_refresh": None, "error": None})
+        task = asyncio.create_task(self.refresh(registration))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def registrations(self, json_key: dict) -> list:
+        """Registrations made with this service account key."""
+        fingerprint = key_fingerprint(json_key)
+        return [registration for registration, key in self._keys.items() if key_fingerprint(key) == fingerprint]
+
+    async def unregister(self, registration: tuple) -> int:
+        """
+        Forget a registration and its key, then drop its stored rollups, which
+        would otherwise go stale. Returns the number of rollup rows deleted.
+        """
+        self._keys.pop(registration, None)
+        self._status.pop(registration, None)
+        # Wait for a refresh in progress so it cannot store rows after the delete
+        async with self._locks.setdefault(registration, asyncio.Lock()):
+            deleted = await asyncio.to_thread(self.store.delete, *registration)
+        self._locks.pop(registration, None)
+        return deleted
+
+    async def refresh(self, registration: tuple):
+        site_url, pattern, match_mode = registration
+        lock = self._locks.setdefault(registration, asyncio.Lock())
+        async with lock:
+            if registration not in self._keys:
+                # Unregistered while this refresh was waiting
+                return
+            status = self._status[registration]
+            try:
+                session = await get_session(self._keys[registration])
+                days = await refresh_rollups(self.store, session, site_url, pattern, match_mode)
+                status.update(last_refresh=time.time(), error=None)
+                logger.info(f"Rollups of {site_url} refreshed ({days} days)")
+            except Exception as e:
+                status["error"] = str(e.detail if isinstance(e, HTTPException) else e)
+                logger.error(f"Rollup refresh failed for {site_url}: {status['error']}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for registration in list(self._keys):
+                await self.refresh(registration)
+
+    def start(self):
+        self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in [self._loop_task, *self._tasks]:
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*self._tasks, *filter(None, [self._loop_task]), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            **self.store.stats(),
+            "max_registrations": self.max_registrations,
+            # Counts only: /stats is unauthenticated, and sites and brand patterns are client data
+            "registered": len(self._keys),
+            "failing": sum(1 for status in self._status.values() if status["error"] is not None),
+            "never_refreshed": sum(1 for status in self._status.values() if status["last_refresh"] is None)
+        }
+
+
+rollup_refresher = RollupRefresher(rollup_store) if rollup_store is not None else None
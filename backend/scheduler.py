@@ -0,0 +1,154 @@
+"""
+Central scheduler for Search Console searchanalytics.query calls.
+
+Every query is paced by token buckets (one per service account, one per
+property whichever key queries it), retried with exponential backoff and full jitter on 429 and 5xx
+responses, and coalesced with identical in-flight queries so concurrent
+requests for the same data make a single upstream call.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+from googleapiclient.errors import HttpError
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Sustained queries per second allowed per service account and per property
+# (Search Console allows 1,200 queries per minute for each); bursts of up to
+# one second's worth of tokens go through immediately
+GSC_KEY_QPS = float(os.getenv("GSC_KEY_QPS", "20"))
+GSC_SITE_QPS = float(os.getenv("GSC_SITE_QPS", "20"))
+# Retries after a 429 or 5xx response, with exponential backoff and full jitter
+GSC_MAX_RETRIES = int(os.getenv("GSC_MAX_RETRIES", "5"))
+GSC_BACKOFF_BASE = float(os.getenv("GSC_BACKOFF_BASE", "1"))
+GSC_BACKOFF_MAX = float(os.getenv("GSC_BACKOFF_MAX", "32"))
+
+BUCKET_CACHE_SIZE = 4096
+BUCKET_TTL = 3600
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of rejecting callers."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take one token and return how many seconds to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, HttpError) and (error.resp.status == 429 or error.resp.status >= 500)
+
+
+def backoff_delay(attempt: int, error: Exception = None) -> float:
+    """Full-jitter exponential backoff, honouring a Retry-After header when present."""
+    retry_after = error.resp.get('retry-after') if isinstance(error, HttpError) else None
+    if retry_after and str(retry_after).isdigit():
+        return min(GSC_BACKOFF_MAX, float(retry_after))
+    return random.uniform(0, min(GSC_BACKOFF_MAX, GSC_BACKOFF_BASE * 2 ** attempt))
+
+
+class QueryScheduler:
+    """Rate limits, retries and coalesces searchanalytics.query calls."""
+
+    def __init__(self, key_qps: float = GSC_KEY_QPS, site_qps: float = GSC_SITE_QPS, max_retries: int = GSC_MAX_RETRIES):
+        self.key_qps = key_qps
+        self.site_qps = site_qps
+        self.max_retries = max_retries
+        self._buckets = TTLCache(BUCKET_CACHE_SIZE, BUCKET_TTL)
+        self._inflight = {}
+        self.waiting = 0
+        self.running = 0
+        self.calls = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _bucket(self, key, rate: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate)
+            self._buckets.set(key, bucket)
+        return bucket
+
+    async def _acquire(self, account: str, site_url: str):
+        delay = max(
+            self._bucket(('key', account), self.key_qps).reserve(),
+            # The property quota is shared by every key that can read it
+            self._bucket(('site', site_url), self.site_qps).reserve()
+        )
+        if delay > 0:
+            self.throttled += 1
+            self.waiting += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.waiting -= 1
+
+    async def _call(self, account: str, site_url: str, call):
+        attempt = 0
+        while True:
+            await self._acquire(account, site_url)
+            self.calls += 1
+            self.running += 1
+            try:
+                return await call()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    self.failures += 1
+                    raise
+                delay = backoff_delay(attempt, e)
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"Search Console returned {e.resp.status} for {site_url}, retry {attempt} in {delay:.1f}s")
+            finally:
+                self.running -= 1
+            await asyncio.sleep(delay)
+
+    async def submit(self, account: str, site_url: str, body: dict, call):
+        """
+        Run `call()` (a coroutine function performing the query) under the rate
+        limits. Identical queries of the same account already in flight share
+        its result instead of calling the API again.
+        """
+        key = (account, site_url, json.dumps(body, sort_keys=True))
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._call(account, site_url, call))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded so one caller going away does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.waiting,
+            "in_flight": self.running,
+            "coalescing": len(self._inflight),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "failures": self.failures
+        }
+
+
+query_scheduler = QueryScheduler()
@@ -0,0 +1,47 @@
+"""
+Common ground of the SQLite-backed stores (store.RowStore, rollups.RollupStore):
+connection set-up and the day-range helpers both use to track stored days.
+"""
+import sqlite3
+from datetime import datetime, timedelta
+from typing import List
+
+
+def date_range(start_date: str, end_date: str) -> List[str]:
+    """Every YYYY-MM-DD day of an inclusive range."""
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    return [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end - start).days + 1)]
+
+
+def contiguous_ranges(days: List[str]) -> List[tuple]:
+    """Group sorted YYYY-MM-DD strings into inclusive (start, end) runs."""
+    ranges = []
+    for day in days:
+        if ranges:
+            previous = datetime.strptime(ranges[-1][1], "%Y-%m-%d")
+            if datetime.strptime(day, "%Y-%m-%d") - previous == timedelta(days=1):
+                ranges[-1] = (ranges[-1][0], day)
+                continue
+        ranges.append((day, day))
+    return ranges
+
+
+class SQLiteStore:
+    """Base of the SQLite-backed stores; every method is blocking and opens its own connection."""
+
+    # Tables and indexes, created when missing
+    SCHEMA = ""
+    # Pragmas applied before the schema, e.g. ones that only work on an empty database
+    PRAGMAS = ()
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            for pragma in self.PRAGMAS:
+                conn.execute(f"PRAGMA {pragma}")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
@@ -0,0 +1,312 @@
+"""
+Persistent local store of raw per-day, per-query Search Console rows.
+
+Analyses are answered from SQLite; only the days that are not stored yet are
+fetched from the API. Recent days are still being updated by Google, so they
+are kept as provisional and fetched again until they are old enough.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from fetch import GSC_FETCH_CONCURRENCY, fetch_rows, fetch_shard, plan_fetch
+from sqlite_store import SQLiteStore, contiguous_ranges, date_range
+
+logger = logging.getLogger(__name__)
+
+# Path of the SQLite database; the store is disabled when empty
+ROW_STORE_PATH = os.getenv("ROW_STORE_PATH", "")
+# Least recently used sites are evicted once the database grows past this size
+ROW_STORE_MAX_BYTES = int(os.getenv("ROW_STORE_MAX_BYTES", str(2 * 1024 ** 3)))
+# Days this recent are refetched on every request (Search Console backfills them)
+ROW_STORE_PROVISIONAL_DAYS = int(os.getenv("ROW_STORE_PROVISIONAL_DAYS", "3"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites (
+    site_url TEXT PRIMARY KEY,
+    last_access REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fetched_days (
+    site_url TEXT NOT NULL,
+    date TEXT NOT NULL,
+    final INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (site_url, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_totals (
+    site_url TEXT NOT NULL,
+    date TEXT NOT NULL,
+    clicks INTEGER NOT NULL,
+    impressions INTEGER NOT NULL,
+    PRIMARY KEY (site_url, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS query_rows (
+    site_url TEXT NOT NULL,
+    date TEXT NOT NULL,
+    query TEXT NOT NULL,
+    clicks INTEGER NOT NULL,
+    impressions INTEGER NOT NULL,
+    position REAL NOT NULL,
+    PRIMARY KEY (site_url, date, query)
+) WITHOUT ROWID;
+"""
+
+
+class RowStore(SQLiteStore):
+    """Raw per-day query rows of every synced site, evicted by least recent use."""
+
+    SCHEMA = SCHEMA
+    PRAGMAS = ("auto_vacuum = INCREMENTAL",)
+
+    def __init__(self, path: str, max_bytes: int = ROW_STORE_MAX_BYTES):
+        super().__init__(path)
+        self.max_bytes = max_bytes
+
+    def missing_days(self, site_url: str, start_date: str, end_date: str) -> List[str]:
+        """Days in the range that are not stored, or only stored provisionally."""
+        with self._connect() as conn:
+            final_days = {
+                row[0] for row in conn.execute(
+                    "SELECT date FROM fetched_days WHERE site_url = ? AND date BETWEEN ? AND ? AND final = 1",
+                    (site_url, start_date, end_date)
+                )
+            }
+        return [day for day in date_range(start_date, end_date) if day not in final_days]
+
+    def data_version(self, site_url: str, start_date: str, end_date: str):
+        """
+        Fetch time of the most recently stored day of the range, or None when
+        any day is missing or provisional (the next request would refetch it).
+        """
+        with self._connect() as conn:
+            final_days, fetched_at = conn.execute(
+                "SELECT COUNT(*), MAX(fetched_at) FROM fetched_days "
+                "WHERE site_url = ? AND date BETWEEN ? AND ? AND final = 1",
+                (site_url, start_date, end_date)
+            ).fetchone()
+        return fetched_at if final_days == len(date_range(start_date, end_date)) else None
+
+    def clear_days(self, site_url: str, days: List[str]):
+        """Forget `days` before they are fetched again, so a sync cut short leaves them missing."""
+        with self._connect() as conn:
+            for table in ('query_rows', 'daily_totals', 'fetched_days'):
+                conn.executemany(
+                    f"DELETE FROM {table} WHERE site_url = ? AND date = ?",
+                    [(site_url, day) for day in days]
+                )
+
+    def insert_rows(self, site_url: str, rows: list):
+        """Store one page of API rows keyed by [date, query]; such rows are unique per page and shard."""
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO query_rows VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (site_url, row['keys'][0], row['keys'][1], row.get('clicks', 0),
+                     row.get('impressions', 0), row.get('position', 0))
+                    for row in rows
+                )
+            )
+
+    def finish_days(self, site_url: str, days: List[str], totals: list):
+        """
+        Mark `days` as fetched once all their query rows are stored.
+        `totals` are API rows keyed by [date]; those outside `days` are ignored.
+        """
+        provisional_from = (datetime.now() - timedelta(days=ROW_STORE_PROVISIONAL_DAYS)).strftime("%Y-%m-%d")
+        now = time.time()
+        day_set = set(days)
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO daily_totals VALUES (?, ?, ?, ?)",
+                [
+                    (site_url, row['keys'][0], row.get('clicks', 0), row.get('impressions', 0))
+                    for row in totals if row['keys'][0] in day_set
+                ]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO fetched_days VALUES (?, ?, ?, ?)",
+                [(site_url, day, int(day < provisional_from), now) for day in days]
+            )
+            conn.execute("INSERT OR REPLACE INTO sites VALUES (?, ?)", (site_url, now))
+        self.evict(keep=site_url)
+
+    def total_clicks(self, site_url: str, start_date: str, end_date: str):
+        """Property-level clicks for the range, or None when no day has data."""
+        with self._connect() as conn:
+            conn.execute("UPDATE sites SET last_access = ? WHERE site_url = ?", (time.time(), site_url))
+            clicks, days = conn.execute(
+                "SELECT SUM(clicks), COUNT(*) FROM daily_totals WHERE site_url = ? AND date BETWEEN ? AND ?",
+                (site_url, start_date, end_date)
+            ).fetchone()
+        return clicks if days else None
+
+    def query_row_chunks(self, site_url: str, start_date: str, end_date: str, size: int = 25000, by_date: bool = False):
+        """
+        Per-query rows for the range, aggregated the way Search Console does, in chunks of `size`.
+        With `by_date`, rows are keyed by [query, date] instead.
+        """
+        if by_date:
+            sql = """
+                SELECT query, date, clicks, impressions, position * impressions
+                FROM query_rows
+                WHERE site_url = ? AND date BETWEEN ? AND ?
+            """
+        else:
+            sql = """
+                SELECT query, SUM(clicks), SUM(impressions), SUM(position * impressions)
+                FROM query_rows
+                WHERE site_url = ? AND date BETWEEN ? AND ?
+                GROUP BY query
+            """
+        with self._connect() as conn:
+            cursor = conn.execute(sql, (site_url, start_date, end_date))
+            while True:
+                chunk = cursor.fetchmany(size)
+                if not chunk:
+                    return
+                yield [
+                    {
+                        'keys': keys,
+                        'clicks': clicks,
+                        'impressions': impressions,
+                        'ctr': clicks / impressions if impressions > 0 else 0,
+                        'position': position_sum / impressions if impressions > 0 else 0
+                    }
+                    for *keys, clicks, impressions, position_sum in chunk
+                ]
+
+    def size_bytes(self) -> int:
+        with self._connect() as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def invalidate(self, site_url: str) -> int:
+        """Drop everything stored for a site. Returns the number of query rows removed."""
+        with self._connect() as conn:
+            deleted = conn.execute("DELETE FROM query_rows WHERE site_url = ?", (site_url,)).rowcount
+            conn.execute("DELETE FROM daily_totals WHERE site_url = ?", (site_url,))
+            conn.execute("DELETE FROM fetched_days WHERE site_url = ?", (site_url,))
+            conn.execute("DELETE FROM sites WHERE site_url = ?", (site_url,))
+        with self._connect() as conn:
+            conn.execute("PRAGMA incremental_vacuum")
+        logger.info(f"Invalidated row store for {site_url} ({deleted} rows)")
+        return deleted
+
+    def evict(self, keep: str = None):
+        """Evict least recently used sites until the store fits in max_bytes."""
+        while self.size_bytes() > self.max_bytes:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT site_url FROM sites WHERE site_url != ? ORDER BY last_access LIMIT 1",
+                    (keep or '',)
+                ).fetchone()
+            if row is None:
+                break
+            logger.info(f"Row store over {self.max_bytes} bytes, evicting {row[0]}")
+            self.invalidate(row[0])
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            sites = conn.execute("SELECT COUNT(*) FROM sites").fetchone()[0]
+        return {"sites": sites, "size_bytes": self.size_bytes(), "max_bytes": self.max_bytes}
+
+
+row_store = RowStore(ROW_STORE_PATH) if ROW_STORE_PATH else None
+
+# (site_url, day) -> future of the sync fetching that day, resolved to True once it is stored
+_day_syncs = {}
+
+
+class _RowWriter:
+    """fetch_rows sink writing each page of [date, query] rows straight into the store."""
+
+    def __init__(self, store: RowStore, site_url: str):
+        self.store = store
+        self.site_url = site_url
+
+    def fold(self, rows: list):
+        self.store.insert_rows(self.site_url, rows)
+
+
+async def _fetch_range(store: RowStore, session, site_url: str, start_date: str, end_date: str, shard: str, on_page):
+    """
+    Fetch one contiguous range of missing days shard by shard. Pages go to
+    SQLite as they arrive, and each shard's days are marked fetched as soon
+    as it completes, so a failure keeps the shards already stored.
+    """
+    semaphore = asyncio.Semaphore(GSC_FETCH_CONCURRENCY)
+    totals, (shards, first_page) = await asyncio.gather(
+        fetch_rows(session, site_url, start_date, end_date, dimensions=['date'], shard='none'),
+        plan_fetch(session, site_url, start_date, end_date, ['date', 'query'], shard, semaphore)
+    )
+
+    async def fetch_one(shard_start: str, shard_end: str):
+        days = date_range(shard_start, shard_end)
+        await asyncio.to_thread(store.clear_days, site_url, days)
+        await fetch_shard(
+            session, site_url, shard_start, shard_end, ['date', 'query'], semaphore,
+            first_page=first_page, on_page=on_page, sink=_RowWriter(store, site_url)
+        )
+        await asyncio.to_thread(store.finish_days, site_url, days, totals)
+
+    # Let every shard finish before failing, so the ones that succeed are kept
+    results = await asyncio.gather(
+        *(fetch_one(shard_start, shard_end) for shard_start, shard_end in shards), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def _fetch_days(store: RowStore, session, site_url: str, days: List[str], shard: str, on_page):
+    for range_start, range_end in contiguous_ranges(days):
+        await _fetch_range(store, session, site_url, range_start, range_end, shard, on_page)
+
+
+async def sync_site(
+    store: RowStore,
+    session,
+    site_url: str,
+    start_date: str,
+    end_date: str,
+    shard: str = 'auto',
+    on_page=None
+):
+    """
+    Fetch and store the days of the range that are missing locally. Days
+    already being fetched by a concurrent sync are waited for rather than
+    fetched again, so overlapping requests share the work while disjoint
+    ranges of one site (the two periods of /compare) sync in parallel.
+    """
+    pending = await asyncio.to_thread(store.missing_days, site_url, start_date, end_date)
+    if not pending:
+        logger.info(f"Row store hit for {site_url} {start_date}..{end_date}")
+        return
+
+    logger.info(f"Row store missing {len(pending)} days for {site_url}")
+    loop = asyncio.get_running_loop()
+    while pending:
+        claimed = [day for day in pending if (site_url, day) not in _day_syncs]
+        waiting = {day: _day_syncs[(site_url, day)] for day in pending if (site_url, day) in _day_syncs}
+        future = loop.create_future()
+        for day in claimed:
+            _day_syncs[(site_url, day)] = future
+        try:
+            await _fetch_days(store, session, site_url, claimed, shard, on_page)
+            future.set_result(True)
+        finally:
+            if not future.done():
+                future.set_result(False)
+            for day in claimed:
+                del _day_syncs[(site_url, day)]
+
+        # Days whose sync failed are claimed again on the next round; asyncio.wait
+        # (unlike gather) leaves the other syncs' futures alone if this one is cancelled
+        if waiting:
+            await asyncio.wait(set(waiting.values()))
+        pending = [day for day, sync in waiting.items() if not sync.result()]
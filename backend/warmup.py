@@ -0,0 +1,62 @@
+"""
+Startup warm-up, run from the FastAPI lifespan hook.
+
+Pays the one-off costs of the first analysis before traffic arrives: the
+discovery document and service build, classifier compilation and the lazy
+initialisation inside pandas/numpy. Connection warm-up runs in the
+background so it never delays startup.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aggregation import QueryAccumulator, compare_queries
+from analysis import summarize_period
+from classifier import get_classifier
+from gsc import GSC_API_ENDPOINT, warm_up_pool
+
+logger = logging.getLogger(__name__)
+
+# JSON list of brand patterns to compile at startup; items are a pattern
+# (keywords mode) or a [pattern, mode] pair
+WARMUP_PATTERNS = os.getenv("WARMUP_PATTERNS", "[]")
+# Open keep-alive connections to the Search Console API from every pool thread
+GSC_WARM_CONNECTIONS = os.getenv("GSC_WARM_CONNECTIONS", "1") == "1"
+
+SAMPLE_ROWS = [
+    {'keys': ['queryscope login'], 'clicks': 3, 'impressions': 10, 'ctr': 0.3, 'position': 1.2},
+    {'keys': ['seo tool'], 'clicks': 1, 'impressions': 40, 'ctr': 0.025, 'position': 8.5}
+]
+
+_background = set()
+
+
+def warm_pipeline(patterns: list):
+    """Compile the configured classifiers and run a tiny analysis end to end."""
+    for item in patterns:
+        pattern, mode = (item, 'keywords') if isinstance(item, str) else item
+        get_classifier(pattern, mode)
+
+    accumulator = QueryAccumulator(get_classifier('queryscope', 'keywords'))
+    accumulator.fold(SAMPLE_ROWS)
+    _, frame = summarize_period(accumulator, 4)
+    compare_queries(frame, frame)
+
+
+async def warm_up():
+    start = time.perf_counter()
+    try:
+        patterns = json.loads(WARMUP_PATTERNS)
+    except json.JSONDecodeError:
+        logger.error(f"Ignoring invalid WARMUP_PATTERNS: {WARMUP_PATTERNS}")
+        patterns = []
+    await asyncio.to_thread(warm_pipeline, patterns)
+    logger.info(f"Warm-up done in {time.perf_counter() - start:.2f}s")
+
+    connect_url = (GSC_API_ENDPOINT or 'https://searchconsole.googleapis.com/') if GSC_WARM_CONNECTIONS else None
+    # warm_up_pool blocks on the Search Console pool, so it runs on the default executor
+    task = asyncio.create_task(asyncio.to_thread(warm_up_pool, connect_url))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
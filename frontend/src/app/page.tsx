@@ -38,8 +38,7 @@ interface ResultsData {
   top_non_brand_queries: QueryData[];
   top_brand_queries: QueryData[];
   site_url: string;
-  all_non_brand_queries: QueryData[];
-  all_brand_queries: QueryData[];
+  result_id: string;
 }
 
 interface FAQItem {
@@ -787,109 +786,74 @@ export default function Home() {
     }
   };
 
+  // Full query data stays on the server; exports are streamed from the stored result
+  const exportUrl = (data: ResultsData, summary: boolean = true): string | null => {
+    const apiUrl = process.env.NEXT_PUBLIC_API_URL;
+    if (!apiUrl || !data.result_id) {
+      console.error('Missing API URL or result ID');
+      return null;
+    }
+    return `${apiUrl}/results/${data.result_id}/export.csv${summary ? '' : '?summary=false'}`;
+  };
+
   const handleExportCSV = (data: ResultsData) => {
-    if (!data.all_non_brand_queries || !data.all_brand_queries) {
-      console.error('Missing query data');
+    const url = exportUrl(data);
+    if (!url) {
       return;
     }
 
-    const formatNumber = (num: number): string => {
-      return num.toLocaleString('fr-FR');
-    };
-
-    const formatPercent = (num: number): string => {
-      return `${num.toFixed(1)}%`;
-    };
-
-    const formatPosition = (num: number): string => {
-      return num === Math.floor(num) ? num.toString() : num.toFixed(1);
-    };
-
-    const allQueries = [
-      ...(data.all_non_brand_queries || []).map(q => ({
-        ...q,
-        type: 'Non-Brand'
-      })),
-      ...(data.all_brand_queries || []).map(q => ({
-        ...q,
-        type: 'Brand'
-      }))
-    ].sort((a, b) => b.clicks - a.clicks);
-
-    const csv = [
-      ['QUERY', 'TYPE', 'CLICKS', 'IMPRESSIONS', 'CTR', 'POSITION'],
-      ...allQueries.map(q => [
-        q.query,
-        q.type,
-        formatNumber(q.clicks),
-        formatNumber(q.impressions),
-        formatPercent(q.ctr),
-        formatPosition(q.position)
-      ]),
-      ['', '', '', '', '', ''],
-      ['NON-BRAND TOTAL', '', formatNumber(data.non_brand_clicks), formatNumber(data.non_brand_impressions), formatPercent(data.non_brand_ctr), formatPosition(data.non_brand_avg_position)],
-      ['BRAND TOTAL', '', formatNumber(data.brand_clicks), formatNumber(data.brand_impressions), formatPercent(data.brand_ctr), formatPosition(data.brand_avg_position)],
-      ['HIDDEN TRAFFIC', '', formatNumber(data.unattributed_clicks), '', '', '']
-    ].map(row => row.join(';')).join('\n');
-
-    const blob = new Blob(['\ufeff' + csv], { type: 'text/csv;charset=utf-8;' });
     const link = document.createElement('a');
-    link.href = URL.createObjectURL(blob);
+    link.href = url;
     link.download = `queryscope_analysis.csv`;
     link.click();
   };
 
-  const handleExportExcel = (data: ResultsData) => {
-    if (!data.all_non_brand_queries || !data.all_brand_queries) {
-      console.error('Missing query data');
+  const handleExportExcel = async (data: ResultsData) => {
+    const url = exportUrl(data, false);
+    if (!url) {
       return;
     }
 
-    const formatNumber = (num: number): string => {
-      return num.toLocaleString('fr-FR');
-    };
+    // Cell formats by column of the CSV: Type, Query, Clicks, Impressions, CTR, Position, Click Share, Impression Share
+    const formats: Record<number, string> = { 2: '#,##0', 3: '#,##0', 4: '0.00%', 5: '0.0', 6: '0.00%', 7: '0.00%' };
+    const percent = (text: string): number => parseFloat(text) / 100;
 
-    const formatPercent = (num: number): string => {
-      return `${num.toFixed(1)}%`;
-    };
+    try {
+      const response = await axios.get(url, { responseType: 'text' });
+      // The byte order mark is only there for Excel's CSV import; cells are read as text so queries stay text
+      const csv = (response.data as string).replace(/^\uFEFF/, '');
+      const sheet = XLSX.read(csv, { type: 'string', raw: true }).Sheets.Sheet1;
+      const [header, ...rows] = XLSX.utils.sheet_to_json<string[]>(sheet, { header: 1, raw: true, defval: '' });
+
+      const ws = XLSX.utils.aoa_to_sheet([
+        header,
+        ...rows.map(([type, query, clicks, impressions, ctr, position, clickShare, impressionShare]) => [
+          type, query, Number(clicks), Number(impressions), percent(ctr), Number(position),
+          percent(clickShare), percent(impressionShare)
+        ]),
+        [],
+        ['Non-Brand', 'TOTAL', data.non_brand_clicks, data.non_brand_impressions, data.non_brand_ctr / 100, data.non_brand_avg_position],
+        ['Brand', 'TOTAL', data.brand_clicks, data.brand_impressions, data.brand_ctr / 100, data.brand_avg_position],
+        ['Unattributed', 'HIDDEN TRAFFIC', data.unattributed_clicks]
+      ]);
+
+      const range = XLSX.utils.decode_range(ws['!ref'] as string);
+      for (let r = 1; r <= range.e.r; r++) {
+        for (const [c, format] of Object.entries(formats)) {
+          const cell = ws[XLSX.utils.encode_cell({ r, c: Number(c) })];
+          if (cell && cell.t === 'n') {
+            cell.z = format;
+          }
+        }
+      }
 
-    const formatPosition = (num: number): string => {
-      return num === Math.floor(num) ? num.toString() : num.toFixed(1);
-    };
+      const wb = XLSX.utils.book_new();
+      XLSX.utils.book_append_sheet(wb, ws, "Analysis");
 
-    const allQueries = [
-      ...(data.all_non_brand_queries || []).map(q => ({
-        ...q,
-        type: 'Non-Brand'
-      })),
-      ...(data.all_brand_queries || []).map(q => ({
-        ...q,
-        type: 'Brand'
-      }))
-    ].sort((a, b) => b.clicks - a.clicks);
-
-    const excelData = [
-      ['QUERY', 'TYPE', 'CLICKS', 'IMPRESSIONS', 'CTR', 'POSITION'],
-      ...allQueries.map(q => [
-        q.query,
-        q.type,
-        formatNumber(q.clicks),
-        formatNumber(q.impressions),
-        formatPercent(q.ctr),
-        formatPosition(q.position)
-      ]),
-      ['', '', '', '', '', ''],
-      ['NON-BRAND TOTAL', '', formatNumber(data.non_brand_clicks), formatNumber(data.non_brand_impressions), formatPercent(data.non_brand_ctr), formatPosition(data.non_brand_avg_position)],
-      ['BRAND TOTAL', '', formatNumber(data.brand_clicks), formatNumber(data.brand_impressions), formatPercent(data.brand_ctr), formatPosition(data.brand_avg_position)],
-      ['HIDDEN TRAFFIC', '', formatNumber(data.unattributed_clicks), '', '', '']
-    ];
-
-    const wb = XLSX.utils.book_new();
-    const ws = XLSX.utils.aoa_to_sheet(excelData);
-
-    XLSX.utils.book_append_sheet(wb, ws, "Analysis");
-
-    XLSX.writeFile(wb, `queryscope_analysis.xlsx`);
+      XLSX.writeFile(wb, `queryscope_analysis.xlsx`);
+    } catch (err) {
+      console.error('Excel export failed:', err);
+    }
   };
 
   return (